@@ -0,0 +1,215 @@
+#!/usr/bin/env python3
+"""
+Run many programs, or one function over many sets of arguments, across a
+pool of worker processes.
+
+    batch.py files a.math b.math c.mathc
+    batch.py call fib.math fib < args.txt
+
+The files command compiles and runs each file in a worker. The call command
+compiles the file once, unless it's already a module, ships the module to
+every worker, and then calls the named function with each line of
+arguments from the input, one tuple of numbers per line. Either way the
+work is sent out in chunks, and the results are printed in input order as
+they come back.
+"""
+from __future__ import print_function
+
+import argparse
+import functools
+import itertools
+import os
+import sys
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import bcmodule
+from interpreter import (interp, run, execute, layout, decode_functions,
+                         PUSH_NUM, CALL, RETURN)
+from main import compile_bytecode
+
+
+class Result(object):
+    """
+    The outcome of one run, either its value or the error it raised.
+    """
+    __slots__ = ('value', 'error')
+
+    def __init__(self, value=None, error=None):
+        self.value = value
+        self.error = error
+
+    def __repr__(self):
+        return 'Result({!r}, {!r})'.format(self.value, self.error)
+
+    def __str__(self):
+        if self.error is not None:
+            return 'error: {}'.format(self.error)
+        return str(self.value)
+
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of up to size items, lazily.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def ordered(executor, fn, chunks, window):
+    """
+    Submit fn(chunk) for every chunk, and yield the items of the lists it
+    returns in the order of the chunks. At most window chunks are in flight
+    at once, so an endless stream of input is fine.
+    """
+    pending = deque()
+    for chunk in chunks:
+        pending.append(executor.submit(fn, chunk))
+        if len(pending) >= window:
+            for result in pending.popleft().result():
+                yield result
+    while pending:
+        for result in pending.popleft().result():
+            yield result
+
+
+def run_file(name, optimize=False):
+    try:
+        if bcmodule.is_module(name):
+            fns, code = bcmodule.load(name)
+            return Result(run(fns, code))
+        return Result(interp(*compile_bytecode(name, optimize=optimize)))
+    except Exception as e:
+        return Result(error=str(e) or e.__class__.__name__)
+
+
+def run_files_chunk(chunk, optimize=False):
+    return [run_file(name, optimize) for name in chunk]
+
+
+# The program each worker of a call batch runs, set once per worker by
+# load_program() rather than being sent along with every chunk.
+_program = None
+
+
+def load_program(module, index):
+    global _program
+    fns, _ = bcmodule.read(module)
+    _program = (layout(fns, decode_functions(fns)), index, fns[index].arity)
+
+
+def call_chunk(chunk):
+    frames, index, arity = _program
+    results = []
+    for args in chunk:
+        if len(args) != arity:
+            results.append(Result(error='expected {} arguments, got {}'
+                                  .format(arity, len(args))))
+            continue
+        code = ([PUSH_NUM] * arity + [CALL, RETURN],
+                list(args) + [index, None])
+        try:
+            results.append(Result(execute(frames, code)))
+        except Exception as e:
+            results.append(Result(error=str(e) or e.__class__.__name__))
+    return results
+
+
+def run_files(names, workers=None, chunksize=1, optimize=False):
+    """
+    Compile and run each of the files names, yielding a Result for each
+    one in order.
+    """
+    workers = workers or os.cpu_count()
+    fn = functools.partial(run_files_chunk, optimize=optimize)
+    with ProcessPoolExecutor(workers) as executor:
+        for result in ordered(executor, fn, chunked(names, chunksize),
+                              2 * workers):
+            yield result
+
+
+def run_calls(module, name, arg_tuples, workers=None, chunksize=256):
+    """
+    Call the function called name in a compiled module, as written by
+    bcmodule.dump(), with each tuple of arguments in arg_tuples. Yields a
+    Result for each call in order.
+    """
+    fns, _ = bcmodule.read(module)
+    indices = [i for i, fn in enumerate(fns) if fn.name == name]
+    if not indices:
+        raise Exception('no function called {}'.format(name))
+    workers = workers or os.cpu_count()
+    with ProcessPoolExecutor(workers, initializer=load_program,
+                             initargs=(module, indices[0])) as executor:
+        for result in ordered(executor, call_chunk,
+                              chunked(arg_tuples, chunksize), 2 * workers):
+            yield result
+
+
+def parse_args(lines):
+    """
+    Parse lines of numbers, separated by spaces or commas, into tuples of
+    floats. Blank lines are skipped.
+    """
+    for line in lines:
+        fields = line.replace(',', ' ').split()
+        if fields:
+            yield tuple(float(field) for field in fields)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Run many .math programs, or calls, in parallel.')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='the number of worker processes, one per core '
+                        'by default')
+    parser.add_argument('-c', '--chunksize', type=int,
+                        help='how many files or calls to send to a worker '
+                        'at once')
+    parser.add_argument('-O', dest='optimize', action='store_true',
+                        help='fold constants and simplify expressions')
+    commands = parser.add_subparsers(dest='command')
+
+    files_parser = commands.add_parser(
+        'files', help='run each file, printing its result')
+    files_parser.add_argument('filenames', nargs='+')
+
+    call_parser = commands.add_parser(
+        'call', help='call a function with each line of arguments')
+    call_parser.add_argument('filename',
+                             help='the .math script or module defining the '
+                             'function')
+    call_parser.add_argument('function')
+    call_parser.add_argument('-i', '--input', type=argparse.FileType('r'),
+                             default=sys.stdin,
+                             help='where to read the arguments from, one '
+                             'call per line, stdin by default')
+
+    args = parser.parse_args()
+    failed = False
+    if args.command == 'files':
+        results = run_files(args.filenames, args.jobs, args.chunksize or 1,
+                            args.optimize)
+        for name, result in zip(args.filenames, results):
+            print('{}: {}'.format(name, result))
+            failed = failed or result.error is not None
+    elif args.command == 'call':
+        if bcmodule.is_module(args.filename):
+            with open(args.filename, 'rb') as f:
+                module = f.read()
+        else:
+            module = bcmodule.dump(*compile_bytecode(
+                args.filename, optimize=args.optimize))
+        results = run_calls(module, args.function,
+                            parse_args(args.input), args.jobs,
+                            args.chunksize or 256)
+        for result in results:
+            print(result)
+            failed = failed or result.error is not None
+    else:
+        parser.print_help()
+    sys.exit(1 if failed else 0)
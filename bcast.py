@@ -33,6 +33,10 @@ class AST(object):
     node. This means that most subclasses don't need to impelement __repr__,
     etc.
     """
+    # Programs can have a lot of nodes, so they don't get a __dict__. Each
+    # subclass lists the attributes it adds, or an empty __slots__.
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -49,8 +53,9 @@ class AST(object):
         return (self.__class__ == other.__class__ and
                 self.value == other.value)
 
-    # Every subclass should implement codegen.
-    def codegen(self):
+    # Every subclass should implement codegen, which appends the node's
+    # instructions to the bcinstr.Emitter out.
+    def codegen(self, out):
         raise Exception("Codegen unimplemented for {}".format(
             self.__class__.__name__
         ))
@@ -68,14 +73,18 @@ class Num(AST):
     """
     Represents a literal number.
     """
-    def codegen(self):
-        return [bcinstr.PushNum(self.value.value)]
+    __slots__ = ()
+
+    def codegen(self, out):
+        out.emit(bcinstr.PushNum(self.value.value))
 
 
 class Ident(AST):
     """
     Represents a variable.
     """
+    __slots__ = ()
+
     def label(self, env):
         if self.value.value not in env.local_names:
             raise Exception("Variable `{}` is undefined".format(
@@ -90,19 +99,30 @@ class NameLabel(Ident):
     label are the same variable, and the index of the label corresponds to the
     position of that variable stored on the local variables stack.
     """
-    def codegen(self):
-        return [bcinstr.LoadLocal(self.value)]
+    __slots__ = ()
+
+    def codegen(self, out):
+        out.emit(bcinstr.LoadLocal(self.value))
 
     def __str__(self):
         return "[{}]".format(self.value)
 
 
+# The operators that only work out their right hand side when they need to.
+short_circuit = ('&&', '||')
+
+# The operators whose result is always 0.0 or 1.0.
+comparisons = ('<', '>', '<=', '>=', '==', '!=')
+
+
 class BinOp(AST):
     """
     Represents a binary operation on two expressions. The lhs and rhs
     attributes represent the two expressions, and the op attribute
     stores the operator applied to them.
     """
+    __slots__ = ('lhs', 'op', 'rhs')
+
     def __init__(self, lhs, op, rhs):
         self.lhs, self.op, self.rhs = lhs, op, rhs
 
@@ -125,16 +145,77 @@ class BinOp(AST):
     # Generate the code for the left hand and right hand sides, then call the
     # operation. The stack model encodes expressions in RPN, so an expression
     # like (1 + 1) * 2 becomes (1 1 + 2 *).
-    def codegen(self):
-        code = self.lhs.codegen()
-        code.extend(self.rhs.codegen())
-        code.append(bcinstr.MathOp(self.op.value))
-        return code
-
-    # Recursively label both sides, with a shared environment.
+    def codegen(self, out):
+        if self.op.value in short_circuit:
+            again = self.lhs_again()
+            if again is not None:
+                self.short_circuit(out, again)
+                return
+        self.lhs.codegen(out)
+        self.rhs.codegen(out)
+        out.emit(bcinstr.MathOp(self.op.value))
+
+    # a && b is a when a is false, and b otherwise, and a || b is a when a is
+    # true. Either way, the right hand side is only worked out when it's the
+    # result. The operator still makes the result, from a constant that's
+    # as true or false as the left hand side, or from the left hand side's
+    # value pushed again, since the branch takes it off the stack. So the
+    # result goes through float() just like it would have, and is exactly
+    # what the ops table gives.
+    def short_circuit(self, out, again):
+        op = self.op.value
+        skip, end = bcinstr.Label(), bcinstr.Label()
+        self.lhs.codegen(out)
+        out.branch_unless(skip)
+        if op == '&&':
+            self.rhs_codegen(out, 1.0)
+        else:
+            self.lhs_codegen(out, again)
+        out.branch(end)
+        out.place(skip)
+        if op == '&&':
+            self.lhs_codegen(out, again)
+        else:
+            self.rhs_codegen(out, 0.0)
+        out.place(end)
+
+    def rhs_codegen(self, out, lhs):
+        out.emit(bcinstr.PushNum(lhs))
+        self.rhs.codegen(out)
+        out.emit(bcinstr.MathOp(self.op.value))
+
+    # A local is loaded twice, since a && a and a || a are float(a), and the
+    # peephole optimizer fuses the two loads and the operator.
+    def lhs_codegen(self, out, again):
+        out.emit(again)
+        if again.isa(bcinstr.LoadLocal):
+            out.emit(bcinstr.LoadLocal(again.value))
+            out.emit(bcinstr.MathOp(self.op.value))
+
+    # The instruction that pushes the left hand side's value again, when
+    # that's the result of && or ||, or None if there isn't one. A
+    # comparison is always 0.0 when it's false and 1.0 when it's true.
+    def lhs_again(self):
+        lhs = self.lhs
+        if isinstance(lhs, Num):
+            return bcinstr.PushNum(lhs.value.value)
+        elif isinstance(lhs, NameLabel):
+            return bcinstr.LoadLocal(lhs.value)
+        elif isinstance(lhs, Tee) and lhs.name is not None:
+            return bcinstr.LoadLocal(lhs.name.value)
+        elif isinstance(lhs, BinOp) and lhs.op.value in comparisons:
+            return bcinstr.PushNum(0.0 if self.op.value == '&&' else 1.0)
+        return None
+
+    # Recursively label both sides, with a shared environment. The left
+    # hand side of && or || is kept in a local of its own, if its value
+    # can't be pushed again any other way.
     def label(self, env):
         self.lhs = self.lhs.label(env)
         self.rhs = self.rhs.label(env)
+        if self.op.value in short_circuit and self.lhs_again() is None:
+            self.lhs = Tee(NameLabel(env.next_local), self.lhs)
+            env.next_local += 1
         return self
 
 
@@ -144,6 +225,8 @@ class Assignment(AST):
     the assignment is stored in the expr attribute. The AST is invalid if
     anything other than an Ident is stored in the name attribute.
     """
+    __slots__ = ('name', 'expr')
+
     def __init__(self, name, expr):
         assert isinstance(name, Ident)
         self.name, self.expr = name, expr
@@ -158,10 +241,9 @@ class Assignment(AST):
         return (self.__class__ == other.__class__ and
                 self.name == other.name and self.expr == other.expr)
 
-    def codegen(self):
-        code = self.expr.codegen()
-        code.append(bcinstr.StoreLocal(self.name.value))
-        return code
+    def codegen(self, out):
+        self.expr.codegen(out)
+        out.emit(bcinstr.StoreLocal(self.name.value))
 
     # Either replace the left hand side with a label from the environement,
     # or, if it's not present in the environment, bind it as a fresh name.
@@ -175,14 +257,51 @@ class Assignment(AST):
         return self
 
 
+class Tee(AST):
+    """
+    Stores the value of an expression in a local, and is that value as
+    well, so that it can be used again later without working it out again.
+    Only labeling and the optimizer make these, on labeled ASTs.
+    """
+    __slots__ = ('name', 'expr')
+
+    def __init__(self, name, expr):
+        self.name, self.expr = name, expr
+
+    def __repr__(self):
+        return "Tee({}, {})".format(self.name, self.expr)
+
+    def __str__(self):
+        return "({} = {})".format(self.name, self.expr)
+
+    def __eq__(self, other):
+        return (self.__class__ == other.__class__ and
+                self.name == other.name and self.expr == other.expr)
+
+    # The peephole optimizer turns the store and load into a TEE_LOCAL, or
+    # fuses the load into whatever uses it.
+    def codegen(self, out):
+        self.expr.codegen(out)
+        out.emit(bcinstr.StoreLocal(self.name.value))
+        out.emit(bcinstr.LoadLocal(self.name.value))
+
+
 class Return(AST):
     """
     Represents return a result from the program.
     """
-    def codegen(self):
-        code = self.value.codegen()
-        code.append(bcinstr.Return())
-        return code
+    __slots__ = ()
+
+    # Nothing runs in the current frame after a call in return position, so
+    # the callee can take over the frame instead of returning into it.
+    def codegen(self, out):
+        if isinstance(self.value, Call):
+            for arg in self.value.args:
+                arg.codegen(out)
+            out.emit(bcinstr.TailCall(self.value.name.value))
+        else:
+            self.value.codegen(out)
+            out.emit(bcinstr.Return())
 
     def __str__(self):
         return "return {}".format(self.value)
@@ -193,8 +312,13 @@ class Return(AST):
 
 
 class Fn(AST):
+    __slots__ = ('name', 'args', 'body', 'frame_size')
+
     def __init__(self, name, args, body):
         self.name, self.args, self.body = name, args, body
+        # The number of locals, including the arguments, known once the
+        # function is labeled.
+        self.frame_size = None
 
     def __repr__(self):
         return "{}({}, {}, {})".format(
@@ -214,17 +338,17 @@ class Fn(AST):
                 self.name == other.name and self.args == other.args and
                 self.body == other.body)
 
-    def codegen(self):
-        code = []
-        for i, _ in enumerate(self.args):
-            code.append(bcinstr.StoreLocal(i))
-        code = list(reversed(code))
+    # A function needs an Emitter of its own, since its code is separate
+    # from the code around it.
+    def codegen(self, out):
+        for i in reversed(range(len(self.args))):
+            out.emit(bcinstr.StoreLocal(i))
         for line in self.body:
-            code.extend(line.codegen())
-        if not code[-1].isa(bcinstr.Return):
-            code.append(bcinstr.PushNum(0))
-            code.append(bcinstr.Return())
-        return code
+            line.codegen(out)
+        code = out.code
+        if not code or not code[-1].isa((bcinstr.Return, bcinstr.TailCall)):
+            out.emit(bcinstr.PushNum(0))
+            out.emit(bcinstr.Return())
 
     def label(self, env):
         # Create a fresh environment local to the function,
@@ -239,10 +363,13 @@ class Fn(AST):
         for i, line in enumerate(self.body):
             self.body[i] = line.label(env)
 
+        self.frame_size = env.next_local
         return self
 
 
 class Call(AST):
+    __slots__ = ('name', 'args')
+
     def __init__(self, name, args):
         self.name, self.args = name, args
 
@@ -259,12 +386,10 @@ class Call(AST):
         return (self.__class__ == other.__class__ and
                 self.name == other.name and self.args == other.args)
 
-    def codegen(self):
-        code = []
+    def codegen(self, out):
         for arg in self.args:
-            code.extend(arg.codegen())
-        code.append(bcinstr.Call(self.name.value))
-        return code
+            arg.codegen(out)
+        out.emit(bcinstr.Call(self.name.value))
 
     def label(self, env):
         if self.name.value not in env.functions:
@@ -275,6 +400,8 @@ class Call(AST):
 
 
 class IfElse(AST):
+    __slots__ = ('cond', 'if_block', 'else_block')
+
     def __init__(self, cond, if_block, else_block):
         self.cond = cond
         self.if_block, self.else_block = if_block, else_block
@@ -311,20 +438,20 @@ class IfElse(AST):
                 self.if_block == other.if_block and
                 self.else_block == other.else_block)
 
-    def codegen(self):
-        code = self.cond.codegen()
-        if_code = []
+    # The if block always ends with a branch over the else block, even when
+    # it's empty, which the peephole optimizer removes.
+    def codegen(self, out):
+        else_label, end = bcinstr.Label(), bcinstr.Label()
+        self.cond.codegen(out)
+        out.branch_unless(else_label)
         for stmt in self.if_block:
-            if_code.extend(stmt.codegen())
-        else_code = []
+            stmt.codegen(out)
+        out.branch(end)
+        out.place(else_label)
         if self.else_block is not None:
             for stmt in self.else_block:
-                else_code.extend(stmt.codegen())
-        if_code.append(bcinstr.Branch(len(else_code)))
-        code.append(bcinstr.CondBranch(0, len(if_code)))
-        code.extend(if_code)
-        code.extend(else_code)
-        return code
+                stmt.codegen(out)
+        out.place(end)
 
     def label(self, env):
         self.cond = self.cond.label(env)
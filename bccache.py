@@ -0,0 +1,160 @@
+"""
+A content-addressed on-disk cache of compiled programs.
+
+Entries are keyed on a hash of the source text, the compiler version and
+any options that change the compiled output, so an entry can never be
+stale. The cache is bounded in size, evicting the least recently used
+entries first.
+"""
+import hashlib
+import os
+import pickle
+import tempfile
+
+import lexer
+import lookahead
+import bcparser
+import bcast
+import bcinstr
+import codegen
+import inliner
+import optimizer
+import peephole
+import purity
+import interpreter
+
+
+# Anything that changes the output of the compiler has to be part of the
+# key. Rather than relying on a version number being bumped by hand, hash
+# the source of every module in the front end.
+COMPILER_MODULES = [lexer, lookahead, bcparser, bcast, bcinstr, codegen,
+                    inliner, optimizer, peephole, purity, interpreter]
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+SUFFIX = '.pickle'
+
+_compiler_version = None
+
+
+def compiler_version():
+    global _compiler_version
+    if _compiler_version is None:
+        digest = hashlib.sha256()
+        for module in COMPILER_MODULES:
+            name = module.__file__
+            if name.endswith(('.pyc', '.pyo')):
+                name = name[:-1]
+            with open(name, 'rb') as f:
+                digest.update(f.read())
+        _compiler_version = digest.hexdigest()
+    return _compiler_version
+
+
+def default_directory():
+    if 'MATH_CACHE_DIR' in os.environ:
+        return os.environ['MATH_CACHE_DIR']
+    base = os.environ.get('XDG_CACHE_HOME',
+                          os.path.join(os.path.expanduser('~'), '.cache'))
+    return os.path.join(base, 'mathc')
+
+
+class Cache(object):
+    """
+    A directory of pickled compiler outputs. The modification time of each
+    entry records when it was last used, and is what eviction goes by.
+    """
+    def __init__(self, directory=None, max_size=DEFAULT_MAX_SIZE):
+        self.directory = directory or default_directory()
+        self.max_size = max_size
+
+    def key(self, name, *options):
+        """
+        Hash the contents of the file name, along with the compiler version
+        and the given options.
+        """
+        digest = hashlib.sha256(compiler_version().encode('ascii'))
+        digest.update(repr(options).encode('utf-8'))
+        with open(name, 'rb') as f:
+            for chunk in iter(lambda: f.read(lexer.CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key + SUFFIX)
+
+    def get(self, key):
+        """
+        Return the cached value for key, or None if there isn't one.
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except (IOError, OSError):
+            return None
+        except Exception:
+            # A corrupt entry is just a miss, and gets replaced on the put.
+            self.remove(path)
+            return None
+        # Mark the entry as recently used.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return value
+
+    def put(self, key, value):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        # Write to a temporary file first so that concurrent readers never
+        # see a partially written entry.
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, self.path(key))
+        except Exception:
+            self.remove(tmp)
+            raise
+        self.evict()
+
+    def entries(self):
+        """
+        List (last use, size, path) for every entry in the cache.
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(SUFFIX):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in
+        max_size.
+        """
+        entries = sorted(self.entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            self.remove(path)
+            total -= size
+
+    def clear(self):
+        for _, _, path in self.entries():
+            self.remove(path)
+
+    @staticmethod
+    def remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
@@ -1,3 +1,4 @@
+from array import array
 import struct
 
 
@@ -5,7 +6,39 @@ def pad(string, width):
     return string + " " * (width - len(string))
 
 
+class ConstantPool(object):
+    """
+    Collects the distinct numbers used by some code, so that instructions
+    can refer to them by index instead of storing them inline.
+    """
+    def __init__(self):
+        self.values = []
+        self.indices = {}
+
+    def __len__(self):
+        return len(self.values)
+
+    def add(self, value):
+        # Key on the exact bit pattern, so that 0.0 and -0.0 stay distinct.
+        key = struct.pack('<d', value)
+        if key not in self.indices:
+            self.indices[key] = len(self.values)
+            self.values.append(value)
+        return self.indices[key]
+
+
 class Instr(object):
+    # There's an instruction object for every instruction of a program, so
+    # they don't get a __dict__. Subclasses list the attributes they add.
+    __slots__ = ('value',)
+    # Each instruction has a fixed integer opcode, which is used both for
+    # its bytecode encoding and to dispatch on it in the interpreter.
+    opcode = None
+    # The struct format of the encoded instruction, starting with the opcode.
+    fmt = '<Bi'
+    # The fields of the record that are indices into the constant pool.
+    const_fields = ()
+
     def __init__(self, value):
         self.value = value
 
@@ -15,32 +48,56 @@ class Instr(object):
     def isa(self, typ):
         return isinstance(self, typ)
 
+    # A record is the tuple of fields that make up the encoded instruction,
+    # with numbers replaced by their index in the constant pool.
+    def to_record(self, consts):
+        return (self.opcode, self.value)
+
+    def to_bytecode(self, consts):
+        return struct.pack(self.fmt, *self.to_record(consts))
+
+    # The inverse of to_record(), where consts is the list of values.
+    @classmethod
+    def from_record(cls, record, consts):
+        return cls(record[1])
+
 
 class PushNum(Instr):
+    __slots__ = ()
+    opcode = 1
+    const_fields = (1,)
+
     def __str__(self):
         return pad("PUSH_NUM", 15) + str(self.value)
 
-    def to_bytecode(self):
-        return struct.pack('<Bf', 1, self.value)
+    def to_record(self, consts):
+        return (self.opcode, consts.add(self.value))
+
+    @classmethod
+    def from_record(cls, record, consts):
+        return cls(consts[record[1]])
 
 
 class LoadLocal(Instr):
+    __slots__ = ()
+    opcode = 2
+
     def __str__(self):
         return pad("LOAD_LOCAL", 15) + str(self.value)
 
-    def to_bytecode(self):
-        return struct.pack('<Bi', 2, self.value)
-
 
 class StoreLocal(Instr):
+    __slots__ = ()
+    opcode = 3
+
     def __str__(self):
         return pad("STORE_LOCAL", 15) + str(self.value)
 
-    def to_bytecode(self):
-        return struct.pack('<Bi', 3, self.value)
-
 
 class MathOp(Instr):
+    __slots__ = ()
+    opcode = 4
+
     op_info = {
         '+': ('ADD', 1),
         '-': ('SUB', 2),
@@ -56,15 +113,23 @@ class MathOp(Instr):
         '&&': ('AND', 12),
         '||': ('OR', 13),
     }
+    op_names = {number: op for op, (_, number) in op_info.items()}
 
     def __str__(self):
         return pad('OP_' + MathOp.op_info[self.value][0], 15)
 
-    def to_bytecode(self):
-        return struct.pack('<Bi', 4, MathOp.op_info[self.value][1])
+    def to_record(self, consts):
+        return (self.opcode, MathOp.op_info[self.value][1])
+
+    @classmethod
+    def from_record(cls, record, consts):
+        return cls(MathOp.op_names[record[1]])
 
 
 class Return(Instr):
+    __slots__ = ()
+    opcode = 5
+
     def __init__(self):
         pass
 
@@ -74,27 +139,47 @@ class Return(Instr):
     def __str__(self):
         return 'RETURN'
 
-    def to_bytecode(self):
-        return struct.pack('<Bi', 5, 0)
+    def to_record(self, consts):
+        return (self.opcode, 0)
+
+    @classmethod
+    def from_record(cls, record, consts):
+        return cls()
 
 
 class Call(Instr):
+    __slots__ = ()
+    opcode = 6
+
     def __str__(self):
         return pad('CALL', 15) + str(self.value)
 
-    def to_bytecode(self):
-        return struct.pack('<Bi', 6, self.value)
+
+class TailCall(Instr):
+    """
+    A call in return position. Rather than saving the caller's frame, the
+    callee replaces it, and returns straight to the caller's caller.
+    """
+    __slots__ = ()
+    opcode = 9
+
+    def __str__(self):
+        return pad('TAIL_CALL', 15) + str(self.value)
 
 
 class Branch(Instr):
+    __slots__ = ()
+    opcode = 7
+
     def __str__(self):
         return pad("BRANCH", 15) + str(self.value)
 
-    def to_bytecode(self):
-        return struct.pack('<Bi', 7, self.value)
-
 
 class CondBranch(Instr):
+    __slots__ = ('true_loc', 'false_loc')
+    opcode = 8
+    fmt = '<Bhh'
+
     def __init__(self, true_loc, false_loc):
         self.true_loc = true_loc
         self.false_loc = false_loc
@@ -108,5 +193,228 @@ class CondBranch(Instr):
         return (pad("COND_BRANCH", 15) + str(self.true_loc) +
                 ' ' + str(self.false_loc))
 
-    def to_bytecode(self):
-        return struct.pack('<Bhh', 8, self.true_loc, self.false_loc)
+    def to_record(self, consts):
+        return (self.opcode, self.true_loc, self.false_loc)
+
+    @classmethod
+    def from_record(cls, record, consts):
+        return cls(record[1], record[2])
+
+
+# Superinstructions, which the peephole optimizer fuses out of common
+# sequences of the instructions above.
+
+class TeeLocal(Instr):
+    """
+    Store the top of the stack to a local without popping it, replacing
+    STORE_LOCAL n; LOAD_LOCAL n.
+    """
+    __slots__ = ()
+    opcode = 10
+
+    def __str__(self):
+        return pad("TEE_LOCAL", 15) + str(self.value)
+
+
+class LocalNumOp(Instr):
+    """
+    Apply an operator to a local and a number, replacing
+    LOAD_LOCAL slot; PUSH_NUM num; OP_x.
+    """
+    __slots__ = ('slot', 'num', 'op')
+    opcode = 11
+    fmt = '<BiiB'
+    const_fields = (2,)
+
+    def __init__(self, slot, num, op):
+        self.slot, self.num, self.op = slot, num, op
+
+    def __repr__(self):
+        return "{}({}, {}, {!r})".format(
+            self.__class__.__name__, self.slot, self.num, self.op)
+
+    def __str__(self):
+        return (pad('LOCAL_NUM_' + MathOp.op_info[self.op][0], 15) +
+                '{} {}'.format(self.slot, self.num))
+
+    def to_record(self, consts):
+        return (self.opcode, self.slot, consts.add(self.num),
+                MathOp.op_info[self.op][1])
+
+    @classmethod
+    def from_record(cls, record, consts):
+        return cls(record[1], consts[record[2]], MathOp.op_names[record[3]])
+
+
+class LocalLocalOp(Instr):
+    """
+    Apply an operator to two locals, replacing
+    LOAD_LOCAL lhs; LOAD_LOCAL rhs; OP_x.
+    """
+    __slots__ = ('lhs', 'rhs', 'op')
+    opcode = 12
+    fmt = '<BiiB'
+
+    def __init__(self, lhs, rhs, op):
+        self.lhs, self.rhs, self.op = lhs, rhs, op
+
+    def __repr__(self):
+        return "{}({}, {}, {!r})".format(
+            self.__class__.__name__, self.lhs, self.rhs, self.op)
+
+    def __str__(self):
+        return (pad('LOCALS_' + MathOp.op_info[self.op][0], 15) +
+                '{} {}'.format(self.lhs, self.rhs))
+
+    def to_record(self, consts):
+        return (self.opcode, self.lhs, self.rhs, MathOp.op_info[self.op][1])
+
+    @classmethod
+    def from_record(cls, record, consts):
+        return cls(record[1], record[2], MathOp.op_names[record[3]])
+
+
+# The instruction classes by opcode, used to decode bytecode.
+instructions = {cls.opcode: cls for cls in [
+    PushNum, LoadLocal, StoreLocal, MathOp, Return, Call, Branch, CondBranch,
+    TailCall, TeeLocal, LocalNumOp, LocalLocalOp,
+]}
+
+
+class CompactCode(object):
+    """
+    A list of instructions packed into two arrays, as an alternative to
+    instruction objects that takes a fraction of the memory. records holds
+    the record of every instruction, padded to WIDTH ints, and consts holds
+    the values their constant indices refer to.
+    """
+    __slots__ = ('records', 'consts')
+    WIDTH = 4
+
+    def __init__(self, records, consts):
+        self.records = records
+        self.consts = consts
+
+    @classmethod
+    def from_instrs(cls, code):
+        consts = ConstantPool()
+        records = array('i')
+        for instr in code:
+            record = instr.to_record(consts)
+            records.extend(record + (0,) * (cls.WIDTH - len(record)))
+        return cls(records, array('d', consts.values))
+
+    def __len__(self):
+        return len(self.records) // self.WIDTH
+
+    def __iter__(self):
+        """
+        Generate the record of each instruction, padded with zeros.
+        """
+        return zip(*[iter(self.records)] * self.WIDTH)
+
+    def to_instrs(self):
+        return [instructions[record[0]].from_record(record, self.consts)
+                for record in self]
+
+
+class Label(object):
+    """
+    A position in an Emitter's code, which branches can refer to before
+    it's known. branches holds the ones waiting for it to be placed.
+    """
+    __slots__ = ('position', 'branches')
+
+    def __init__(self):
+        self.position = None
+        self.branches = []
+
+
+class Emitter(object):
+    """
+    The code of a function, or of the top level, which AST nodes append
+    their instructions to as codegen() walks the tree. Forward branches go
+    to labels, and are patched with their offsets once the label's place is
+    known, so nothing ever has to be emitted twice.
+    """
+    __slots__ = ('code',)
+
+    def __init__(self):
+        self.code = []
+
+    def emit(self, instr):
+        self.code.append(instr)
+
+    def branch(self, label):
+        self.jump(Branch(0), label)
+
+    # Branch on the value on top of the stack, falling through when it's
+    # true and going to label when it isn't.
+    def branch_unless(self, label):
+        self.jump(CondBranch(0, 0), label)
+
+    def jump(self, instr, label):
+        self.code.append(instr)
+        if label.position is None:
+            label.branches.append(len(self.code) - 1)
+        else:
+            self.patch(len(self.code) - 1, label.position)
+
+    def place(self, label):
+        label.position = len(self.code)
+        for index in label.branches:
+            self.patch(index, label.position)
+        label.branches = []
+
+    # Offsets are relative to the instruction after the branch.
+    def patch(self, index, position):
+        instr = self.code[index]
+        if instr.isa(CondBranch):
+            instr.false_loc = position - index - 1
+        else:
+            instr.value = position - index - 1
+
+
+class Function(object):
+    """
+    A compiled function, along with what the compiler knows about it.
+    """
+    __slots__ = ('name', 'arity', 'frame_size', 'code', 'pure', 'decoded',
+                 'compact')
+
+    def __init__(self, name, arity, code, pure=False, frame_size=None):
+        self.name = name
+        self.arity = arity
+        # The number of locals, including the arguments. None if unknown.
+        self.frame_size = frame_size
+        self.code = code
+        # Pure functions only depend on their arguments, so calls to them
+        # can be memoized.
+        self.pure = pure
+        # The interpreter's decoded form of the code, filled in when the
+        # function is first run, or directly when loading a module.
+        self.decoded = None
+        # The CompactCode form, which replaces code after pack().
+        self.compact = None
+
+    def __repr__(self):
+        return "{}({!r}, {}, {!r}, pure={})".format(
+            self.__class__.__name__,
+            self.name, self.arity, self.code, self.pure)
+
+    def pack(self):
+        """
+        Replace the instruction objects with their compact form, to keep
+        large programs in memory. Passes that work on instruction objects
+        need unpack() first.
+        """
+        if self.code is not None:
+            self.compact = CompactCode.from_instrs(self.code)
+            self.code = None
+        return self
+
+    def unpack(self):
+        if self.code is None and self.compact is not None:
+            self.code = self.compact.to_instrs()
+            self.compact = None
+        return self
@@ -0,0 +1,160 @@
+"""
+The binary module format for compiled programs.
+
+All values are little-endian. A module is laid out as:
+
+    header          magic, format version, function count, constant count
+    function table  an entry for every function, followed by one for the
+                    top level code
+    constant pool   every number used by the code, as 64-bit floats
+    code sections   the encoded instructions of each function, back to back
+
+Each function table entry is the offset and length in bytes of the code
+section, the number of arguments, the number of locals including the
+arguments, flags, and the length of the UTF-8 name that immediately follows
+the entry. Offsets are from the start of the file.
+Instructions are encoded with bcinstr's to_bytecode(), so PUSH_NUM refers
+to numbers by their index in the constant pool.
+"""
+import mmap
+import struct
+
+import bcinstr
+from interpreter import decode, decode_records, frame_size
+
+
+MAGIC = b'MBC\0'
+VERSION = 3
+
+HEADER = struct.Struct('<4sHHII')
+ENTRY = struct.Struct('<IIHHHH')
+CONST = struct.Struct('<d')
+
+# Function flags
+PURE = 1
+
+# The encoding of each instruction by opcode, and how many fields it has.
+RECORDS = {opcode: struct.Struct(cls.fmt)
+           for opcode, cls in bcinstr.instructions.items()}
+FIELDS = {opcode: len(record.unpack(bytes(record.size)))
+          for opcode, record in RECORDS.items()}
+
+
+def encode(code, consts):
+    """
+    Encode a list of instructions or a CompactCode as a code section, with
+    its numbers added to the module's constant pool consts.
+    """
+    if not isinstance(code, bcinstr.CompactCode):
+        return b''.join(instr.to_bytecode(consts) for instr in code)
+    section = []
+    for record in code:
+        opcode = record[0]
+        fields = list(record[:FIELDS[opcode]])
+        # Renumber the constants from the function's own pool.
+        for field in bcinstr.instructions[opcode].const_fields:
+            fields[field] = consts.add(code.consts[fields[field]])
+        section.append(RECORDS[opcode].pack(*fields))
+    return b''.join(section)
+
+
+def dump(fns, code):
+    """
+    Serialize compiled functions and top level code into a module.
+    """
+    consts = bcinstr.ConstantPool()
+    sections = [encode(section, consts) for section in [
+        fn.code if fn.code is not None else fn.compact for fn in fns] + [code]]
+    names = [fn.name.encode('utf-8') for fn in fns] + [b'']
+    arities = [fn.arity for fn in fns] + [0]
+    frame_sizes = [
+        fn.frame_size if fn.frame_size is not None else
+        frame_size(decode(fn.code if fn.code is not None else fn.compact))
+        for fn in fns] + [frame_size(decode(code))]
+    flags = [PURE if fn.pure else 0 for fn in fns] + [0]
+
+    offset = (HEADER.size + ENTRY.size * len(sections) +
+              sum(len(name) for name in names) + CONST.size * len(consts))
+    table = []
+    for section, name, arity, size, flag in zip(
+            sections, names, arities, frame_sizes, flags):
+        table.append(ENTRY.pack(
+            offset, len(section), arity, size, flag, len(name)))
+        table.append(name)
+        offset += len(section)
+
+    return b''.join(
+        [HEADER.pack(MAGIC, VERSION, 0, len(fns), len(consts))] + table +
+        [CONST.pack(value) for value in consts.values] + sections)
+
+
+def write(fns, code, name):
+    with open(name, 'wb') as f:
+        f.write(dump(fns, code))
+
+
+def read_records(buf, offset, length):
+    """
+    Generate the instruction records in a code section of the buffer.
+    """
+    end = offset + length
+    while offset < end:
+        record = RECORDS.get(buf[offset])
+        if record is None:
+            raise Exception("Unsupported opcode {} at offset {}".format(
+                buf[offset], offset))
+        yield record.unpack_from(buf, offset)
+        offset += record.size
+
+
+def read(buf):
+    """
+    Decode a module straight from a buffer into the interpreter's decoded
+    form, without building any instruction objects along the way.
+    Returns the functions, which only have their decoded code, and the
+    decoded top level code, ready for interpreter.run().
+    """
+    if len(buf) < HEADER.size:
+        raise Exception("Truncated module header")
+    magic, version, _, fn_count, const_count = HEADER.unpack_from(buf, 0)
+    if magic != MAGIC:
+        raise Exception("Not a compiled module")
+    if version != VERSION:
+        raise Exception("Unsupported module version {}, expected {}".format(
+            version, VERSION))
+
+    offset = HEADER.size
+    table = []
+    for _ in range(fn_count + 1):
+        start, length, arity, size, flags, name_length = ENTRY.unpack_from(
+            buf, offset)
+        offset += ENTRY.size
+        name = bytes(buf[offset:offset + name_length]).decode('utf-8')
+        offset += name_length
+        table.append((start, length, arity, size, flags, name))
+    consts = [CONST.unpack_from(buf, offset + i * CONST.size)[0]
+              for i in range(const_count)]
+
+    fns = []
+    for start, length, arity, size, flags, name in table:
+        fn = bcinstr.Function(name, arity, None, bool(flags & PURE), size)
+        fn.decoded = decode_records(read_records(buf, start, length), consts)
+        fns.append(fn)
+    return fns[:-1], fns[-1].decoded
+
+
+def load(name):
+    """
+    Memory-map a compiled module and decode it.
+    """
+    with open(name, 'rb') as f:
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return read(buf)
+    finally:
+        buf.close()
+
+
+def is_module(name):
+    with open(name, 'rb') as f:
+        return f.read(len(MAGIC)) == MAGIC
@@ -1,38 +1,7 @@
-from lexer import Num, Ident, Op, Keyword
-import bcast
-
-
-def parse_primary(tokens):
-    if tokens.peek() == '(':
-        expr = parse_expr(tokens.skip())
-        assert tokens.next() == ')'
-        return expr
-
-    elif tokens.peek().isa(Num):
-        return bcast.Num(tokens.next())
-    elif tokens.peek().isa(Ident):
-        name = tokens.next()
-        if tokens.peek() == '(':
-            args = parse_args(tokens)
-            return bcast.Call(name, args)
-        else:
-            return bcast.Ident(name)
-    raise Exception("Parse Error, got {}, expecting a number, "
-                    "variable, or parenthesis.".format(
-                        tokens.peek()
-                    ))
-
+from functools import partial
 
-def parse_args(tokens):
-    assert tokens.next() == '('
-    args = []
-    while tokens.peek() != ')':
-        args.append(parse_expr(tokens))
-        if tokens.peek() == ',':
-            tokens.skip()
-
-    assert tokens.next() == ')'
-    return args
+from lexer import Num, Ident, Op, Char, Sep, Keyword
+import bcast
 
 
 operator_table = {
@@ -55,94 +24,186 @@ precedence = {k: v for k, (v, _) in operator_table.items()}
 associativity = {k: v for k, (_, v) in operator_table.items()}
 
 
-def parse_binop_rhs(tokens, lhs, prec):
-    look = tokens.peek()
-    while (look and look.isa(Op) and precedence[look.value] >= prec):
-        op = tokens.next()
-        rhs = parse_primary(tokens)
-        op_prec = precedence[op.value]
-        look = tokens.peek()
-        while (look and look.isa(Op) and
-               (precedence[look.value] > op_prec or
-                associativity[look.value] == 'R' and
-                precedence[look.value] >= op_prec)):
-            op_prec = precedence[look.value]
-            rhs = parse_binop_rhs(tokens, rhs, op_prec)
-            look = tokens.peek()
-        lhs = bcast.BinOp(lhs, op, rhs)
-    return lhs
-
-
-def parse_expr(tokens, expr=None):
-    if expr is None:
-        expr = parse_primary(tokens)
-
-    if not tokens.peek():
-        return expr
-
-    if tokens.peek().isa(Op):
-        expr = parse_binop_rhs(tokens, expr, 0)
-    return expr
-
-
-def parse_block(tokens):
-    assert tokens.next() == '{'
-    statements = []
-    while tokens.peek() != '}':
-        if tokens.peek() == '}':
-            break
-        statements.append(parse_statement(tokens))
-        if tokens.peek() == ';':
-            tokens.skip()
-    assert tokens.next() == '}'
-    return statements
-
-
-def parse_statement(tokens):
-    if tokens.peek().isa(Keyword):
-        if tokens.peek() == 'return':
-            expr = parse_expr(tokens.skip())
-            return bcast.Return(expr)
-        elif tokens.peek() == 'fn':
-            name = tokens.skip().next()
-            assert name.isa(Ident)
-            assert tokens.next() == '('
+def is_char(token, value):
+    return token.__class__ is Char and token.value == value
+
+
+class Parser(object):
+    """
+    Parses a stream of tokens into a list of statements.
+
+    Expressions are parsed by operator precedence, with an explicit stack
+    for parentheses and call arguments rather than recursion, so they can
+    be nested as deeply as memory allows. Tokens are told apart by their
+    class and value, rather than by Token.__eq__.
+    """
+    def __init__(self, tokens):
+        self.advance = partial(next, iter(tokens), None)
+        self.look = self.advance()
+
+    def error(self, expecting):
+        raise Exception("Parse Error, got {}, expecting {}.".format(
+            self.look, expecting))
+
+    def expect(self, value):
+        if self.look is None or self.look.value != value or (
+                self.look.__class__ is not Char):
+            self.error('`{}`'.format(value))
+        self.look = self.advance()
+
+    def skip(self, value):
+        """
+        Skip the next token if it's the separator or character value.
+        """
+        look = self.look
+        if look is not None and look.value == value and (
+                look.__class__ is Char or look.__class__ is Sep):
+            self.look = self.advance()
+
+    # Parse an expression. If first is given, it's the already parsed first
+    # operand. If primary is true, stop after a single operand, which may
+    # still be a parenthesized expression or a call.
+    def expression(self, first=None, primary=False):
+        advance = self.advance
+        look = self.look
+        # The operands and (token, precedence) operators of the expression
+        # being parsed. Reducing them as operators come in is what keeps the
+        # trees the same shape as precedence climbing would make them.
+        operands = []
+        operators = []
+        # For every parenthesis or call that's open, the operands and
+        # operators of the expression around it, the name of the function
+        # for a call, and its arguments so far.
+        outer = []
+        operand = first
+        while True:
+            if operand is None:
+                kind = look.__class__
+                if kind is Num:
+                    operand = bcast.Num(look)
+                    look = advance()
+                elif kind is Ident:
+                    name = look
+                    look = advance()
+                    if look is not None and is_char(look, '('):
+                        look = advance()
+                        if look is not None and is_char(look, ')'):
+                            operand = bcast.Call(name, [])
+                            look = advance()
+                        else:
+                            outer.append((operands, operators, name, []))
+                            operands, operators = [], []
+                            continue
+                    else:
+                        operand = bcast.Ident(name)
+                elif kind is Char and look.value == '(':
+                    outer.append((operands, operators, None, None))
+                    operands, operators = [], []
+                    look = advance()
+                    continue
+                else:
+                    self.look = look
+                    self.error('a number, variable, or parenthesis')
+
+            if look is not None and look.__class__ is Op and not (
+                    primary and not outer):
+                prec, assoc = operator_table[look.value]
+                while operators and (operators[-1][1] > prec or
+                                     operators[-1][1] == prec and
+                                     assoc == 'L'):
+                    rhs = operand
+                    op, _ = operators.pop()
+                    operand = bcast.BinOp(operands.pop(), op, rhs)
+                operands.append(operand)
+                operators.append((look, prec))
+                operand = None
+                look = advance()
+                continue
+
+            # The end of an expression, since nothing can follow an operand
+            # but an operator.
+            while operators:
+                rhs = operand
+                op, _ = operators.pop()
+                operand = bcast.BinOp(operands.pop(), op, rhs)
+            if not outer:
+                self.look = look
+                return operand
+
+            operands, operators, name, args = outer.pop()
+            if name is None:
+                self.look = look
+                self.expect(')')
+                look = self.look
+                continue
+            args.append(operand)
+            if look is not None and is_char(look, ','):
+                look = advance()
+            if look is not None and is_char(look, ')'):
+                operand = bcast.Call(name, args)
+                look = advance()
+            else:
+                # Another argument follows.
+                outer.append((operands, operators, name, args))
+                operands, operators = [], []
+                operand = None
+
+    def block(self):
+        self.expect('{')
+        statements = []
+        while self.look is not None and not is_char(self.look, '}'):
+            statements.append(self.statement())
+            self.skip(';')
+        self.expect('}')
+        return statements
+
+    def statement(self):
+        look = self.look
+        if look.__class__ is not Keyword:
+            expr = self.expression(primary=True)
+            if self.look is not None and is_char(self.look, '='):
+                self.look = self.advance()
+                return bcast.Assignment(expr, self.expression())
+            return self.expression(expr)
+
+        self.look = self.advance()
+        if look.value == 'return':
+            return bcast.Return(self.expression())
+        elif look.value == 'fn':
+            name = self.look
+            if name.__class__ is not Ident:
+                self.error('a function name')
+            self.look = self.advance()
+            self.expect('(')
             args = []
-            while tokens.peek().isa(Ident):
-                args.append(tokens.next())
-                if tokens.peek() == ',':
-                    tokens.skip()
-            assert tokens.next() == ')'
-            statements = parse_block(tokens)
-            return bcast.Fn(name, args, statements)
-        elif tokens.peek() == 'if':
-            cond = parse_expr(tokens.skip())
-            if_block = parse_block(tokens)
+            while self.look.__class__ is Ident:
+                args.append(self.look)
+                self.look = self.advance()
+                self.skip(',')
+            self.expect(')')
+            return bcast.Fn(name, args, self.block())
+        elif look.value == 'if':
+            cond = self.expression()
+            if_block = self.block()
             else_block = None
-            if tokens.peek() == 'else':
-                tokens.next()
-                if tokens.peek() == 'if':
-                    else_block = [parse_statement(tokens)]
+            look = self.look
+            if look.__class__ is Keyword and look.value == 'else':
+                self.look = self.advance()
+                look = self.look
+                if look.__class__ is Keyword and look.value == 'if':
+                    else_block = [self.statement()]
                 else:
-                    else_block = parse_block(tokens)
+                    else_block = self.block()
             return bcast.IfElse(cond, if_block, else_block)
-        else:
-            raise Exception("Unimplemented keyword `{}`".format(
-                tokens.peek().value))
-    else:
-        expr = parse_primary(tokens)
-        if tokens.peek() == '=':
-            rhs = parse_expr(tokens.skip())
-            return bcast.Assignment(expr, rhs)
+        raise Exception("Unimplemented keyword `{}`".format(look.value))
 
-        return parse_expr(tokens, expr)
+    def program(self):
+        statements = []
+        while self.look is not None:
+            statements.append(self.statement())
+            self.skip(';')
+        return statements
 
 
 def parse(tokens):
-    statements = []
-    while tokens.peek():
-        statements.append(parse_statement(tokens))
-        if tokens.peek() == ';':
-            tokens.skip()
-
-    return statements
+    return Parser(tokens).program()
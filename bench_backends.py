@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Compare the stack machine with the register machine on the same programs,
+by instruction count and run time. Programs are compiled with -O, so both
+backends start from the same optimized stack code.
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from lexer import tokenize
+from bcparser import parse
+from codegen import codegen
+from interpreter import decode, decode_functions, execute, layout
+import regvm
+
+
+PROGRAMS = [
+    ('fib2(64)', 'something.math', None),
+    ('recursive fib(20)', None, """
+fn fib(n) { if n < 2 { return n; } return fib(n - 1) + fib(n - 2); }
+return fib(20);
+"""),
+    ('arithmetic loop', None, """
+fn loop(n, acc) {
+  if n <= 0 { return acc; }
+  x = n * 2 - 1;
+  if x > 10 { y = x / 3; } else { y = x ^ 2; }
+  return loop(n - 1, acc + y);
+}
+return loop(20000, 0);
+"""),
+    ('polynomial', None, """
+fn poly(x) { return ((((3 * x + 2) * x - 7) * x + 1) * x - 5) * x + 11; }
+fn sum(i, acc) {
+  if i <= 0 { return acc; }
+  return sum(i - 1, acc + poly(i / 1000));
+}
+return sum(20000, 0);
+"""),
+]
+
+
+def static_size(fns, code):
+    return sum(len(fn.code) for fn in fns) + len(code)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the stack and register machines.')
+    parser.add_argument('-n', '--number', type=int, default=5,
+                        help='runs per timing')
+    args = parser.parse_args()
+
+    print('{:<20} {:>14} {:>14} {:>12} {:>12} {:>8}'.format(
+        'program', 'stack instrs', 'reg instrs', 'stack ms', 'reg ms',
+        'speedup'))
+    for name, filename, source in PROGRAMS:
+        if filename is not None:
+            with open(filename) as f:
+                source = f.read()
+        fns, code = codegen(parse(tokenize(source)), True)
+
+        decoded_fns = layout(fns, decode_functions(fns))
+        decoded_code = decode(code)
+        reg_fns, reg_main = regvm.translate(fns, code)
+        assert (execute(decoded_fns, decoded_code) ==
+                regvm.execute(reg_fns, reg_main))
+
+        stack_time = min(timeit.repeat(
+            lambda: execute(decoded_fns, decoded_code),
+            number=args.number, repeat=3)) / args.number
+        reg_time = min(timeit.repeat(
+            lambda: regvm.execute(reg_fns, reg_main),
+            number=args.number, repeat=3)) / args.number
+        reg_size = sum(len(fn.code) for fn in reg_fns) + len(reg_main.code)
+        print('{:<20} {:>14} {:>14} {:>12.2f} {:>12.2f} {:>7.2f}x'.format(
+            name, static_size(fns, code), reg_size, stack_time * 1e3,
+            reg_time * 1e3, stack_time / reg_time))
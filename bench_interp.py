@@ -0,0 +1,38 @@
+#!/usr/bin/env python3
+"""
+Time the interpreter on a compiled .math script, by default something.math,
+whose top level computes fib(64).
+"""
+from __future__ import print_function
+
+import argparse
+import timeit
+
+from main import compile_bytecode
+from interpreter import interp, decode, decode_functions, execute, layout
+import jit
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the interpreter on a .math script.')
+    parser.add_argument('filename', nargs='?', default='something.math',
+                        help='the script to run')
+    parser.add_argument('-n', '--number', type=int, default=1000,
+                        help='runs per timing')
+    args = parser.parse_args()
+
+    fns, code = compile_bytecode(args.filename)
+    decoded_fns = layout(fns, decode_functions(fns))
+    decoded_code = decode(code)
+    jitted = jit.compile_functions(fns, code)['main']
+
+    timings = [
+        ('interp (decode + run)', lambda: interp(fns, code)),
+        ('execute (run only)', lambda: execute(decoded_fns, decoded_code)),
+        ('jit (run only)', jitted),
+    ]
+    print('result:', interp(fns, code))
+    for name, fn in timings:
+        best = min(timeit.repeat(fn, number=args.number, repeat=5))
+        print('{:<24} {:>10.1f} us'.format(name, best / args.number * 1e6))
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Measure how lexing time scales with the size of the input.
+
+Generates progressively larger .math sources and reports the time taken to
+tokenize each of them. A linear lexer keeps the time per kilobyte roughly
+constant as the input grows.
+"""
+from __future__ import print_function
+
+import argparse
+import time
+
+from lexer import tokenize
+
+
+def generate(lines):
+    chunks = []
+    for i in range(lines):
+        chunks.append(
+            "x{0} = {0} * 2.5 - (y + 13) ^ 2; # line {0}\n".format(i))
+    return ''.join(chunks)
+
+
+def measure(text, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        count = sum(1 for _ in tokenize(text))
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return count, best
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark the lexer over increasing input sizes.')
+    parser.add_argument('--start', type=int, default=1000,
+                        help='number of lines in the smallest input')
+    parser.add_argument('--steps', type=int, default=5,
+                        help='number of times to double the input size')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='runs per size, the best one is reported')
+    args = parser.parse_args()
+
+    print('{:>10} {:>10} {:>10} {:>12}'.format(
+        'bytes', 'tokens', 'seconds', 'us/KB'))
+    lines = args.start
+    for _ in range(args.steps):
+        text = generate(lines)
+        count, elapsed = measure(text, args.repeat)
+        print('{:>10} {:>10} {:>10.4f} {:>12.1f}'.format(
+            len(text), count, elapsed, elapsed * 1e6 / (len(text) / 1024.0)))
+        lines *= 2
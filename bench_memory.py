@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Measure how much memory each stage of the compiler keeps per element, for
+a large generated program: bytes per token, per AST node, and per
+instruction, both as instruction objects and in the compact array form.
+"""
+from __future__ import print_function
+
+import argparse
+import tracemalloc
+
+import bcast
+import bcinstr
+from lexer import tokenize
+from lookahead import Lookahead
+from bcparser import parse
+from codegen import codegen
+
+
+def generate(count):
+    chunks = []
+    for i in range(count):
+        chunks.append("""
+fn f{0}(x, y) {{
+  a = x * {0} + y - 2.5;
+  if a > {0} {{ a = a - 1; }} else {{ a = a ^ 2; }}
+  return a / (y + 1) - x * a;
+}}
+""".format(i))
+    chunks.append('return f0(1, 2);\n')
+    return ''.join(chunks)
+
+
+def measure(build):
+    """
+    Call build(), and return its result along with the number of bytes
+    allocated by it that are still alive.
+    """
+    tracemalloc.start()
+    try:
+        result = build()
+        size, _ = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, size
+
+
+def count_nodes(nodes):
+    count = 0
+    todo = list(nodes)
+    while todo:
+        node = todo.pop()
+        if isinstance(node, list):
+            todo.extend(node)
+        elif isinstance(node, bcast.AST):
+            count += 1
+            for name in ('lhs', 'rhs', 'expr', 'body', 'args', 'cond',
+                         'if_block', 'else_block'):
+                child = getattr(node, name, None)
+                if child is not None:
+                    todo.append(child)
+            if isinstance(node, bcast.Return):
+                todo.append(node.value)
+    return count
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Report the memory used per token, node and instruction.')
+    parser.add_argument('--functions', type=int, default=5000,
+                        help='number of functions in the generated program')
+    args = parser.parse_args()
+    text = generate(args.functions)
+
+    tokens, token_bytes = measure(lambda: list(tokenize(text)))
+    # The tokens already exist, so this only counts the nodes themselves.
+    ast, ast_bytes = measure(lambda: parse(Lookahead(iter(tokens))))
+    del tokens
+    (fns, code), instr_bytes = measure(lambda: codegen(ast))
+    instrs = sum(len(fn.code) for fn in fns) + len(code)
+    ntokens = len(list(tokenize(text)))
+    nodes = count_nodes(ast)
+    compact, compact_bytes = measure(
+        lambda: [bcinstr.CompactCode.from_instrs(fn.code) for fn in fns])
+
+    rows = [
+        ('tokens', ntokens, token_bytes),
+        ('AST nodes', nodes, ast_bytes),
+        ('instructions', instrs, instr_bytes),
+        ('compact instructions', instrs, compact_bytes),
+    ]
+    print('{:<22} {:>10} {:>12} {:>10}'.format(
+        'form', 'count', 'bytes', 'per item'))
+    for name, count, size in rows:
+        print('{:<22} {:>10} {:>12} {:>10.1f}'.format(
+            name, count, size, size / float(count)))
@@ -0,0 +1,293 @@
+#!/usr/bin/env python3
+"""
+A benchmark suite over generated workloads, timing each stage of the
+compiler separately: tokenize, parse, codegen and interp.
+
+    bench_suite.py run -o results.json
+    bench_suite.py compare baseline.json results.json --threshold 0.1
+
+run writes the timings as JSON, and compare reports the change in every
+timing between two runs, exiting with status 1 if any got slower by more
+than the threshold.
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import platform
+import sys
+import time
+
+from lexer import tokenize
+from lookahead import Lookahead
+from bcparser import parse
+from codegen import codegen
+from interpreter import interp
+
+
+def expression_chain(size):
+    """
+    One long expression, mixing precedence levels.
+    """
+    terms = []
+    for i in range(size):
+        terms.append('{} * {}'.format(i + 1, i % 7 + 1) if i % 2 else
+                     '{} / {}'.format(i + 1, i % 5 + 1))
+    return 'return {};\n'.format(' + '.join(terms))
+
+
+def nested_ifs(size):
+    """
+    if/else statements nested size deep.
+    """
+    lines = ['fn nest(x) {']
+    for i in range(size):
+        lines.append('if x > {} {{'.format(i))
+    lines.append('return x;')
+    for i in range(size):
+        lines.append('}} else {{ x = x + {}; }}'.format(i))
+    lines.append('return x;')
+    lines.append('}')
+    lines.append('return nest({});'.format(size // 2))
+    return '\n'.join(lines) + '\n'
+
+
+def nested_parens(size):
+    """
+    An expression with parentheses nested size deep.
+    """
+    return 'return {}1{};\n'.format('(1 + ' * size, ')' * size)
+
+
+def many_functions(size):
+    """
+    size functions, each calling the one before it.
+    """
+    lines = ['fn f0(x) { return x + 1; }']
+    for i in range(1, size):
+        lines.append('fn f{0}(x) {{ y = x * 2 - {0}; return f{1}(y / 2); }}'
+                     .format(i, i - 1))
+    lines.append('return f{}(1);'.format(size - 1))
+    return '\n'.join(lines) + '\n'
+
+
+def tail_recursion(size):
+    """
+    fib2 from something.math, making size tail calls.
+    """
+    return """
+fn fib2(n, a, b) {{
+  if n <= 0 {{ return a; }}
+  return fib2(n - 1, b, a + b);
+}}
+return fib2({}, 0, 1);
+""".format(size)
+
+
+def deep_recursion(size):
+    """
+    A recursive sum, size calls deep.
+    """
+    return """
+fn sum(n) {{
+  if n <= 0 {{ return 0; }}
+  return n + sum(n - 1);
+}}
+return sum({});
+""".format(size)
+
+
+def guarded_recursion(size):
+    """
+    A recursive walk, size calls deep, whose guards put an expensive
+    recursive call on the side of && and || that the left side decides.
+    """
+    return """
+fn check(d) {{
+  if d <= 0 {{ return 1; }}
+  return check(d - 1);
+}}
+fn walk(n) {{
+  if n <= 0 || check(20) < 0 {{ return 0; }}
+  ok = n > 0 || check(20);
+  big = n < 0 && check(20);
+  return walk(n - 1) + ok + big;
+}}
+return walk({});
+""".format(size)
+
+
+WORKLOADS = [
+    ('expression_chain', expression_chain, [100, 300, 900]),
+    ('nested_ifs', nested_ifs, [40, 120, 360]),
+    ('nested_parens', nested_parens, [30, 90, 270]),
+    ('many_functions', many_functions, [500, 2000, 8000]),
+    ('tail_recursion', tail_recursion, [1000, 10000, 100000]),
+    ('deep_recursion', deep_recursion, [1000, 10000, 100000]),
+    ('guarded_recursion', guarded_recursion, [1000, 10000, 100000]),
+]
+STAGES = ['tokenize', 'parse', 'codegen', 'interp']
+
+
+class StageError(Exception):
+    """
+    Raised when a stage fails, with the name of the stage and the error.
+    """
+    def __init__(self, stage, error):
+        Exception.__init__(self, stage, error)
+        self.stage = stage
+        self.error = error
+
+
+def best_of(repeat, name, setup, stage):
+    """
+    Time stage(setup()) repeat times, and return the fastest time along
+    with the result of the last run. setup() isn't timed.
+    """
+    best = None
+    for _ in range(repeat):
+        value = setup()
+        start = time.perf_counter()
+        try:
+            result = stage(value)
+        except Exception as e:
+            raise StageError(name, e)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best, result
+
+
+def bench_workload(text, repeat):
+    """
+    Time every stage on the source text, each one given the output of the
+    stage before it. Returns a dict of stage name to seconds.
+    """
+    timings = {}
+    timings['tokenize'], tokens = best_of(
+        repeat, 'tokenize', lambda: text, lambda text: list(tokenize(text)))
+    timings['parse'], _ = best_of(
+        repeat, 'parse', lambda: Lookahead(iter(tokens)), parse)
+    # Codegen labels the AST in place, so every run needs a fresh one.
+    timings['codegen'], (fns, code) = best_of(
+        repeat, 'codegen', lambda: parse(Lookahead(iter(tokens))), codegen)
+    timings['interp'], _ = best_of(
+        repeat, 'interp', lambda: None, lambda _: interp(fns, code))
+    return timings
+
+
+def run(args):
+    results = []
+    for name, generate, sizes in WORKLOADS:
+        if args.workload and name not in args.workload:
+            continue
+        for size in sizes[:args.sizes]:
+            text = generate(size)
+            try:
+                timings = bench_workload(text, args.repeat)
+            except StageError as e:
+                # Workloads past what the compiler can handle are recorded,
+                # rather than ending the whole run.
+                print('{:<18} {:>7} {} failed: {!r}'.format(
+                    name, size, e.stage, e.error))
+                results.append({'workload': name, 'size': size,
+                                'failed': e.stage, 'error': repr(e.error)})
+                continue
+            print('{:<18} {:>7} '.format(name, size) + ' '.join(
+                '{}={:.4f}s'.format(stage, timings[stage])
+                for stage in STAGES))
+            for stage in STAGES:
+                results.append({'workload': name, 'size': size,
+                                'stage': stage, 'seconds': timings[stage]})
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+
+def compare(baseline, current, threshold):
+    """
+    Compare two reports. Returns a list of (workload, size, stage, old
+    seconds, new seconds, regressed) for the timings in both of them.
+    A timing that failed in current but not in baseline counts as an
+    infinitely slow regression.
+    """
+    def timings(report):
+        return {(r['workload'], r['size'], r['stage']): r['seconds']
+                for r in report['results'] if 'stage' in r}
+    old, new = timings(baseline), timings(current)
+    failed = set((r['workload'], r['size'])
+                 for r in current['results'] if 'failed' in r)
+    rows = []
+    for key in sorted(old):
+        workload, size, stage = key
+        if key in new:
+            new_seconds = new[key]
+        elif (workload, size) in failed:
+            new_seconds = float('inf')
+        else:
+            continue
+        old_seconds = old[key]
+        regressed = new_seconds > old_seconds * (1 + threshold)
+        rows.append((workload, size, stage, old_seconds, new_seconds,
+                     regressed))
+    return rows
+
+
+def compare_command(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.current) as f:
+        current = json.load(f)
+    rows = compare(baseline, current, args.threshold)
+    print('{:<18} {:>7} {:<9} {:>10} {:>10} {:>8}'.format(
+        'workload', 'size', 'stage', 'old s', 'new s', 'change'))
+    for workload, size, stage, old, new, regressed in rows:
+        print('{:<18} {:>7} {:<9} {:>10.4f} {:>10.4f} {:>+7.1f}%{}'.format(
+            workload, size, stage, old, new, (new / old - 1) * 100,
+            '  REGRESSION' if regressed else ''))
+    regressions = sum(1 for row in rows if row[-1])
+    print('{} of {} timings regressed by more than {:.0f}%'.format(
+        regressions, len(rows), args.threshold * 100))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Benchmark each stage of the compiler.')
+    commands = parser.add_subparsers(dest='command')
+
+    run_parser = commands.add_parser(
+        'run', help='run the benchmarks and write the results as JSON')
+    run_parser.add_argument('-o', '--output', default='bench.json',
+                            help='where to write the results')
+    run_parser.add_argument('-r', '--repeat', type=int, default=3,
+                            help='runs per timing, the best one is kept')
+    run_parser.add_argument('-s', '--sizes', type=int, default=3,
+                            help='how many of the sizes of each workload '
+                            'to run, from the smallest')
+    run_parser.add_argument('-w', '--workload', action='append',
+                            choices=[name for name, _, _ in WORKLOADS],
+                            help='only run this workload, can be repeated')
+
+    compare_parser = commands.add_parser(
+        'compare', help='compare two results files')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('-t', '--threshold', type=float, default=0.1,
+                                help='the fraction slower that counts as a '
+                                'regression, 0.1 by default')
+
+    args = parser.parse_args()
+    if args.command == 'run':
+        run(args)
+    elif args.command == 'compare':
+        sys.exit(compare_command(args))
+    else:
+        parser.print_help()
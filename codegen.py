@@ -1,19 +1,42 @@
 import bcast
+import bcinstr
+import optimizer
+import peephole
+import purity
 
 
-def codegen(ast):
-    code = []
+def codegen(ast, optimize=False, inliner=None):
     env = bcast.Env()
     functions = []
     for stmt in ast:
         if isinstance(stmt, bcast.Fn):
             env.declare_function(stmt)
+    names = {index: name for name, index in env.functions.items()}
 
+    ast = [stmt.label(env) for stmt in ast]
+    frame_size = env.next_local
+    if inliner is not None:
+        ast, frame_size = inliner.inline(ast, names, frame_size)
+    if optimize:
+        ast = optimizer.optimize(ast, frame_size)
+    pure = purity.pure_functions(
+        [stmt for stmt in ast if isinstance(stmt, bcast.Fn)])
+
+    out = bcinstr.Emitter()
     for stmt in ast:
-        stmt.label(env)
-        fn_code = stmt.codegen()
         if isinstance(stmt, bcast.Fn):
-            functions.append(fn_code)
+            fn_out = bcinstr.Emitter()
+            stmt.codegen(fn_out)
+            index = stmt.name.value
+            functions.append(bcinstr.Function(
+                names[index], len(stmt.args), fn_out.code, index in pure,
+                stmt.frame_size))
         else:
-            code.extend(fn_code)
+            stmt.codegen(out)
+    code = out.code
+
+    if optimize:
+        for fn in functions:
+            fn.code = peephole.optimize(fn.code, fn.arity)
+        code = peephole.optimize(code)
     return functions, code
@@ -0,0 +1,347 @@
+"""
+Incremental compilation, a function at a time.
+
+The source is split into the text of each top level function and the top
+level code around them, without lexing it. Every function is then a unit
+of its own, which is only lexed, parsed and compiled again when its text
+changes, or when a function it calls moves to a different index. Function
+indices are kept from one compile to the next, so adding or removing a
+function doesn't move the others around more than it has to.
+
+    compiler = Compiler()
+    fns, code = compiler.compile(text)
+    # ... edit one function ...
+    fns, code = compiler.compile(text)  # only that function is rebuilt
+"""
+import hashlib
+import os
+import re
+import time
+
+import bcast
+import bcinstr
+import bcparser
+import codegen
+import lexer
+import optimizer
+import peephole
+import purity
+
+
+# Comments, braces and whole words. Words are matched whole, like the lexer
+# does, so that only a `fn` keyword starts a function.
+SPLIT = re.compile(r'#[^\n]*|[{}]|[A-Za-z_][A-Za-z0-9_]*')
+# The separator the parser skips after a function. Comments have to run to
+# the end of the line, so that a ; in one isn't taken for the separator.
+SEPARATOR = re.compile(r'(?:\s|#[^\n]*(?![^\n]))*;')
+
+
+def split(text):
+    """
+    Split source text into the text of each top level function, and the
+    pieces of top level code between them.
+    """
+    fns = []
+    gaps = []
+    depth = 0
+    start = None
+    end = 0
+    for match in SPLIT.finditer(text):
+        word = match.group()
+        if word == '{':
+            depth += 1
+        elif word == '}':
+            depth -= 1
+            if depth == 0 and start is not None:
+                fns.append(text[start:match.end()])
+                start = None
+                end = match.end()
+                separator = SEPARATOR.match(text, end)
+                if separator:
+                    end = separator.end()
+        elif word == 'fn' and depth == 0 and start is None:
+            gaps.append(text[end:match.start()])
+            start = match.start()
+    if start is not None:
+        # An unfinished function, which the parser will complain about.
+        fns.append(text[start:])
+    else:
+        gaps.append(text[end:])
+    return fns, gaps
+
+
+def called_names(node, found):
+    """
+    Collect the names of the functions called from an unlabeled AST, or a
+    list of them, into found.
+    """
+    if isinstance(node, list):
+        for item in node:
+            called_names(item, found)
+    elif isinstance(node, bcast.Call):
+        found.add(node.name.value)
+        called_names(node.args, found)
+    elif isinstance(node, bcast.BinOp):
+        called_names(node.lhs, found)
+        called_names(node.rhs, found)
+    elif isinstance(node, bcast.Assignment):
+        called_names(node.expr, found)
+    elif isinstance(node, bcast.Return):
+        called_names(node.value, found)
+    elif isinstance(node, bcast.IfElse):
+        called_names(node.cond, found)
+        called_names(node.if_block, found)
+        called_names(node.else_block or [], found)
+    elif isinstance(node, bcast.Fn):
+        called_names(node.body, found)
+
+
+class Split(Exception):
+    """
+    Raised when the source doesn't split into functions the way the parser
+    would see it, so it has to be compiled as a whole.
+    """
+
+
+class Summary(object):
+    """
+    What has to be known about a unit before compiling it: the name and
+    arity of a function, or None and 0 for the top level code, and the
+    names of the functions it calls.
+    """
+    __slots__ = ('name', 'arity', 'callees')
+
+    def __init__(self, name, arity, callees):
+        self.name = name
+        self.arity = arity
+        self.callees = callees
+
+
+class Unit(object):
+    """
+    A compiled unit. fn is the compiled Function, or the top level code.
+    callees are the indices of the functions it calls, or None if the
+    purity analysis can't handle it.
+    """
+    __slots__ = ('fn', 'callees')
+
+    def __init__(self, fn, callees):
+        self.fn = fn
+        self.callees = callees
+
+
+def digest(*texts):
+    h = hashlib.sha256()
+    for text in texts:
+        h.update(text.encode('utf-8'))
+        h.update(b'\0')
+    return h.digest()
+
+
+class Compiler(object):
+    """
+    Compiles versions of the same program, reusing the units that didn't
+    change since the last one. After each compile, rebuilt holds the names
+    of the functions that were compiled again, with None for the top level
+    code, and reused the number of units that weren't.
+    """
+    def __init__(self, optimize=False):
+        self.optimize = optimize
+        # The function names, in the order of their indices.
+        self.order = []
+        # Summaries keyed by the digest of the unit's text.
+        self.summaries = {}
+        # Units keyed by the digest of their text and what they depend on.
+        self.units = {}
+        self.rebuilt = []
+        self.reused = 0
+
+    def parse(self, text, parsed):
+        """
+        Parse text, or take its statements from parsed if they're there.
+        """
+        statements = parsed.pop(text, None)
+        if statements is None:
+            statements = bcparser.parse(lexer.tokenize(text))
+        return statements
+
+    def summarize(self, texts, parsed, function):
+        """
+        Summarize a function from its text, or the top level code from the
+        texts of its pieces. Returns the digest of the texts along with the
+        summary. Statements parsed along the way are added to parsed.
+        """
+        key = digest(*texts)
+        summary = self.summaries.get(key)
+        if summary is not None:
+            return key, summary
+        statements = []
+        for text in texts:
+            parsed[text] = bcparser.parse(lexer.tokenize(text))
+            statements.extend(parsed[text])
+        fns = [stmt for stmt in statements if isinstance(stmt, bcast.Fn)]
+        if function and (len(statements) != 1 or len(fns) != 1):
+            raise Split("expected a single function")
+        if not function and fns:
+            raise Split("unexpected function")
+        callees = set()
+        called_names(statements, callees)
+        if function:
+            return key, Summary(fns[0].name.value, len(fns[0].args), callees)
+        return key, Summary(None, 0, callees)
+
+    def compile(self, text):
+        """
+        Compile the source text, like codegen.codegen(), returning the
+        compiled functions and the top level code.
+        """
+        try:
+            return self.compile_units(text)
+        except Split:
+            pass
+        # Compile the whole program the usual way, which also raises the
+        # right errors for programs that don't split.
+        fns, code = codegen.codegen(
+            bcparser.parse(lexer.tokenize(text)), self.optimize)
+        self.order = [fn.name for fn in fns]
+        self.summaries = {}
+        self.units = {}
+        self.rebuilt = self.order + [None]
+        self.reused = 0
+        return fns, code
+
+    def compile_units(self, text):
+        fn_texts, gaps = split(text)
+        # Statements parsed while summarizing, which can be compiled without
+        # parsing them again.
+        parsed = {}
+        try:
+            fn_summaries = [self.summarize([fn_text], parsed, True)
+                            for fn_text in fn_texts]
+            main_key, main_summary = self.summarize(gaps, parsed, False)
+        except Split:
+            raise
+        except Exception:
+            raise Split("a unit doesn't parse")
+
+        names = [summary.name for _, summary in fn_summaries]
+        seen = set()
+        for name in names:
+            if name in seen:
+                raise Exception('function ' + name + ' already defined')
+            seen.add(name)
+        self.order = ([name for name in self.order if name in seen] +
+                      [name for name in names if name not in self.order])
+        indices = {name: i for i, name in enumerate(self.order)}
+
+        summaries = {}
+        units = {}
+        rebuilt = []
+        reused = 0
+        fns = [None] * len(names)
+        callees = {}
+        for (key, summary), fn_text in zip(fn_summaries, fn_texts):
+            summaries[key] = summary
+            unit_key = (key, self.dependencies(summary, indices))
+            unit = self.units.get(unit_key)
+            if unit is None:
+                statements = self.parse(fn_text, parsed)
+                unit = self.compile_function(statements[0], indices)
+                rebuilt.append(summary.name)
+            else:
+                reused += 1
+            units[unit_key] = unit
+            index = indices[summary.name]
+            fns[index] = unit
+            if unit.callees is not None:
+                callees[index] = unit.callees
+
+        summaries[main_key] = main_summary
+        main_unit_key = (main_key, self.dependencies(main_summary, indices))
+        main = self.units.get(main_unit_key)
+        if main is None:
+            statements = []
+            for gap in gaps:
+                statements.extend(self.parse(gap, parsed))
+            main = self.compile_main(statements, indices)
+            rebuilt.append(None)
+        else:
+            reused += 1
+        units[main_unit_key] = main
+
+        # Purity depends on the functions called, however far away, so it's
+        # worked out again for the whole program.
+        pure = purity.pure_callers(callees)
+        for index, unit in enumerate(fns):
+            if unit.fn.pure != (index in pure):
+                fn = unit.fn
+                unit.fn = bcinstr.Function(fn.name, fn.arity, fn.code,
+                                           index in pure, fn.frame_size)
+
+        # Only keep what this version used.
+        self.summaries = summaries
+        self.units = units
+        self.rebuilt = rebuilt
+        self.reused = reused
+        return [unit.fn for unit in fns], main.fn
+
+    def dependencies(self, summary, indices):
+        """
+        The indices a unit's code depends on, which are those of the
+        functions it calls, or None for the ones that don't exist.
+        """
+        return tuple(sorted((name, indices.get(name))
+                            for name in summary.callees))
+
+    def compile_function(self, fn, indices):
+        env = bcast.Env()
+        env.functions = indices
+        name = fn.name.value
+        fn.name = bcast.NameLabel(indices[name])
+        fn = fn.label(env)
+        if self.optimize:
+            optimizer.optimize_function(fn)
+        found = set()
+        analyzable = purity.calls(fn.body, found)
+        out = bcinstr.Emitter()
+        fn.codegen(out)
+        code = out.code
+        if self.optimize:
+            code = peephole.optimize(code, len(fn.args))
+        return Unit(bcinstr.Function(name, len(fn.args), code, False,
+                                     fn.frame_size),
+                    found if analyzable else None)
+
+    def compile_main(self, statements, indices):
+        env = bcast.Env()
+        env.functions = indices
+        statements = [stmt.label(env) for stmt in statements]
+        if self.optimize:
+            statements, _ = optimizer.optimize_body(
+                statements, 0, env.next_local)
+        out = bcinstr.Emitter()
+        for stmt in statements:
+            stmt.codegen(out)
+        code = out.code
+        if self.optimize:
+            code = peephole.optimize(code)
+        return Unit(code, None)
+
+
+def changes(name, interval=0.5):
+    """
+    Generate the contents of the file name, first as it is, and then again
+    every time it changes. Polls every interval seconds.
+    """
+    last = None
+    while True:
+        try:
+            stat = os.stat(name)
+            current = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            current = None
+        if current is not None and current != last:
+            last = current
+            with open(name) as f:
+                yield f.read()
+        time.sleep(interval)
@@ -0,0 +1,405 @@
+"""
+Inlining of small functions into their callers, on labeled ASTs.
+
+A call is replaced by the body of the function it calls, with the
+arguments put in place of its locals, when the function is small enough,
+doesn't call itself however indirectly, and has a body of one of two
+shapes:
+
+    fn add(a, b) { return a + b; }   # inlined into any expression
+    fn maths(z) { a = ...; b = ...; return ...; }
+                                     # inlined where the call is the whole
+                                     # value of an assignment or a return
+
+Functions are inlined into their callers before their callers are inlined
+anywhere, so a chain like id -> id2 -> id3 collapses all the way. The
+arguments are still worked out once each, in order, before anything in
+the body that could raise, so programs give the same results and the same
+errors as before.
+
+    inliner = Inliner(budget=16)
+    ast, frame_size = inliner.inline(ast, names, frame_size)
+    print(inliner.report())
+"""
+import bcast
+import bcinstr
+import purity
+
+
+# The largest function, in instructions, that's inlined by default.
+DEFAULT_BUDGET = 16
+
+# Marks something in an expression that could raise, in events().
+EFFECT = object()
+
+
+def instruction_count(stmts):
+    """
+    How many instructions labeled statements compile to.
+    """
+    out = bcinstr.Emitter()
+    for stmt in stmts:
+        stmt.codegen(out)
+    return len(out.code)
+
+
+def is_trivial(expr):
+    """
+    Can expr be worked out any number of times, in any order, and always
+    give the same value without raising?
+    """
+    return isinstance(expr, (bcast.Num, bcast.NameLabel))
+
+
+def events(expr, out):
+    """
+    Append the locals read by expr to out, in the order they're read, with
+    EFFECT wherever something is done that could raise.
+    """
+    if isinstance(expr, bcast.NameLabel):
+        out.append(expr.value)
+    elif isinstance(expr, bcast.BinOp):
+        events(expr.lhs, out)
+        if expr.op.value in bcast.short_circuit:
+            # The right hand side might not be worked out at all, so an
+            # argument that's first used there can't be worked out there.
+            out.append(EFFECT)
+            events(expr.rhs, out)
+        else:
+            events(expr.rhs, out)
+            out.append(EFFECT)
+    elif isinstance(expr, bcast.Call):
+        for arg in expr.args:
+            events(arg, out)
+        out.append(EFFECT)
+    elif isinstance(expr, bcast.Tee):
+        events(expr.expr, out)
+    return out
+
+
+def pushed_again(expr, out):
+    """
+    Add the locals in expr that are the left hand side of && or ||, whose
+    values are pushed again when they're the result, to the set out.
+    """
+    if isinstance(expr, bcast.BinOp):
+        if (expr.op.value in bcast.short_circuit and
+                isinstance(expr.lhs, bcast.NameLabel)):
+            out.add(expr.lhs.value)
+        pushed_again(expr.lhs, out)
+        pushed_again(expr.rhs, out)
+    elif isinstance(expr, bcast.Call):
+        for arg in expr.args:
+            pushed_again(arg, out)
+    elif isinstance(expr, bcast.Tee):
+        pushed_again(expr.expr, out)
+    return out
+
+
+def copy(node, slots):
+    """
+    Copy a labeled statement or expression, replacing each of its locals
+    that's in slots by the expression for it there.
+    """
+    if isinstance(node, bcast.NameLabel):
+        if node.value in slots:
+            return copy(slots[node.value], {})
+        return bcast.NameLabel(node.value)
+    elif isinstance(node, bcast.Num):
+        return bcast.Num(node.value)
+    elif isinstance(node, bcast.Tee):
+        return bcast.Tee(copy(node.name, slots), copy(node.expr, slots))
+    elif isinstance(node, bcast.BinOp):
+        return bcast.BinOp(copy(node.lhs, slots), node.op,
+                           copy(node.rhs, slots))
+    elif isinstance(node, bcast.Call):
+        return bcast.Call(bcast.NameLabel(node.name.value),
+                          [copy(arg, slots) for arg in node.args])
+    elif isinstance(node, bcast.Assignment):
+        return bcast.Assignment(copy(node.name, slots),
+                                copy(node.expr, slots))
+    elif isinstance(node, bcast.Return):
+        return bcast.Return(copy(node.value, slots))
+    raise Exception("Can't inline {}".format(node.__class__.__name__))
+
+
+class Frame(object):
+    """
+    The function being inlined into: its name, for the report, and the
+    next free slot in its frame.
+    """
+    __slots__ = ('name', 'next_slot')
+
+    def __init__(self, name, next_slot):
+        self.name = name
+        self.next_slot = next_slot
+
+    def fresh(self):
+        self.next_slot += 1
+        return bcast.NameLabel(self.next_slot - 1)
+
+
+class Inliner(object):
+    """
+    Inlines calls to functions that compile to at most budget
+    instructions. After inline(), inlined holds the caller and callee
+    names of every call that was inlined, with None for the top level
+    code, and before and after the instruction counts of the whole
+    program.
+    """
+    def __init__(self, budget=DEFAULT_BUDGET):
+        self.budget = budget
+        self.inlined = []
+        self.before = None
+        self.after = None
+        # The functions and their names, keyed by index, and the indices of
+        # those that can be inlined.
+        self.fns = {}
+        self.names = {}
+        self.inlinable = set()
+
+    def inline(self, ast, names, frame_size):
+        """
+        Inline calls in a labeled program, where names maps function
+        indices to names, and the top level code uses frame_size locals.
+        Returns the new statements, and how many locals the top level code
+        uses now.
+        """
+        fns = [stmt for stmt in ast if isinstance(stmt, bcast.Fn)]
+        top = [stmt for stmt in ast if not isinstance(stmt, bcast.Fn)]
+        self.before = (sum(instruction_count(fn.body) for fn in fns) +
+                       instruction_count(top))
+
+        callees = {}
+        for fn in fns:
+            found = set()
+            if purity.calls(fn.body, found):
+                callees[fn.name.value] = found
+        self.fns = {fn.name.value: fn for fn in fns}
+        self.names = names
+        recursive = set(index for index in callees
+                        if index in reachable(callees, index))
+
+        # Callees come before their callers, so that what's inlined is
+        # already as inlined as it gets.
+        for index in postorder(callees):
+            fn = self.fns[index]
+            frame = Frame(names[index], fn.frame_size)
+            fn.body = self.block(fn.body, frame)
+            fn.frame_size = frame.next_slot
+            if (index not in recursive and self.shape(fn) is not None and
+                    instruction_count(fn.body) <= self.budget):
+                self.inlinable.add(index)
+
+        if purity.calls(top, set()):
+            frame = Frame(None, frame_size)
+            top = self.block(top, frame)
+            frame_size = frame.next_slot
+        self.after = (sum(instruction_count(fn.body) for fn in fns) +
+                      instruction_count(top))
+        return fns + top, frame_size
+
+    def shape(self, fn):
+        """
+        Return 'expr' if fn is a single return, 'block' if it's a list of
+        assignments ending in a return, or None if it can't be inlined.
+        """
+        body = fn.body
+        if not body or not isinstance(body[-1], bcast.Return):
+            return None
+        if len(body) == 1:
+            return 'expr'
+        if all(isinstance(stmt, bcast.Assignment) for stmt in body[:-1]):
+            return 'block'
+        return None
+
+    def block(self, stmts, frame):
+        result = []
+        for stmt in stmts:
+            if isinstance(stmt, bcast.Assignment):
+                stmt.expr = self.expr(stmt.expr, frame)
+                if self.is_inlinable(stmt.expr):
+                    result.extend(self.splice(stmt.expr, frame, stmt))
+                    continue
+            elif isinstance(stmt, bcast.Return):
+                stmt.value = self.expr(stmt.value, frame)
+                if self.is_inlinable(stmt.value):
+                    result.extend(self.splice(stmt.value, frame, stmt))
+                    continue
+            elif isinstance(stmt, bcast.IfElse):
+                stmt.cond = self.expr(stmt.cond, frame)
+                stmt.if_block = self.block(stmt.if_block, frame)
+                if stmt.else_block is not None:
+                    stmt.else_block = self.block(stmt.else_block, frame)
+            else:
+                stmt = self.expr(stmt, frame)
+            result.append(stmt)
+        return result
+
+    def is_inlinable(self, expr):
+        """
+        Is expr a call that's still there after expr(), but can be inlined
+        as a list of statements?
+        """
+        return (isinstance(expr, bcast.Call) and
+                expr.name.value in self.inlinable)
+
+    def expr(self, expr, frame):
+        if isinstance(expr, bcast.BinOp):
+            expr.lhs = self.expr(expr.lhs, frame)
+            expr.rhs = self.expr(expr.rhs, frame)
+        elif isinstance(expr, bcast.Call):
+            expr.args = [self.expr(arg, frame) for arg in expr.args]
+            index = expr.name.value
+            if (index in self.inlinable and
+                    self.shape(self.fns[index]) == 'expr'):
+                inlined = self.substitute(self.fns[index], expr.args, frame)
+                if inlined is not None:
+                    self.inlined.append((frame.name, self.names[index]))
+                    return inlined
+        return expr
+
+    def substitute(self, fn, args, frame):
+        """
+        Return the value of fn's single return, with args in place of its
+        arguments, or None if that would work the arguments out in a
+        different order, or after something that could raise.
+        """
+        value = fn.body[0].value
+        order = events(value, [])
+        uses = dict((slot, order.count(slot)) for slot in range(len(args)))
+        pending = [i for i, arg in enumerate(args)
+                   if not is_trivial(arg) and uses[i]]
+        if any(not is_trivial(arg) and not uses[i]
+               for i, arg in enumerate(args)):
+            # An argument that's never used still has to be worked out.
+            return None
+        for event in order:
+            if not pending:
+                break
+            if event is EFFECT or event != pending[0] and event in pending:
+                return None
+            if event == pending[0]:
+                pending.pop(0)
+
+        # The first use of an argument used more than once keeps its
+        # value in a new local, for the uses after it. So does one that's
+        # the left hand side of && or ||, which might be pushed again.
+        again = pushed_again(value, set())
+        slots = {}
+        tees = {}
+        for i, arg in enumerate(args):
+            if is_trivial(arg) or uses[i] == 1 and i not in again:
+                slots[i] = arg
+            else:
+                slots[i] = frame.fresh()
+                tees[i] = arg
+        # Locals that keep values from what was inlined into fn.
+        for slot in range(len(args), fn.frame_size):
+            slots[slot] = frame.fresh()
+        return self.copy_first(value, slots, tees)
+
+    def copy_first(self, expr, slots, tees):
+        """
+        Like copy(), but the first use of a local in tees is a Tee of its
+        argument.
+        """
+        if isinstance(expr, bcast.NameLabel) and expr.value in tees:
+            return bcast.Tee(copy(slots[expr.value], {}),
+                             tees.pop(expr.value))
+        elif isinstance(expr, bcast.Tee):
+            return bcast.Tee(copy(expr.name, slots),
+                             self.copy_first(expr.expr, slots, tees))
+        elif isinstance(expr, bcast.BinOp):
+            lhs = self.copy_first(expr.lhs, slots, tees)
+            return bcast.BinOp(lhs, expr.op,
+                               self.copy_first(expr.rhs, slots, tees))
+        elif isinstance(expr, bcast.Call):
+            return bcast.Call(bcast.NameLabel(expr.name.value),
+                              [self.copy_first(arg, slots, tees)
+                               for arg in expr.args])
+        return copy(expr, slots)
+
+    def splice(self, call, frame, stmt):
+        """
+        Return the statements that inline call, which is the value of the
+        assignment or return stmt, in its place.
+        """
+        fn = self.fns[call.name.value]
+        assigned = set(line.name.value for line in fn.body[:-1])
+        result = []
+        slots = {}
+        for i, arg in enumerate(call.args):
+            if is_trivial(arg) and i not in assigned:
+                slots[i] = arg
+            else:
+                # Arguments are stored in order, before any of the body,
+                # just like the call would have done.
+                slots[i] = frame.fresh()
+                result.append(bcast.Assignment(slots[i], arg))
+        for slot in range(len(call.args), fn.frame_size):
+            slots[slot] = frame.fresh()
+
+        body = [copy(line, slots) for line in fn.body]
+        result.extend(body[:-1])
+        if isinstance(stmt, bcast.Assignment):
+            stmt.expr = body[-1].value
+            result.append(stmt)
+        else:
+            result.append(body[-1])
+        self.inlined.append((frame.name, self.names[call.name.value]))
+        return result
+
+    def report(self):
+        """
+        Describe what was inlined, and how the instruction count changed.
+        """
+        counts = {}
+        for caller, callee in self.inlined:
+            key = (caller or '<main>', callee)
+            counts[key] = counts.get(key, 0) + 1
+        lines = ['inlined {} calls, {} -> {} instructions'.format(
+            len(self.inlined), self.before, self.after)]
+        for (caller, callee), count in sorted(counts.items()):
+            lines.append('  {} into {}: {}'.format(callee, caller, count))
+        return '\n'.join(lines)
+
+
+def reachable(callees, index):
+    """
+    The set of functions that can be reached by calls from index, not
+    counting index itself unless it's on a cycle.
+    """
+    seen = set()
+    stack = list(callees.get(index, ()))
+    while stack:
+        callee = stack.pop()
+        if callee not in seen:
+            seen.add(callee)
+            stack.extend(callees.get(callee, ()))
+    return seen
+
+
+def postorder(callees):
+    """
+    The functions in callees, each after all the ones it calls, except
+    where calls go round in a cycle.
+    """
+    order = []
+    seen = set()
+    for root in sorted(callees):
+        if root in seen:
+            continue
+        seen.add(root)
+        stack = [(root, iter(sorted(callees[root])))]
+        while stack:
+            index, children = stack[-1]
+            for child in children:
+                if child in callees and child not in seen:
+                    seen.add(child)
+                    stack.append((child, iter(sorted(callees[child]))))
+                    break
+            else:
+                stack.pop()
+                order.append(index)
+    return order
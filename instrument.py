@@ -0,0 +1,115 @@
+"""
+Collectors built on the interpreter's hooks, and the report main.py prints
+for --profile.
+
+    counts, calls, depth = OpcodeCounts(), CallProfile(), StackDepth()
+    interp(fns, code, hooks=[counts, calls, depth])
+    print(report(fns, counts, calls, depth))
+"""
+import time
+from collections import Counter
+
+from interpreter import Hooks, opcode_names
+
+
+class OpcodeCounts(Hooks):
+    """
+    Counts how many times each opcode of the decoded form runs.
+    """
+    def __init__(self):
+        self.counts = Counter()
+
+    def instruction(self, ip, op, arg, data_stack, local_stack, call_stack):
+        self.counts[op] += 1
+
+    def most_common(self, n=None):
+        """
+        List (opcode name, count) pairs, most frequent first.
+        """
+        return [(opcode_names[op], count)
+                for op, count in self.counts.most_common(n)]
+
+
+class CallProfile(Hooks):
+    """
+    Counts the calls to every function, and the time spent in them. The
+    inclusive time of a function includes the functions it calls, and the
+    exclusive time doesn't. The time of a recursive call is only counted
+    once in the inclusive time, by the outermost call.
+    """
+    def __init__(self, clock=time.perf_counter):
+        self.clock = clock
+        self.calls = Counter()
+        self.inclusive = Counter()
+        self.exclusive = Counter()
+        # [index, start time, time in calls made from it] for each frame.
+        self.frames = []
+        self.active = Counter()
+
+    def enter(self, index):
+        self.calls[index] += 1
+        self.active[index] += 1
+        self.frames.append([index, self.clock(), 0.0])
+
+    def exit(self, index, value):
+        index, start, children = self.frames.pop()
+        elapsed = self.clock() - start
+        self.active[index] -= 1
+        if not self.active[index]:
+            self.inclusive[index] += elapsed
+        self.exclusive[index] += elapsed - children
+        if self.frames:
+            self.frames[-1][2] += elapsed
+
+    def functions(self):
+        """
+        List (index, calls, inclusive, exclusive) for every function that
+        was called, the most exclusive time first.
+        """
+        return sorted(
+            ((index, self.calls[index], self.inclusive[index],
+              self.exclusive[index]) for index in self.calls),
+            key=lambda row: row[3], reverse=True)
+
+
+class StackDepth(Hooks):
+    """
+    Records the deepest the data stack and the call stack got.
+    """
+    def __init__(self):
+        self.data = 0
+        self.calls = 0
+
+    def instruction(self, ip, op, arg, data_stack, local_stack, call_stack):
+        if len(data_stack) > self.data:
+            self.data = len(data_stack)
+        if len(call_stack) > self.calls:
+            self.calls = len(call_stack)
+
+
+def function_name(fns, index):
+    return '<main>' if index is None else fns[index].name
+
+
+def report(fns, counts, calls, depth, limit=10):
+    """
+    Format what the collectors gathered, with the limit hottest functions
+    and opcodes.
+    """
+    lines = ['{:<20} {:>10} {:>12} {:>12}'.format(
+        'function', 'calls', 'inclusive s', 'exclusive s')]
+    for index, n, inclusive, exclusive in calls.functions()[:limit]:
+        lines.append('{:<20} {:>10} {:>12.6f} {:>12.6f}'.format(
+            function_name(fns, index), n, inclusive, exclusive))
+
+    total = sum(counts.counts.values())
+    lines.append('')
+    lines.append('{:<20} {:>10} {:>7}'.format('opcode', 'count', '%'))
+    for name, n in counts.most_common(limit):
+        lines.append('{:<20} {:>10} {:>6.1f}%'.format(
+            name, n, 100.0 * n / total))
+
+    lines.append('')
+    lines.append('{} instructions, max data stack {}, max call depth {}'
+                 .format(total, depth.data, depth.calls))
+    return '\n'.join(lines)
@@ -1,7 +1,9 @@
+from collections import OrderedDict, deque
+import math
+
 import bcinstr
 
 
-DEBUG = False
 ops = {
     '+': lambda a, b: a + b,
     '-': lambda a, b: a - b,
@@ -19,62 +21,656 @@ ops = {
 }
 
 
-def interp(fns, bytecode):
-    code = bytecode
+# Opcodes of the decoded form that interp() actually runs. These are
+# separate from the bytecode opcodes, because every arithmetic operator gets
+# an opcode of its own so that the dispatch loop never looks at operators.
+(PUSH_NUM, LOAD_LOCAL, STORE_LOCAL, RETURN, CALL, TAIL_CALL, BRANCH,
+ COND_BRANCH, ADD, SUB, MUL, DIV, LT, GT, LTE, GTE, EQ, NE,
+ BINARY, TEE_LOCAL, LOCAL_NUM_ADD, LOCAL_NUM_SUB, LOCAL_NUM_MUL,
+ LOCAL_NUM_LT, LOCAL_NUM_LTE, LOCAL_NUM_OP, LOCAL_LOCAL_ADD, LOCAL_LOCAL_SUB,
+ LOCAL_LOCAL_MUL, LOCAL_LOCAL_OP, CALL_MEMO, TAIL_CALL_MEMO) = range(32)
+opcode_names = (
+    'PUSH_NUM', 'LOAD_LOCAL', 'STORE_LOCAL', 'RETURN', 'CALL', 'TAIL_CALL',
+    'BRANCH', 'COND_BRANCH', 'ADD', 'SUB', 'MUL', 'DIV', 'LT', 'GT', 'LTE',
+    'GTE', 'EQ', 'NE', 'BINARY', 'TEE_LOCAL', 'LOCAL_NUM_ADD',
+    'LOCAL_NUM_SUB', 'LOCAL_NUM_MUL', 'LOCAL_NUM_LT', 'LOCAL_NUM_LTE',
+    'LOCAL_NUM_OP', 'LOCAL_LOCAL_ADD', 'LOCAL_LOCAL_SUB', 'LOCAL_LOCAL_MUL',
+    'LOCAL_LOCAL_OP', 'CALL_MEMO', 'TAIL_CALL_MEMO')
+
+# The operators which are inlined into the dispatch loop. The rest go through
+# the BINARY opcode, which calls the function from ops stored as its operand.
+inline_ops = {
+    '+': ADD,
+    '-': SUB,
+    '*': MUL,
+    '/': DIV,
+    '<': LT,
+    '>': GT,
+    '<=': LTE,
+    '>=': GTE,
+    '==': EQ,
+    '!=': NE,
+}
+
+
+# Like inline_ops, for the operators of the fused superinstructions. The
+# rest go through the generic opcodes, which call the function from ops.
+local_num_ops = {
+    '+': LOCAL_NUM_ADD,
+    '-': LOCAL_NUM_SUB,
+    '*': LOCAL_NUM_MUL,
+    '<': LOCAL_NUM_LT,
+    '<=': LOCAL_NUM_LTE,
+}
+local_local_ops = {
+    '+': LOCAL_LOCAL_ADD, '-': LOCAL_LOCAL_SUB, '*': LOCAL_LOCAL_MUL}
+
+
+def decode_math(record, i, consts):
+    op = bcinstr.MathOp.op_names[record[1]]
+    if op in inline_ops:
+        return inline_ops[op], None
+    return BINARY, ops[op]
+
+
+def decode_local_num(record, i, consts):
+    op = bcinstr.MathOp.op_names[record[3]]
+    if op in local_num_ops:
+        return local_num_ops[op], (record[1], consts[record[2]])
+    return LOCAL_NUM_OP, (record[1], consts[record[2]], ops[op])
+
+
+def decode_local_local(record, i, consts):
+    op = bcinstr.MathOp.op_names[record[3]]
+    if op in local_local_ops:
+        return local_local_ops[op], (record[1], record[2])
+    return LOCAL_LOCAL_OP, (record[1], record[2], ops[op])
+
+
+# Decoders for each bytecode opcode. Each takes an instruction record, its
+# index and the constant pool, and returns the decoded opcode and operand.
+# Branch offsets are turned into absolute targets, so that the loop doesn't
+# need to do any arithmetic on the instruction pointer.
+decoders = {
+    bcinstr.PushNum.opcode: lambda r, i, consts: (PUSH_NUM, consts[r[1]]),
+    bcinstr.LoadLocal.opcode: lambda r, i, consts: (LOAD_LOCAL, r[1]),
+    bcinstr.StoreLocal.opcode: lambda r, i, consts: (STORE_LOCAL, r[1]),
+    bcinstr.MathOp.opcode: decode_math,
+    bcinstr.Return.opcode: lambda r, i, consts: (RETURN, None),
+    bcinstr.Call.opcode: lambda r, i, consts: (CALL, r[1]),
+    bcinstr.TailCall.opcode: lambda r, i, consts: (TAIL_CALL, r[1]),
+    bcinstr.Branch.opcode: lambda r, i, consts: (BRANCH, i + 1 + r[1]),
+    bcinstr.CondBranch.opcode: lambda r, i, consts: (
+        COND_BRANCH, (i + 1 + r[1], i + 1 + r[2])),
+    bcinstr.TeeLocal.opcode: lambda r, i, consts: (TEE_LOCAL, r[1]),
+    bcinstr.LocalNumOp.opcode: decode_local_num,
+    bcinstr.LocalLocalOp.opcode: decode_local_local,
+}
+
+
+def decode_records(records, consts):
+    """
+    Turn a sequence of instruction records, as produced by to_record() or
+    read back from a compiled module, into flat opcode and operand lists.
+    """
+    opcodes = []
+    operands = []
+    for i, record in enumerate(records):
+        if record[0] not in decoders:
+            raise Exception("Unsupported opcode {}".format(record[0]))
+        opcode, operand = decoders[record[0]](record, i, consts)
+        opcodes.append(opcode)
+        operands.append(operand)
+    return opcodes, operands
+
+
+def decode(code):
+    """
+    Turn a list of instructions, or their CompactCode, into a pair of flat
+    opcode and operand lists.
+    """
+    if isinstance(code, bcinstr.CompactCode):
+        return decode_records(code, code.consts)
+    consts = bcinstr.ConstantPool()
+    records = [instr.to_record(consts) for instr in code]
+    return decode_records(records, consts.values)
+
+
+def decode_functions(fns):
+    """
+    Decode a list of compiled functions, reusing any that are already
+    decoded.
+    """
+    for fn in fns:
+        if fn.decoded is None:
+            fn.decoded = decode(
+                fn.code if fn.code is not None else fn.compact)
+    return [fn.decoded for fn in fns]
+
+
+class Unassigned(object):
+    """
+    The value of a local before anything is stored in it. Frames start out
+    full of it, so using it in any way raises an error, like reading past
+    the end of a frame used to.
+    """
+    __slots__ = ()
+
+    def __repr__(self):
+        return 'UNASSIGNED'
+
+    def error(self, *args):
+        raise Exception("Local read before it was assigned")
+
+    __bool__ = __nonzero__ = __float__ = __hash__ = error
+    __eq__ = __ne__ = __lt__ = __le__ = __gt__ = __ge__ = error
+    __add__ = __radd__ = __sub__ = __rsub__ = error
+    __mul__ = __rmul__ = __truediv__ = __rtruediv__ = error
+    __div__ = __rdiv__ = __pow__ = __rpow__ = error
+
+
+UNASSIGNED = Unassigned()
+
+
+def checked(value):
+    """
+    Raise if a result is an unassigned local, which could otherwise be
+    returned all the way up without ever being used.
+    """
+    if value is UNASSIGNED:
+        value.error()
+    return value
+
+
+local_opcodes = (LOAD_LOCAL, STORE_LOCAL, TEE_LOCAL)
+local_num_opcodes = set(local_num_ops.values()) | {LOCAL_NUM_OP}
+local_local_opcodes = set(local_local_ops.values()) | {LOCAL_LOCAL_OP}
+
+
+def frame_size(code):
+    """
+    Count the local slots used by decoded code.
+    """
+    size = 0
+    for op, arg in zip(*code):
+        if op in local_opcodes:
+            size = max(size, arg + 1)
+        elif op in local_num_opcodes:
+            size = max(size, arg[0] + 1)
+        elif op in local_local_opcodes:
+            size = max(size, arg[0] + 1, arg[1] + 1)
+    return size
+
+
+def has_prologue(code, arity):
+    """
+    Does decoded code start by storing its arity arguments in their slots,
+    the way codegen() emits it?
+    """
+    opcodes, operands = code
+    return (opcodes[:arity] == [STORE_LOCAL] * arity and
+            operands[:arity] == list(range(arity - 1, -1, -1)))
+
+
+def layout(fns, decoded):
+    """
+    Prepare decoded functions for execute(). Each one becomes a tuple of
+    its opcodes, its operands, the number of arguments the caller moves
+    straight into the frame, and the blank values of the rest of the frame.
+    When the arguments are moved in, the code runs from just past the
+    prologue that would have stored them.
+    """
+    frames = []
+    for fn, (opcodes, operands) in zip(fns, decoded):
+        size = fn.frame_size
+        if size is None:
+            size = max(frame_size((opcodes, operands)), fn.arity)
+        nargs = fn.arity if has_prologue((opcodes, operands), fn.arity) else 0
+        frames.append(
+            (opcodes, operands, nargs, [UNASSIGNED] * (size - nargs)))
+    return frames
+
+
+# Marks a cache miss, since any value could be the result of a call.
+MISSING = object()
+
+
+def memo_key(args):
+    """
+    The key of a call's arguments in a memo cache. Zeros are keyed with
+    their sign, since 0.0 == -0.0, but a function can give different
+    results for them.
+    """
+    return tuple((arg, math.copysign(1.0, arg))
+                 if arg.__class__ is float and arg == 0.0 else arg
+                 for arg in args)
+
+
+class LRUCache(object):
+    """
+    The results of one function, keyed on tuples of arguments, evicting the
+    least recently used results beyond maxsize.
+    """
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.results = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        value = self.results.get(key, MISSING)
+        if value is MISSING:
+            self.misses += 1
+        else:
+            self.hits += 1
+            self.results.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.results[key] = value
+        if len(self.results) > self.maxsize:
+            self.results.popitem(last=False)
+
+
+class Memo(object):
+    """
+    Memoizes calls to pure functions, with a separate cache of up to
+    maxsize results for each function. A Memo can be reused across runs of
+    the same program to keep the results from earlier runs.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self.caches = {}
+
+    def cache(self, index):
+        if index not in self.caches:
+            self.caches[index] = LRUCache(self.maxsize)
+        return self.caches[index]
+
+    def stats(self, fns):
+        """
+        List (name, hits, misses) for every memoized function that was
+        called.
+        """
+        return [(fns[index].name, cache.hits, cache.misses)
+                for index, cache in sorted(self.caches.items())
+                if cache.hits or cache.misses]
+
+    def rewrite(self, fns, code):
+        """
+        Return a copy of decoded code where every call to a pure function
+        in fns goes through its cache.
+        """
+        opcodes, operands = list(code[0]), list(code[1])
+        for i, op in enumerate(opcodes):
+            if op in (CALL, TAIL_CALL) and fns[operands[i]].pure:
+                index = operands[i]
+                opcodes[i] = CALL_MEMO if op == CALL else TAIL_CALL_MEMO
+                operands[i] = (index, fns[index].arity, self.cache(index))
+        return opcodes, operands
+
+
+def interp(fns, bytecode, memo=None, hooks=None):
+    return run(fns, decode(bytecode), memo, hooks)
+
+
+def run(fns, code, memo=None, hooks=None):
+    """
+    Run decoded top level code, calling into the compiled functions fns.
+    If hooks are given, they're called as the program runs, see Hooks.
+    """
+    frames = prepare(fns, memo)
+    if memo is not None:
+        code = memo.rewrite(fns, code)
+    if hooks:
+        return execute_hooked(frames, code, hooks)
+    return execute(frames, code)
+
+
+def call(fns, index, args, memo=None, hooks=None):
+    """
+    Call the compiled function fns[index] with a sequence of arguments.
+    """
+    return run(fns, stub(index, args), memo, hooks)
+
+
+def prepare(fns, memo=None):
+    """
+    Decode and lay out fns for execute(), once for any number of calls.
+    """
+    decoded = decode_functions(fns)
+    if memo is not None:
+        decoded = [memo.rewrite(fns, fn) for fn in decoded]
+    return layout(fns, decoded)
+
+
+def invoke(fns, frames, index, args, memo=None):
+    """
+    Like call(), with fns already laid out as frames by prepare().
+    """
+    code = stub(index, args)
+    if memo is not None:
+        code = memo.rewrite(fns, code)
+    return execute(frames, code)
+
+
+def stub(index, args):
+    """
+    Decoded code that calls function index with args, and returns.
+    """
+    return ([PUSH_NUM] * len(args) + [CALL, RETURN],
+            [float(arg) for arg in args] + [index, None])
+
+
+def execute(fns, code):
+    """
+    Run decoded code, calling into the functions fns, as laid out by
+    layout(). The branches are ordered roughly by how often each opcode
+    runs.
+    """
+    opcodes, operands = code
+    ip = 0
+    data_stack = []
+    push = data_stack.append
+    pop = data_stack.pop
+    local_stack = [UNASSIGNED] * frame_size(code)
+    call_stack = []
+    # The (cache, key) pairs waiting for the result of the current frame.
+    # Tail calls add to it, since they share their caller's result. Only the
+    # most recent ones are kept, since a cache would evict the rest anyway,
+    # and memoized tail calls have to run in constant space too.
+    pending = None
+    while True:
+        op = opcodes[ip]
+        arg = operands[ip]
+        ip += 1
+        if op == LOAD_LOCAL:
+            push(local_stack[arg])
+        elif op == PUSH_NUM:
+            push(arg)
+        elif op == LOCAL_NUM_SUB:
+            push(local_stack[arg[0]] - arg[1])
+        elif op == LOCAL_LOCAL_ADD:
+            push(local_stack[arg[0]] + local_stack[arg[1]])
+        elif op == LOCAL_NUM_LTE:
+            push(1.0 if local_stack[arg[0]] <= arg[1] else 0.0)
+        elif op == ADD:
+            rhs = pop()
+            data_stack[-1] = data_stack[-1] + rhs
+        elif op == SUB:
+            rhs = pop()
+            data_stack[-1] = data_stack[-1] - rhs
+        elif op == COND_BRANCH:
+            if pop():
+                ip = arg[0]
+            else:
+                ip = arg[1]
+        elif op == STORE_LOCAL:
+            local_stack[arg] = pop()
+        elif op == CALL:
+            call_stack.append((opcodes, operands, ip, local_stack, pending))
+            # The arguments become the start of the new frame, and the rest
+            # is filled in at its full size, so stores never have to grow
+            # it. The code starts just past its prologue.
+            opcodes, operands, nargs, blank = fns[arg]
+            if nargs:
+                local_stack = data_stack[-nargs:]
+                del data_stack[-nargs:]
+                if blank:
+                    local_stack.extend(blank)
+            else:
+                local_stack = blank[:]
+            ip = nargs
+            pending = None
+        elif op == TAIL_CALL:
+            opcodes, operands, nargs, blank = fns[arg]
+            if nargs:
+                local_stack = data_stack[-nargs:]
+                del data_stack[-nargs:]
+                if blank:
+                    local_stack.extend(blank)
+            else:
+                local_stack = blank[:]
+            ip = nargs
+        elif op == RETURN:
+            if data_stack[-1] is UNASSIGNED:
+                # Returning an unassigned local is reading it, even if the
+                # caller never uses the result.
+                UNASSIGNED.error()
+            if pending is not None:
+                for cache, key in pending:
+                    cache.put(key, data_stack[-1])
+            if not call_stack:
+                return pop()
+            opcodes, operands, ip, local_stack, pending = call_stack.pop()
+        elif op == MUL:
+            rhs = pop()
+            data_stack[-1] = data_stack[-1] * rhs
+        elif op == DIV:
+            rhs = pop()
+            data_stack[-1] = data_stack[-1] / rhs
+        elif op == LTE:
+            rhs = pop()
+            data_stack[-1] = 1.0 if data_stack[-1] <= rhs else 0.0
+        elif op == LT:
+            rhs = pop()
+            data_stack[-1] = 1.0 if data_stack[-1] < rhs else 0.0
+        elif op == GTE:
+            rhs = pop()
+            data_stack[-1] = 1.0 if data_stack[-1] >= rhs else 0.0
+        elif op == GT:
+            rhs = pop()
+            data_stack[-1] = 1.0 if data_stack[-1] > rhs else 0.0
+        elif op == EQ:
+            rhs = pop()
+            data_stack[-1] = 1.0 if data_stack[-1] == rhs else 0.0
+        elif op == NE:
+            rhs = pop()
+            data_stack[-1] = 1.0 if data_stack[-1] != rhs else 0.0
+        elif op == BRANCH:
+            ip = arg
+        elif op == TEE_LOCAL:
+            local_stack[arg] = data_stack[-1]
+        elif op == LOCAL_NUM_ADD:
+            push(local_stack[arg[0]] + arg[1])
+        elif op == LOCAL_NUM_MUL:
+            push(local_stack[arg[0]] * arg[1])
+        elif op == LOCAL_LOCAL_SUB:
+            push(local_stack[arg[0]] - local_stack[arg[1]])
+        elif op == LOCAL_LOCAL_MUL:
+            push(local_stack[arg[0]] * local_stack[arg[1]])
+        elif op == LOCAL_NUM_LT:
+            push(1.0 if local_stack[arg[0]] < arg[1] else 0.0)
+        elif op == LOCAL_NUM_OP:
+            push(arg[2](local_stack[arg[0]], arg[1]))
+        elif op == LOCAL_LOCAL_OP:
+            push(arg[2](local_stack[arg[0]], local_stack[arg[1]]))
+        elif op == CALL_MEMO or op == TAIL_CALL_MEMO:
+            index, arity, cache = arg
+            key = memo_key(data_stack[len(data_stack) - arity:])
+            value = cache.get(key)
+            if value is MISSING:
+                if op == CALL_MEMO:
+                    call_stack.append(
+                        (opcodes, operands, ip, local_stack, pending))
+                    pending = None
+                if pending is None:
+                    pending = deque(maxlen=cache.maxsize)
+                pending.append((cache, key))
+                opcodes, operands, nargs, blank = fns[index]
+                if nargs:
+                    local_stack = data_stack[-nargs:]
+                    del data_stack[-nargs:]
+                    if blank:
+                        local_stack.extend(blank)
+                else:
+                    local_stack = blank[:]
+                ip = nargs
+                continue
+            del data_stack[len(data_stack) - arity:]
+            push(value)
+            if op == TAIL_CALL_MEMO:
+                # The cached result is this frame's result, so return it.
+                if pending is not None:
+                    for cache, key in pending:
+                        cache.put(key, value)
+                if not call_stack:
+                    return pop()
+                opcodes, operands, ip, local_stack, pending = (
+                    call_stack.pop())
+        else:
+            # BINARY, the decoder guarantees there are no other opcodes.
+            rhs = pop()
+            data_stack[-1] = arg(data_stack[-1], rhs)
+
+
+class Hooks(object):
+    """
+    The points where execute_hooked() calls into instrumentation. Hooks
+    override the methods they're interested in, and the rest do nothing.
+    Functions are identified by their index in fns, and the top level code
+    by None.
+    """
+    # Called before every instruction, with the machine state before it.
+    # call_stack has an entry for every frame below the current one.
+    def instruction(self, ip, op, arg, data_stack, local_stack, call_stack):
+        pass
+
+    # Called on entry to a function, including by a tail call, and to the
+    # top level code when it starts.
+    def enter(self, index):
+        pass
+
+    # Called when a function's frame is done with. value is the result it
+    # returned, or None if a tail call took over its frame.
+    def exit(self, index, value):
+        pass
+
+
+# The operations behind each of the plain arithmetic opcodes, for the
+# hooked loop. It doesn't need the inlined versions execute() has.
+binary_ops = {opcode: ops[op] for op, opcode in inline_ops.items()}
+local_num_fns = {opcode: ops[op] for op, opcode in local_num_ops.items()}
+local_local_fns = {opcode: ops[op] for op, opcode in local_local_ops.items()}
+
+
+def execute_hooked(fns, code, hooks):
+    """
+    Like execute(), calling into each of hooks as it runs. This is a
+    separate loop so that execute() pays nothing for instrumentation, and
+    it's written for clarity rather than speed.
+    """
+    on_instruction = [hook.instruction for hook in hooks]
+    on_enter = [hook.enter for hook in hooks]
+    on_exit = [hook.exit for hook in hooks]
+
+    opcodes, operands = code
     ip = 0
+    index = None
     data_stack = []
-    local_stack = []
-    local_save = []
+    local_stack = [UNASSIGNED] * frame_size(code)
     call_stack = []
+    pending = None
+    for hook in on_enter:
+        hook(index)
     while True:
-        instr = code[ip]
-        if DEBUG:
-            print('@@@')
-            print('code', code)
-            print('ip', ip)
-            print('instr', instr)
-            print('data', data_stack)
-            print('local',  local_stack)
-            print('stack', '[{}]'.format(
-                ', '.join(str((Ellipsis, p)) for _, p in call_stack)))
-            print('scopes', local_save)
-            print()
-
-        if instr.isa(bcinstr.PushNum):
-            data_stack.append(instr.value)
-        elif instr.isa(bcinstr.LoadLocal):
-            addr = instr.value
-            value = local_stack[addr]
-            data_stack.append(value)
-        elif instr.isa(bcinstr.StoreLocal):
-            addr = instr.value
-            value = data_stack.pop()
-            if addr >= len(local_stack):
-                extra_needed = addr - len(local_stack) + 1
-                local_stack.extend([None]*extra_needed)
-            local_stack[addr] = value
-        elif instr.isa(bcinstr.MathOp):
+        op = opcodes[ip]
+        arg = operands[ip]
+        for hook in on_instruction:
+            hook(ip, op, arg, data_stack, local_stack, call_stack)
+        ip += 1
+
+        if op == CALL_MEMO or op == TAIL_CALL_MEMO:
+            callee, arity, cache = arg
+            key = memo_key(data_stack[len(data_stack) - arity:])
+            value = cache.get(key)
+            if value is not MISSING:
+                del data_stack[len(data_stack) - arity:]
+                data_stack.append(value)
+                if op == CALL_MEMO:
+                    continue
+                # The cached result is this frame's result, so return it.
+                op = RETURN
+
+        if op == PUSH_NUM:
+            data_stack.append(arg)
+        elif op == LOAD_LOCAL:
+            data_stack.append(local_stack[arg])
+        elif op == STORE_LOCAL:
+            local_stack[arg] = data_stack.pop()
+        elif op == TEE_LOCAL:
+            local_stack[arg] = data_stack[-1]
+        elif op == BRANCH:
+            ip = arg
+        elif op == COND_BRANCH:
+            ip = arg[0] if data_stack.pop() else arg[1]
+        elif op in binary_ops or op == BINARY:
+            fn = binary_ops[op] if op in binary_ops else arg
             rhs = data_stack.pop()
-            lhs = data_stack.pop()
-            data_stack.append(ops[instr.value](lhs, rhs))
-        elif instr.isa(bcinstr.Return):
+            data_stack[-1] = fn(data_stack[-1], rhs)
+        elif op in local_num_fns:
+            data_stack.append(local_num_fns[op](local_stack[arg[0]], arg[1]))
+        elif op == LOCAL_NUM_OP:
+            data_stack.append(arg[2](local_stack[arg[0]], arg[1]))
+        elif op in local_local_fns:
+            data_stack.append(local_local_fns[op](
+                local_stack[arg[0]], local_stack[arg[1]]))
+        elif op == LOCAL_LOCAL_OP:
+            data_stack.append(arg[2](local_stack[arg[0]],
+                                     local_stack[arg[1]]))
+        elif op == RETURN:
+            value = checked(data_stack[-1])
+            if pending is not None:
+                for cache, key in pending:
+                    cache.put(key, value)
+            for hook in on_exit:
+                hook(index, value)
             if not call_stack:
                 return data_stack.pop()
-            local_stack = local_save.pop()
-            code, ip = call_stack.pop()
-        elif instr.isa(bcinstr.Call):
-            local_save.append(local_stack)
-            local_stack = []
-            call_stack.append((code, ip))
-            ip = -1
-            code = fns[instr.value]
-        elif instr.isa(bcinstr.Branch):
-            ip += instr.value
-        elif instr.isa(bcinstr.CondBranch):
-            if data_stack.pop():
-                ip += instr.true_loc
-            else:
-                ip += instr.false_loc
+            opcodes, operands, ip, local_stack, pending, index = (
+                call_stack.pop())
         else:
-            raise Exception("Unsupported instruction " + instr)
-        ip += 1
+            # CALL, TAIL_CALL, or a memoized call that missed its cache.
+            if op == CALL or op == CALL_MEMO:
+                call_stack.append(
+                    (opcodes, operands, ip, local_stack, pending, index))
+                pending = None
+            else:
+                for hook in on_exit:
+                    hook(index, None)
+            if op == CALL_MEMO or op == TAIL_CALL_MEMO:
+                if pending is None:
+                    pending = deque(maxlen=cache.maxsize)
+                pending.append((cache, key))
+            else:
+                callee = arg
+            opcodes, operands, nargs, blank = fns[callee]
+            local_stack = data_stack[len(data_stack) - nargs:] + blank
+            del data_stack[len(data_stack) - nargs:]
+            ip = nargs
+            index = callee
+            for hook in on_enter:
+                hook(index)
+
+
+class Tracer(Hooks):
+    """
+    Prints the whole machine state before every instruction, for debugging
+    the compiler.
+    """
+    def instruction(self, ip, op, arg, data_stack, local_stack, call_stack):
+        print('@@@')
+        print('ip', ip)
+        print('instr', opcode_names[op], arg)
+        print('data', data_stack)
+        print('local', local_stack)
+        print('depth', len(call_stack))
+        print()
+
+
+def trace(fns, bytecode):
+    """
+    Run a program like interp(), printing the machine state before every
+    instruction. This is much slower than interp().
+    """
+    return interp(fns, bytecode, hooks=[Tracer()])
@@ -0,0 +1,368 @@
+"""
+Compile functions to Python source, and from there to Python functions.
+
+Every compiled function becomes a Python function of its own, with the
+locals of the stack machine as Python locals, and calls between functions
+as direct Python calls. The stack is only simulated at compile time: the
+values on it become nested Python expressions, which are assigned to
+temporaries wherever the order of evaluation could otherwise change, so
+the generated code raises exactly where the interpreter would. The if/else
+regions that codegen() emits become Python if/else statements, and
+functions that tail call themselves become loops.
+
+Functions that don't have the structure codegen() emits are compiled to a
+call into the interpreter instead.
+"""
+import math
+
+import bcinstr
+import interpreter
+from interpreter import ops, MISSING
+
+
+class Unsupported(Exception):
+    """
+    Raised for code that can't be translated into Python.
+    """
+
+
+# The Python expression for each operator, in terms of its operands.
+# The logical operators go through ops, since an and/or in Python would
+# skip evaluating their right hand side.
+templates = {
+    '+': '({} + {})',
+    '-': '({} - {})',
+    '*': '({} * {})',
+    '/': '({} / {})',
+    '^': '({} ** {})',
+    '&&': 'op_and({}, {})',
+    '||': 'op_or({}, {})',
+}
+
+# The comparisons are kept as conditions, so that a branch on one can test
+# it directly rather than the 1.0 or 0.0 it evaluates to.
+comparisons = {
+    '<': '{} < {}',
+    '>': '{} > {}',
+    '<=': '{} <= {}',
+    '>=': '{} >= {}',
+    '==': '{} == {}',
+    '!=': '{} != {}',
+}
+
+
+class Value(object):
+    """
+    A value on the simulated stack. expr is the Python expression that
+    computes it. An atomic expression can be evaluated at any time with the
+    same result, so it never needs to be saved in a temporary. A comparison
+    also has its condition, which is true when the value is 1.0.
+    """
+    def __init__(self, expr, atomic=False, cond=None):
+        self.expr = expr
+        self.atomic = atomic
+        self.cond = cond
+
+
+def constant(value):
+    if math.isinf(value) or math.isnan(value):
+        return Value("float('{!r}')".format(value), True)
+    if math.copysign(1, value) < 0:
+        # Parenthesized so that -2.0 ** 2 can't happen.
+        return Value('({!r})'.format(value), True)
+    return Value(repr(value), True)
+
+
+def binary(op, lhs, rhs):
+    if op in comparisons:
+        cond = comparisons[op].format(lhs.expr, rhs.expr)
+        return Value('(1.0 if {} else 0.0)'.format(cond), cond=cond)
+    return Value(templates[op].format(lhs.expr, rhs.expr))
+
+
+class FunctionCompiler(object):
+    """
+    Generates the Python source of a single function.
+    """
+    def __init__(self, fns, index, code, name, arity):
+        self.fns = fns
+        self.index = index
+        self.code = code
+        self.name = name
+        self.arity = arity
+        self.lines = []
+        self.indent = 1
+        self.temps = 0
+        self.loop = index is not None and any(
+            instr.isa(bcinstr.TailCall) and instr.value == index
+            for instr in code)
+
+    def emit(self, line):
+        self.lines.append('    ' * self.indent + line)
+
+    def temp(self):
+        self.temps += 1
+        return 't{}'.format(self.temps)
+
+    def assign(self, value, name=None):
+        """
+        Emit an assignment of value to a temporary, or to name if given,
+        and return the temporary as a value.
+        """
+        if name is None:
+            if value.atomic:
+                return value
+            name = self.temp()
+        self.emit('{} = {}'.format(name, value.expr))
+        return Value(name, True)
+
+    def flush(self, stack):
+        """
+        Evaluate the values on the stack, in the order the interpreter would
+        have, saving them in temporaries.
+        """
+        stack[:] = [self.assign(value) for value in stack]
+
+    def compile(self):
+        params = ['p{}'.format(i) for i in range(self.arity)]
+        self.lines.append('def {}({}):'.format(self.name, ', '.join(params)))
+        if self.loop:
+            self.emit('while True:')
+            self.indent += 1
+        stack = [Value(param, True) for param in params]
+        _, terminated = self.block(0, len(self.code), stack)
+        if not terminated:
+            raise Unsupported("code falls off the end")
+        return '\n'.join(self.lines)
+
+    def block(self, start, end, stack):
+        """
+        Emit code[start:end]. Returns the stack after it, and whether it
+        always returns.
+        """
+        code = self.code
+        ip = start
+        while ip < end:
+            instr = code[ip]
+            if instr.isa(bcinstr.PushNum):
+                stack.append(constant(instr.value))
+            elif instr.isa(bcinstr.LoadLocal):
+                stack.append(Value('l{}'.format(instr.value)))
+            elif instr.isa((bcinstr.StoreLocal, bcinstr.TeeLocal)):
+                # Anything that read the local has to be evaluated before
+                # it's overwritten.
+                value = stack.pop()
+                self.flush(stack)
+                local = 'l{}'.format(instr.value)
+                self.emit('{} = {}'.format(local, value.expr))
+                if instr.isa(bcinstr.TeeLocal):
+                    stack.append(Value(local))
+            elif instr.isa(bcinstr.MathOp):
+                rhs = stack.pop()
+                lhs = stack.pop()
+                stack.append(binary(instr.value, lhs, rhs))
+            elif instr.isa(bcinstr.LocalNumOp):
+                stack.append(binary(instr.op, Value('l{}'.format(instr.slot)),
+                                    constant(instr.num)))
+            elif instr.isa(bcinstr.LocalLocalOp):
+                stack.append(binary(instr.op, Value('l{}'.format(instr.lhs)),
+                                    Value('l{}'.format(instr.rhs))))
+            elif instr.isa(bcinstr.Call):
+                args = self.pop_args(stack, instr.value)
+                stack.append(Value('f{}({})'.format(instr.value, args)))
+            elif instr.isa(bcinstr.TailCall):
+                if instr.value == self.index:
+                    arity = self.arity
+                    args = stack[len(stack) - arity:]
+                    del stack[len(stack) - arity:]
+                    self.flush(stack)
+                    if arity:
+                        self.emit('{} = {}'.format(
+                            ', '.join('p{}'.format(i) for i in range(arity)),
+                            ', '.join(arg.expr for arg in args)))
+                    self.emit('continue')
+                else:
+                    args = self.pop_args(stack, instr.value)
+                    self.flush(stack)
+                    self.emit('return f{}({})'.format(instr.value, args))
+                return stack, True
+            elif instr.isa(bcinstr.Return):
+                value = stack.pop()
+                self.flush(stack)
+                self.emit('return {}'.format(value.expr))
+                return stack, True
+            elif instr.isa(bcinstr.CondBranch):
+                stack, terminated, ip = self.if_else(ip, stack)
+                if terminated:
+                    return stack, True
+                continue
+            else:
+                raise Unsupported("unstructured {}".format(instr))
+            ip += 1
+        return stack, False
+
+    def pop_args(self, stack, index):
+        arity = self.fns[index].arity
+        args = stack[len(stack) - arity:]
+        del stack[len(stack) - arity:]
+        return ', '.join(arg.expr for arg in args)
+
+    def if_else(self, ip, stack):
+        """
+        Emit the if/else starting with the COND_BRANCH at code[ip]. Returns
+        the stack after it, whether it always returns, and the index of the
+        first instruction after it.
+        """
+        code = self.code
+        branch = code[ip]
+        if branch.true_loc != 0 or branch.false_loc < 0:
+            raise Unsupported("unstructured branch")
+        if_start = ip + 1
+        else_start = if_start + branch.false_loc
+        # An if with an else ends with a forward branch over the else. The
+        # peephole optimizer drops the empty ones from ifs without an else.
+        last = code[else_start - 1] if else_start > if_start else None
+        if last is not None and last.isa(bcinstr.Branch) and last.value >= 0:
+            if_end, end = else_start - 1, else_start + last.value
+        elif last is not None and last.isa(bcinstr.Branch):
+            raise Unsupported("backward branch")
+        else:
+            if_end, end = else_start, else_start
+
+        cond = stack.pop()
+        self.flush(stack)
+        depth = len(stack)
+        self.emit('if {}:'.format(cond.cond or cond.expr))
+        if_stack, if_returns = self.side(if_start, if_end, list(stack), None)
+        names = [value.expr for value in if_stack[depth:]]
+
+        self.emit('else:')
+        else_line = len(self.lines)
+        else_stack, else_returns = self.side(
+            else_start, end, list(stack),
+            names if not if_returns else None)
+        if self.lines[else_line:] == ['    ' * (self.indent + 1) + 'pass']:
+            del self.lines[else_line - 1:]
+
+        # Each side of a conditional expression leaves its value on the
+        # stack. Anything else left behind is from expression statements,
+        # which nothing ever reads.
+        if if_returns:
+            stack = else_stack
+        elif else_returns:
+            stack = if_stack
+        elif len(if_stack) == len(else_stack):
+            stack = if_stack
+        return stack, if_returns and else_returns, end
+
+    def side(self, start, end, stack, names):
+        """
+        Emit one side of an if/else. Whatever it leaves on the stack is
+        assigned to names, or to new temporaries if names is None.
+        """
+        self.indent += 1
+        lines = len(self.lines)
+        depth = len(stack)
+        stack, returns = self.block(start, end, stack)
+        if not returns:
+            if names is not None and len(names) == len(stack) - depth:
+                for i, name in enumerate(names):
+                    stack[depth + i] = self.assign(stack[depth + i], name)
+            else:
+                for i in range(depth, len(stack)):
+                    stack[i] = self.assign(stack[i], self.temp())
+        if len(self.lines) == lines:
+            self.emit('pass')
+        self.indent -= 1
+        return stack, returns
+
+
+def fallback(index, arity):
+    """
+    The source of a function that runs fns[index] in the interpreter.
+    """
+    params = ', '.join('p{}'.format(i) for i in range(arity))
+    return ('def f{0}({1}):\n'
+            '    return invoke(fns, frames, {0}, [{1}], memo)'.format(
+                index, params))
+
+
+def source(fns, code=None, interpreted=None):
+    """
+    Generate the Python source for the compiled functions fns, and for the
+    top level code if it's given, as a function called main. The indices of
+    the functions left to the interpreter are added to interpreted.
+    """
+    if interpreted is None:
+        interpreted = set()
+    sources = []
+    for index, fn in enumerate(fns):
+        try:
+            if fn.code is None:
+                raise Unsupported("function has no instructions")
+            sources.append(FunctionCompiler(
+                fns, index, fn.code, 'f{}'.format(index), fn.arity).compile())
+        except Unsupported:
+            sources.append(fallback(index, fn.arity))
+            interpreted.add(index)
+    if code is not None:
+        sources.append(
+            FunctionCompiler(fns, None, code, 'main', 0).compile())
+    return '\n\n\n'.join(sources) + '\n'
+
+
+def memoized(fn, cache):
+    def call(*args):
+        key = interpreter.memo_key(args)
+        value = cache.get(key)
+        if value is MISSING:
+            value = fn(*args)
+            cache.put(key, value)
+        return value
+    return call
+
+
+def compile_functions(fns, code=None, memo=None):
+    """
+    Compile fns, and the top level code if it's given, into Python
+    functions. Returns the namespace they were defined in, where fns[i] is
+    called f<i> and the top level code is main. Calls to pure functions go
+    through memo, if it's given.
+    """
+    namespace = {
+        'op_and': ops['&&'],
+        'op_or': ops['||'],
+        'invoke': interpreter.invoke,
+        'fns': fns,
+        'memo': memo,
+    }
+    interpreted = set()
+    exec(compile(source(fns, code, interpreted), '<jit>', 'exec'), namespace)
+    # The functions left to the interpreter share one decoding of the
+    # program, rather than decoding it again on every call.
+    namespace['frames'] = (interpreter.prepare(fns, memo) if interpreted
+                           else None)
+    if memo is not None:
+        for index, fn in enumerate(fns):
+            name = 'f{}'.format(index)
+            # The interpreter already memoizes its own calls.
+            if fn.pure and index not in interpreted:
+                namespace[name] = memoized(namespace[name], memo.cache(index))
+    return namespace
+
+
+def run(fns, code, memo=None):
+    """
+    Compile and run a program, like interpreter.interp().
+    """
+    try:
+        main = compile_functions(fns, code, memo)['main']
+    except Unsupported:
+        return interpreter.interp(fns, code, memo)
+    try:
+        return main()
+    except RecursionError:
+        # Python's stack is much smaller than the interpreter's, and only
+        # tail calls of a function to itself become loops. Programs have
+        # no side effects, so it's safe to start over in the interpreter.
+        return interpreter.interp(fns, code, memo)
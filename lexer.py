@@ -1,3 +1,5 @@
+import codecs
+import mmap
 import re
 from lookahead import lookahead
 
@@ -10,6 +12,10 @@ class Token(object):
     work generically for subclasses. To add a new token type, an empty subclass
     is usually sufficient.
     """
+    # Tokens are by far the most numerous objects in the compiler, so they
+    # don't get a __dict__. Subclasses need an empty __slots__ of their own.
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -39,14 +45,16 @@ class Token(object):
 
 
 class Num(Token):
+    __slots__ = ()
+
     def __init__(self, value):
         self.value = float(value)
 
-class Ident(Token): pass
-class Char(Token): pass
-class Op(Token): pass
-class Sep(Token): pass
-class Keyword(Token): pass
+class Ident(Token): __slots__ = ()
+class Char(Token): __slots__ = ()
+class Op(Token): __slots__ = ()
+class Sep(Token): __slots__ = ()
+class Keyword(Token): __slots__ = ()
 
 
 # The handlers are pairs of constructors and regular expressions. When a
@@ -63,28 +71,101 @@ HANDLERS = [
 ]
 
 
-@lookahead
-def tokenize(string):
+# All of the handlers combined into a single alternation. Python's regex
+# alternation tries each branch in order at a given position, so the first
+# handler that matches wins, exactly as if we tried each pattern in turn.
+# Each handler gets its own named group so that we can tell which one fired.
+MASTER = re.compile('|'.join(
+    '(?P<h{}>{})'.format(i, pattern.pattern)
+    for i, (_, pattern) in enumerate(HANDLERS)
+))
+GROUP_HANDLERS = {'h{}'.format(i): handler
+                  for i, (handler, _) in enumerate(HANDLERS)}
+WHITESPACE = re.compile(r'\s*')
+
+
+# Number of characters (or bytes) read from a file-like source at a time.
+CHUNK_SIZE = 1 << 16
+
+# Characters that always end a token: whitespace, and the ones that are a
+# whole token on their own and never part of a longer one. Text after one
+# of them, outside a comment, lexes the same whatever came before it.
+TOKEN_ENDS = ' \t\r\n;*/^(){},'
+
+
+def scan(string, pos=0, endpos=None):
+    """
+    Generate the tokens in string[pos:endpos] without copying the string.
+    """
+    if endpos is None:
+        endpos = len(string)
     while True:
-        # Strip any leading whitespace
-        string = string.lstrip()
-        for handler, pattern in HANDLERS:
-            match = pattern.match(string)
-            if match:
-                value = handler(match.group(0))
-                # If the handler returns None, then don't emit a token
-                if value is not None:
-                    yield handler(match.group(0))
-                # Consume a portion of the string
-                string = string[match.end():]
-                # Don't try any further patterns
-                break
-        else:
+        # Skip any leading whitespace
+        pos = WHITESPACE.match(string, pos, endpos).end()
+        match = MASTER.match(string, pos, endpos)
+        if match:
+            value = GROUP_HANDLERS[match.lastgroup](match.group())
+            # If the handler returns None, then don't emit a token
+            if value is not None:
+                yield value
+            pos = match.end()
+        elif pos >= endpos:
             # If no pattern matched, and the string is empty, we're done.
-            if not string:
-                return
-
+            return
+        else:
             # As a last resort, just emit the first character in the
             # text as a token.
-            yield Char(string[0])
-            string = string[1:]
+            yield Char(string[pos])
+            pos += 1
+
+
+def chunks(source):
+    """
+    Turn any supported source into a sequence of text chunks. Sources can be
+    strings, file objects opened in text or binary mode, bytes-like buffers
+    such as mmaps, or iterables of str or bytes chunks. Bytes are decoded as
+    UTF-8 incrementally, so multi-byte characters may straddle chunk edges.
+    """
+    if hasattr(source, 'read'):
+        read = source.read
+        source = iter(lambda: read(CHUNK_SIZE), read(0))
+    elif isinstance(source, (bytes, bytearray, memoryview, mmap.mmap)):
+        view = memoryview(source)
+        source = (view[i:i + CHUNK_SIZE]
+                  for i in range(0, len(view), CHUNK_SIZE))
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in source:
+        if not isinstance(chunk, str):
+            chunk = decoder.decode(chunk)
+        if chunk:
+            yield chunk
+    tail = decoder.decode(b'', final=True)
+    if tail:
+        yield tail
+
+
+@lookahead
+def tokenize(source):
+    if isinstance(source, str):
+        for token in scan(source):
+            yield token
+        return
+
+    # Everything up to the last character in TOKEN_ENDS lexes exactly as it
+    # would in the complete text, unless that character is in a comment,
+    # which runs from a # to the end of its line. Only what's after it is
+    # carried over into the next chunk, so even a program on one long line
+    # is lexed a chunk at a time.
+    rest = ''
+    for chunk in chunks(source):
+        buf = rest + chunk
+        comment = buf.find('#', buf.rfind('\n') + 1)
+        if comment < 0:
+            comment = len(buf)
+        cut = max(buf.rfind(end, 0, comment) for end in TOKEN_ENDS) + 1
+        for token in scan(buf, 0, cut):
+            yield token
+        rest = buf[cut:]
+    for token in scan(rest):
+        yield token
@@ -2,11 +2,19 @@
 from __future__ import print_function
 
 import argparse
+import sys
 
 from lexer import tokenize
 from bcparser import parse
 from codegen import codegen
-from interpreter import interp
+from interpreter import interp, run, Memo
+import bcmodule
+from bccache import Cache
+import jit
+import regvm
+import instrument
+import incremental
+import inliner
 
 
 tests = [
@@ -18,51 +26,176 @@ tests = [
 ]
 
 
-def compile_bytecode(name):
-    with open(name, 'r') as f:
-        text = f.read()
-    tokens = tokenize(text)
-    ast = parse(tokens)
-    fns, stack = codegen(ast)
+def compile_bytecode(name, cache=None, optimize=False, inlining=None):
+    # On a cache hit, the whole front end is skipped.
+    if cache is not None:
+        options = (optimize,)
+        if inlining is not None:
+            options += (inlining.budget,)
+        key = cache.key(name, *options)
+        compiled = cache.get(key)
+        if compiled is not None:
+            return compiled
+
+    # Let the lexer pull the source in chunks while the parser consumes
+    # tokens, rather than reading the whole file into memory first.
+    with open(name, 'rb') as f:
+        ast = parse(tokenize(f))
+    fns, stack = codegen(ast, optimize, inlining)
+
+    if cache is not None:
+        cache.put(key, (fns, stack))
     return fns, stack
 
 
-def output(code, name):
-    code = [instr.to_bytecode() for instr in code]
-    with open(name, 'wb') as f:
-        f.write(b''.join(code))
+def output(fns, code, name):
+    bcmodule.write(fns, code, name)
 
 
 def prettyprint(fns, code):
-    fns = ['\n'.join(str(instr) for instr in fn) for fn in fns]
+    fns = ['\n'.join(str(instr) for instr in fn.code) for fn in fns]
     fns.append('\n'.join(str(instr) for instr in code))
     return '\n\n'.join(fns)
 
 
+def execute(args, fns, code, loaded=False):
+    """
+    Run a compiled program the way args ask for, printing the result and
+    any reports. Programs loaded from a module are already decoded.
+    """
+    memo = Memo(args.memo) if args.memo else None
+    hooks = None
+    if args.profile:
+        hooks = [instrument.OpcodeCounts(), instrument.CallProfile(),
+                 instrument.StackDepth()]
+
+    if loaded:
+        # Modules have no instructions left to compile or translate, so
+        # --jit and --registers have nothing to work with here.
+        result = run(fns, code, memo, hooks)
+    elif args.jit:
+        result = jit.run(fns, code, memo)
+    elif args.registers:
+        result = regvm.interp(fns, code)
+    else:
+        result = interp(fns, code, memo, hooks)
+    print(result)
+
+    if hooks is not None:
+        print(instrument.report(fns, *hooks), file=sys.stderr)
+    if memo is not None:
+        for name, hits, misses in memo.stats(fns):
+            print('memo {}: {} hits, {} misses'.format(name, hits, misses),
+                  file=sys.stderr)
+
+
+def watch(args):
+    """
+    Compile and run the file every time it changes, only recompiling the
+    functions that changed, until interrupted.
+    """
+    compiler = incremental.Compiler(args.optimize)
+    for text in incremental.changes(args.filename):
+        try:
+            fns, code = compiler.compile(text)
+            print('rebuilt {} of {} units'.format(
+                len(compiler.rebuilt),
+                len(compiler.rebuilt) + compiler.reused), file=sys.stderr)
+            execute(args, fns, code)
+        except Exception as e:
+            print('error: {}'.format(e), file=sys.stderr)
+        sys.stdout.flush()
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(
         description='Compile or interpret .math scripts.')
 
     parser.add_argument('filename', type=str,
-                        help='the file to compile or interpret')
+                        help='the file to compile or interpret, either a '
+                        '.math script or a module written with -o')
     parser.add_argument('-o, --out', dest='output', type=str,
                         help='the file to write compiled output to')
     parser.add_argument('-p, --pretty', dest='pretty',
                         action='store_true',
                         help='output pretty-printed code')
+    parser.add_argument('-O', dest='optimize', action='store_true',
+                        help='fold constants and simplify expressions')
+    parser.add_argument('--inline', type=int, metavar='BUDGET', nargs='?',
+                        const=inliner.DEFAULT_BUDGET,
+                        help='inline calls to small functions, of up to '
+                        'BUDGET instructions, {} by default, and report '
+                        'what was inlined'.format(inliner.DEFAULT_BUDGET))
+    parser.add_argument('--memo', type=int, metavar='SIZE',
+                        help='memoize calls to pure functions, keeping up '
+                        'to SIZE results per function')
+    parser.add_argument('--jit', action='store_true',
+                        help='compile functions to Python functions before '
+                        'running them, rather than interpreting them')
+    parser.add_argument('--registers', action='store_true',
+                        help='run on the register machine rather than the '
+                        'stack machine')
+    parser.add_argument('--profile', action='store_true',
+                        help='report the hottest functions and opcodes '
+                        'after running')
+    parser.add_argument('--watch', action='store_true',
+                        help='run the file again whenever it changes, '
+                        'only recompiling the functions that changed')
+    parser.add_argument('--no-cache', dest='cache', action='store_false',
+                        help="don't use the compilation cache")
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='empty the compilation cache before compiling')
+    parser.add_argument('--cache-dir', type=str,
+                        help='where to keep the compilation cache, '
+                        'defaults to $MATH_CACHE_DIR or ~/.cache/mathc')
 
     args = parser.parse_args()
+    if args.registers and (args.jit or args.memo):
+        parser.error('--registers cannot be combined with --jit or --memo')
+    if args.profile and (args.jit or args.registers):
+        parser.error('--profile only works with the interpreter')
 
-    fns, code = compile_bytecode(args.filename)
-    if args.pretty:
-        out = prettyprint(fns, code)
-        if args.output:
-            with open(args.output, 'w') as f:
-                f.write(out)
-        else:
-            print(out)
-    elif args.output:
-        output(code, args.output)
+    cache = Cache(args.cache_dir)
+    if args.clear_cache:
+        cache.clear()
+
+    if args.watch:
+        if args.pretty or args.output:
+            parser.error('--watch cannot be combined with -p or -o')
+        if args.inline is not None:
+            # Inlining makes functions depend on the bodies of others,
+            # which would have to be rebuilt along with them.
+            parser.error('--watch cannot be combined with --inline')
+        if bcmodule.is_module(args.filename):
+            parser.error('--watch needs a .math script, not a module')
+        try:
+            watch(args)
+        except KeyboardInterrupt:
+            pass
+    elif bcmodule.is_module(args.filename):
+        # Compiled modules are run directly, skipping the whole front end.
+        if args.pretty or args.output or args.inline is not None:
+            parser.error('cannot pretty-print or recompile a module')
+        fns, code = bcmodule.load(args.filename)
+        execute(args, fns, code, loaded=True)
     else:
-        result = interp(fns, code)
-        print(result)
+        inlining = None
+        if args.inline is not None:
+            inlining = inliner.Inliner(args.inline)
+        fns, code = compile_bytecode(args.filename,
+                                     cache if args.cache else None,
+                                     args.optimize, inlining)
+        # On a cache hit, nothing was inlined this time.
+        if inlining is not None and inlining.before is not None:
+            print(inlining.report(), file=sys.stderr)
+        if args.pretty:
+            out = prettyprint(fns, code)
+            if args.output:
+                with open(args.output, 'w') as f:
+                    f.write(out)
+            else:
+                print(out)
+        elif args.output:
+            output(fns, code, args.output)
+        else:
+            execute(args, fns, code)
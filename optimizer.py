@@ -0,0 +1,460 @@
+"""
+Optimization passes over labeled ASTs, run between label() and codegen().
+
+Every pass must keep the exact floating point results of the unoptimized
+program, so they only rewrite expressions into forms that the interpreter
+evaluates to the same value.
+"""
+import math
+
+import bcast
+import lexer
+import purity
+from interpreter import ops
+
+
+def optimize(ast, frame_size=0):
+    """
+    Optimize a labeled program, returning the new list of statements.
+    The top level statements are treated as the body of a function with no
+    arguments, using frame_size locals, and come after all of the functions
+    in the result.
+    """
+    fns = [stmt for stmt in ast if isinstance(stmt, bcast.Fn)]
+    top = [stmt for stmt in ast if not isinstance(stmt, bcast.Fn)]
+    for fn in fns:
+        optimize_function(fn)
+    top, _ = optimize_body(top, 0, frame_size)
+    return fns + top
+
+
+def optimize_function(fn):
+    """
+    Optimize the body of a labeled Fn in place, updating its frame size.
+    """
+    fn.body, fn.frame_size = optimize_body(
+        fn.body, len(fn.args), fn.frame_size)
+
+
+def optimize_body(body, nargs, frame_size):
+    """
+    Optimize the body of a function with nargs arguments, which uses
+    frame_size locals. Returns the new body, and how many locals it uses.
+    """
+    body = fold_constants(body, nargs)
+    # The passes below need to know every statement and expression there
+    # is, which purity.calls() checks for.
+    if not purity.calls(body, set()):
+        return body, frame_size
+    body, frame_size = eliminate_common(body, frame_size)
+    return reuse_slots(body, nargs, frame_size)
+
+
+def make_num(value):
+    return bcast.Num(lexer.Num(value))
+
+
+def is_num(expr, value=None):
+    """
+    Is expr a literal number, and if value is given, exactly that number?
+    Zeros only match a zero of the same sign.
+    """
+    if not isinstance(expr, bcast.Num):
+        return False
+    if value is None:
+        return True
+    num = expr.value.value
+    return num == value and math.copysign(1, num) == math.copysign(1, value)
+
+
+# Identities that hold for every float x, including infinities, NaN and
+# negative zero. Note that x + 0 is not among them, since -0.0 + 0 is 0.0.
+# Each entry is (operator, the literal, which side the literal is on).
+identities = [
+    ('*', 1.0, 'rhs'),
+    ('*', 1.0, 'lhs'),
+    ('/', 1.0, 'rhs'),
+    ('-', 0.0, 'rhs'),
+    ('+', -0.0, 'rhs'),
+    ('+', -0.0, 'lhs'),
+    ('^', 1.0, 'rhs'),
+]
+
+
+def fold_expr(expr, consts):
+    """
+    Fold constant subexpressions of expr, replacing the locals in consts by
+    their known values.
+    """
+    if isinstance(expr, bcast.NameLabel):
+        return consts.get(expr.value, expr)
+    elif isinstance(expr, bcast.Call):
+        expr.args = [fold_expr(arg, consts) for arg in expr.args]
+    elif isinstance(expr, bcast.Tee):
+        expr.expr = fold_expr(expr.expr, consts)
+    elif isinstance(expr, bcast.BinOp):
+        expr.lhs = fold_expr(expr.lhs, consts)
+        expr.rhs = fold_expr(expr.rhs, consts)
+        op = expr.op.value
+        if is_num(expr.lhs) and op in bcast.short_circuit:
+            # The right hand side is never worked out when a literal on the
+            # left decides the result.
+            if bool(expr.lhs.value.value) == (op == '||'):
+                return expr.lhs
+        if is_num(expr.lhs) and is_num(expr.rhs):
+            try:
+                value = ops[op](expr.lhs.value.value, expr.rhs.value.value)
+            except (ArithmeticError, ValueError):
+                # Leave errors like division by zero to happen at runtime.
+                return expr
+            # Some operations, like a negative number to a fractional power,
+            # leave the reals. Those can't be stored as a constant.
+            if isinstance(value, float):
+                return make_num(value)
+            return expr
+        for identity_op, value, side in identities:
+            if op != identity_op:
+                continue
+            if side == 'rhs' and is_num(expr.rhs, value):
+                return expr.lhs
+            if side == 'lhs' and is_num(expr.lhs, value):
+                return expr.rhs
+    return expr
+
+
+def count_assignments(stmts, counts):
+    for stmt in stmts:
+        if isinstance(stmt, bcast.Assignment):
+            counts[stmt.name.value] = counts.get(stmt.name.value, 0) + 1
+        elif isinstance(stmt, bcast.IfElse):
+            count_assignments(stmt.if_block, counts)
+            count_assignments(stmt.else_block or [], counts)
+    return counts
+
+
+def fold_constants(body, nargs):
+    """
+    Fold the constants in a function body. Locals that are assigned exactly
+    once, by a statement that always runs, are replaced by their value in
+    every statement that follows the assignment.
+    """
+    counts = count_assignments(body, {})
+    for arg in range(nargs):
+        counts[arg] = counts.get(arg, 0) + 1
+    once = set(slot for slot, count in counts.items() if count == 1)
+    return fold_block(body, {}, once)
+
+
+def fold_block(stmts, consts, once):
+    """
+    Fold a list of statements. If once is given, the statements always run
+    in order, and constants assigned to the locals in once are propagated.
+    """
+    result = []
+    for stmt in stmts:
+        if isinstance(stmt, bcast.Assignment):
+            stmt.expr = fold_expr(stmt.expr, consts)
+            if once and stmt.name.value in once and is_num(stmt.expr):
+                consts[stmt.name.value] = stmt.expr
+        elif isinstance(stmt, bcast.Return):
+            stmt.value = fold_expr(stmt.value, consts)
+        elif isinstance(stmt, bcast.IfElse):
+            stmt.cond = fold_expr(stmt.cond, consts)
+            if is_num(stmt.cond):
+                # Only one side can ever run, so splice it in place of the
+                # whole statement. It now always runs if this block does.
+                if stmt.cond.value.value:
+                    chosen = stmt.if_block
+                else:
+                    chosen = stmt.else_block or []
+                result.extend(fold_block(chosen, consts, once))
+                continue
+            stmt.if_block = fold_block(stmt.if_block, consts, None)
+            if stmt.else_block is not None:
+                stmt.else_block = fold_block(stmt.else_block, consts, None)
+        else:
+            stmt = fold_expr(stmt, consts)
+        result.append(stmt)
+    return result
+
+
+# Operators that give exactly the same result with their operands swapped.
+commutative = {'+', '*', '==', '!='}
+
+
+class Available(object):
+    """
+    A value worked out earlier, which can be used again as long as none of
+    the locals in deps are assigned in between. holder is the local it's
+    kept in, or the Tee it will be kept in if it's ever used again.
+    """
+    __slots__ = ('holder', 'deps')
+
+    def __init__(self, holder, deps):
+        self.holder = holder
+        self.deps = deps
+
+
+class ValueNumbering(object):
+    """
+    Finds operations on the same values that were already worked out, and
+    loads them from a local instead. Every operation is wrapped in a Tee
+    without a local as it's seen, and only the ones that are used again
+    are given one; relabel() unwraps the rest.
+    """
+    def __init__(self, next_slot):
+        self.next_slot = next_slot
+        # Numbers for the keys of values, so that the key of an operation
+        # only holds the numbers of its operands, however deep they are.
+        self.numbers = {}
+
+    def number(self, key):
+        return self.numbers.setdefault(key, len(self.numbers))
+
+    def load(self, holder):
+        if isinstance(holder, bcast.Tee):
+            if holder.name is None:
+                holder.name = bcast.NameLabel(self.next_slot)
+                self.next_slot += 1
+            return bcast.NameLabel(holder.name.value)
+        return bcast.NameLabel(holder)
+
+    def expr(self, expr, available):
+        """
+        Number an expression, returning the expression to use in its place,
+        a number that's the same for every expression with the same value,
+        or None if it could have side effects, and the locals it reads.
+        """
+        if isinstance(expr, bcast.NameLabel):
+            return (expr, self.number(('local', expr.value)),
+                    frozenset([expr.value]))
+        elif isinstance(expr, bcast.Num):
+            return (expr, self.number(('num', repr(expr.value.value))),
+                    frozenset())
+        elif isinstance(expr, bcast.Call):
+            expr.args = [self.expr(arg, available)[0] for arg in expr.args]
+            return expr, None, frozenset()
+        elif isinstance(expr, bcast.Tee):
+            expr.expr = self.expr(expr.expr, available)[0]
+            kill(available, expr.name.value)
+            return expr, None, frozenset()
+        elif isinstance(expr, bcast.BinOp):
+            expr.lhs, lhs_key, lhs_deps = self.expr(expr.lhs, available)
+            if expr.op.value in bcast.short_circuit:
+                # The right hand side isn't always worked out, so nothing
+                # it works out is available after it.
+                rhs_available = dict(available)
+            else:
+                rhs_available = available
+            expr.rhs, rhs_key, rhs_deps = self.expr(expr.rhs, rhs_available)
+            if lhs_key is None or rhs_key is None:
+                return expr, None, frozenset()
+            op = expr.op.value
+            if op in commutative and rhs_key < lhs_key:
+                lhs_key, rhs_key = rhs_key, lhs_key
+            key = self.number((op, lhs_key, rhs_key))
+            deps = lhs_deps | rhs_deps
+            if key in available:
+                return self.load(available[key].holder), key, deps
+            tee = bcast.Tee(None, expr)
+            available[key] = Available(tee, deps)
+            return tee, key, deps
+        return expr, None, frozenset()
+
+    def block(self, stmts, available):
+        """
+        Number a list of statements, given the values available before
+        them. Returns the values available after them, or None if they
+        always return.
+        """
+        for i, stmt in enumerate(stmts):
+            if isinstance(stmt, bcast.Assignment):
+                slot = stmt.name.value
+                stmt.expr, key, deps = self.expr(stmt.expr, available)
+                kill(available, slot)
+                if key is not None and slot not in deps:
+                    if (isinstance(stmt.expr, bcast.Tee) and
+                            stmt.expr.name is None):
+                        # The value is kept in the assigned local anyway.
+                        stmt.expr = stmt.expr.expr
+                        available[key] = Available(slot, deps | {slot})
+                    elif key not in available:
+                        available[key] = Available(slot, deps | {slot})
+            elif isinstance(stmt, bcast.Return):
+                stmt.value = self.expr(stmt.value, available)[0]
+                return None
+            elif isinstance(stmt, bcast.IfElse):
+                stmt.cond = self.expr(stmt.cond, available)[0]
+                after_if = self.block(stmt.if_block, dict(available))
+                after_else = self.block(stmt.else_block or [],
+                                        dict(available))
+                if after_if is None:
+                    available = after_else
+                elif after_else is None:
+                    available = after_if
+                else:
+                    # Only what's available after both blocks is available
+                    # after the whole statement.
+                    available = {key: value
+                                 for key, value in after_if.items()
+                                 if after_else.get(key) is value}
+                if available is None:
+                    return None
+            else:
+                stmts[i] = self.expr(stmt, available)[0]
+        return available
+
+
+def kill(available, slot):
+    """
+    Forget the values that depend on a local that's being assigned.
+    """
+    for key in [key for key, value in available.items()
+                if slot in value.deps]:
+        del available[key]
+
+
+def eliminate_common(body, frame_size):
+    """
+    Replace operations that were already worked out, on the same values, by
+    the value from the first time, which is kept in a new local if it isn't
+    assigned to one already. The first time still happens in the same
+    place, so runtime errors are raised just like before. Returns the new
+    body, and how many locals it uses.
+    """
+    numbering = ValueNumbering(frame_size)
+    numbering.block(body, {})
+    return relabel(body, {}), numbering.next_slot
+
+
+def relabel(node, slots):
+    """
+    Return node, or a list of them, with its locals renamed according to
+    slots, and the Tees that weren't given a local unwrapped.
+    """
+    # Unwrapped in a loop, so that deep expressions don't recurse any
+    # deeper than they did before they were numbered.
+    while isinstance(node, bcast.Tee) and node.name is None:
+        node = node.expr
+    if isinstance(node, list):
+        return [relabel(item, slots) for item in node]
+    elif isinstance(node, bcast.NameLabel):
+        return bcast.NameLabel(slots.get(node.value, node.value))
+    elif isinstance(node, bcast.Tee):
+        return bcast.Tee(relabel(node.name, slots), relabel(node.expr, slots))
+    elif isinstance(node, bcast.BinOp):
+        node.lhs = relabel(node.lhs, slots)
+        node.rhs = relabel(node.rhs, slots)
+    elif isinstance(node, bcast.Call):
+        node.args = relabel(node.args, slots)
+    elif isinstance(node, bcast.Assignment):
+        node.name = relabel(node.name, slots)
+        node.expr = relabel(node.expr, slots)
+    elif isinstance(node, bcast.Return):
+        node.value = relabel(node.value, slots)
+    elif isinstance(node, bcast.IfElse):
+        node.cond = relabel(node.cond, slots)
+        node.if_block = relabel(node.if_block, slots)
+        if node.else_block is not None:
+            node.else_block = relabel(node.else_block, slots)
+    return node
+
+
+class Interference(object):
+    """
+    Which locals can't share a slot, because one is assigned while the
+    other still holds a value that's used later.
+    """
+    def __init__(self):
+        self.edges = {}
+
+    def add(self, slot):
+        return self.edges.setdefault(slot, set())
+
+    def define(self, slot, live):
+        """
+        Record an assignment to slot, when the locals in live are live.
+        """
+        edges = self.add(slot)
+        for other in live:
+            if other != slot:
+                edges.add(other)
+                self.add(other).add(slot)
+
+    def live_expr(self, expr, live):
+        """
+        Return the locals live before expr, given those live after it.
+        """
+        if isinstance(expr, bcast.NameLabel):
+            self.add(expr.value)
+            return live | {expr.value}
+        elif isinstance(expr, bcast.BinOp):
+            if expr.op.value in bcast.short_circuit:
+                # Either the right hand side is worked out, or the left
+                # hand side's value is loaded again.
+                again = expr.lhs
+                if isinstance(again, bcast.Tee):
+                    again = again.name
+                live = self.live_expr(expr.rhs, live) | live
+                if isinstance(again, bcast.NameLabel):
+                    live = live | {again.value}
+                return self.live_expr(expr.lhs, live)
+            return self.live_expr(expr.lhs, self.live_expr(expr.rhs, live))
+        elif isinstance(expr, bcast.Call):
+            for arg in reversed(expr.args):
+                live = self.live_expr(arg, live)
+            return live
+        elif isinstance(expr, bcast.Tee):
+            self.define(expr.name.value, live)
+            return self.live_expr(expr.expr, live - {expr.name.value})
+        return live
+
+    def live_block(self, stmts, live):
+        """
+        Return the locals live before stmts, given those live after them.
+        """
+        for stmt in reversed(stmts):
+            if isinstance(stmt, bcast.Assignment):
+                self.define(stmt.name.value, live)
+                live = self.live_expr(stmt.expr, live - {stmt.name.value})
+            elif isinstance(stmt, bcast.Return):
+                # Nothing after a return runs.
+                live = self.live_expr(stmt.value, frozenset())
+            elif isinstance(stmt, bcast.IfElse):
+                live = self.live_expr(stmt.cond, (
+                    self.live_block(stmt.if_block, live) |
+                    self.live_block(stmt.else_block or [], live)))
+            else:
+                live = self.live_expr(stmt, live)
+        return live
+
+
+def reuse_slots(body, nargs, frame_size):
+    """
+    Let locals share a slot when their values are never needed at the same
+    time, so that frames are smaller. Returns the new body, and how many
+    locals it uses.
+    """
+    graph = Interference()
+    live = graph.live_block(body, frozenset())
+    slots = {arg: arg for arg in range(nargs)}
+    # A local that's live at the start can be read before it's assigned,
+    # which has to raise an error rather than find another local's value,
+    # so those get a slot to themselves.
+    reserved = set()
+    for slot in sorted(live):
+        if slot >= nargs:
+            slots[slot] = nargs + len(reserved)
+            reserved.add(slots[slot])
+    for slot in sorted(graph.edges):
+        if slot in slots:
+            continue
+        taken = reserved | set(slots.get(other) for other in graph.edges[slot])
+        color = 0
+        while color in taken:
+            color += 1
+        slots[slot] = color
+    size = max([nargs] + [slot + 1 for slot in slots.values()])
+    if size >= frame_size:
+        return body, frame_size
+    return relabel(body, slots), size
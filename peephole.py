@@ -0,0 +1,105 @@
+"""
+A peephole optimizer over the instruction lists produced by codegen().
+
+It removes branches that go nowhere, and fuses common sequences of
+instructions into the superinstructions from bcinstr, so that the
+interpreter dispatches once where it used to dispatch two or three times.
+Branch offsets are recomputed for the shortened code.
+"""
+import bcinstr
+
+
+def branch_targets(code):
+    """
+    Map the index of every branch in code to the indices it can jump to.
+    """
+    targets = {}
+    for i, instr in enumerate(code):
+        if instr.isa(bcinstr.Branch):
+            targets[i] = [i + 1 + instr.value]
+        elif instr.isa(bcinstr.CondBranch):
+            targets[i] = [i + 1 + instr.true_loc, i + 1 + instr.false_loc]
+    return targets
+
+
+def fuse(code, i):
+    """
+    Try to fuse the instructions starting at code[i]. Returns the fused
+    instruction and the number of instructions it replaces, or None.
+    """
+    first = code[i]
+    second = code[i + 1] if i + 1 < len(code) else None
+    third = code[i + 2] if i + 2 < len(code) else None
+    # Prefer fusing the load into an operation over fusing it with the
+    # store, since that saves two dispatches rather than one.
+    if (first.isa(bcinstr.StoreLocal) and second is not None and
+            second.isa(bcinstr.LoadLocal) and second.value == first.value and
+            fuse(code, i + 1) is None):
+        return bcinstr.TeeLocal(first.value), 2
+    if (first.isa(bcinstr.LoadLocal) and third is not None and
+            third.isa(bcinstr.MathOp)):
+        if second.isa(bcinstr.PushNum):
+            return bcinstr.LocalNumOp(
+                first.value, second.value, third.value), 3
+        if second.isa(bcinstr.LoadLocal):
+            return bcinstr.LocalLocalOp(
+                first.value, second.value, third.value), 3
+    return None
+
+
+def optimize(code, start=0):
+    """
+    Return an optimized copy of a list of instructions. Nothing is fused
+    into the first start instructions, which is where a function's prologue
+    stores its arguments, so that the interpreter can recognize it.
+    """
+    # Retargeting can leave new empty branches behind, so repeat until
+    # nothing changes.
+    while True:
+        result = optimize_once(code, start)
+        if len(result) == len(code):
+            return result
+        code = result
+
+
+def optimize_once(code, start=0):
+    targets = branch_targets(code)
+    jumped_to = set(t for ts in targets.values() for t in ts)
+
+    result = []
+    # Where each original instruction ended up, and for branches, which
+    # original instruction they were, so that they can be retargeted.
+    new_index = [0] * (len(code) + 1)
+    origins = {}
+    i = 0
+    while i < len(code):
+        instr = code[i]
+        if instr.isa(bcinstr.Branch) and instr.value == 0:
+            # Anything jumping here falls through to the next instruction.
+            new_index[i] = len(result)
+            i += 1
+            continue
+
+        fused = fuse(code, i) if i >= start else None
+        # Never fuse across a branch target, since something jumps into the
+        # middle of the sequence.
+        if fused is not None and not any(
+                j in jumped_to for j in range(i + 1, i + fused[1])):
+            instr, width = fused
+        else:
+            width = 1
+        for j in range(i, i + width):
+            new_index[j] = len(result)
+        if i in targets:
+            origins[len(result)] = i
+        result.append(instr)
+        i += width
+    new_index[len(code)] = len(result)
+
+    for pos, i in origins.items():
+        ends = [new_index[t] - pos - 1 for t in targets[i]]
+        if code[i].isa(bcinstr.Branch):
+            result[pos] = bcinstr.Branch(ends[0])
+        else:
+            result[pos] = bcinstr.CondBranch(ends[0], ends[1])
+    return result
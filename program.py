@@ -0,0 +1,111 @@
+"""
+An API for calling compiled functions from Python, without going through
+main.py.
+
+    program = Program.from_file('something.math')
+    program.call('fib', 64)
+    program.run()
+
+A Program decodes and lays out its functions once, so every call goes
+straight into the interpreter's loop. Calls can be made from any number of
+threads at once.
+"""
+import threading
+
+import bcmodule
+import jit
+from lexer import tokenize
+from bcparser import parse
+from codegen import codegen
+from interpreter import (decode, decode_functions, layout, execute,
+                         PUSH_NUM, CALL, RETURN)
+from main import compile_bytecode
+
+
+class Program(object):
+    """
+    Compiled functions and top level code, ready to run. With memo, calls
+    to pure functions are memoized, and with use_jit, functions are
+    compiled to Python functions rather than interpreted.
+    """
+    def __init__(self, fns, code, memo=None, use_jit=False):
+        self.fns = fns
+        self.memo = memo
+        # The name table that codegen() resolved calls with.
+        self.functions = {fn.name: index for index, fn in enumerate(fns)}
+
+        decoded = decode_functions(fns)
+        if isinstance(code, tuple):
+            # Modules are loaded already decoded.
+            self.main = code
+        else:
+            self.main = decode(code)
+        if memo is not None:
+            decoded = [memo.rewrite(fns, fn) for fn in decoded]
+            self.main = memo.rewrite(fns, self.main)
+        self.frames = layout(fns, decoded)
+        # The opcodes of the code that calls each function, which only
+        # depend on its arity.
+        self.stubs = [[PUSH_NUM] * fn.arity + [CALL, RETURN] for fn in fns]
+
+        self.compiled = None
+        if use_jit and fns:
+            self.compiled = jit.compile_functions(fns, None, memo)
+
+        # Memo caches aren't safe to update from more than one thread at a
+        # time, unlike everything else here, so calls that use them take
+        # turns.
+        self.lock = threading.Lock() if memo is not None else None
+
+    @classmethod
+    def from_file(cls, name, optimize=False, cache=None, **kwargs):
+        """
+        Compile a .math script, or load a module written by main.py -o.
+        """
+        if bcmodule.is_module(name):
+            return cls(*bcmodule.load(name), **kwargs)
+        return cls(*compile_bytecode(name, cache, optimize), **kwargs)
+
+    @classmethod
+    def from_source(cls, text, optimize=False, **kwargs):
+        return cls(*codegen(parse(tokenize(text)), optimize), **kwargs)
+
+    def index(self, name):
+        if name not in self.functions:
+            raise Exception('no function called {}'.format(name))
+        return self.functions[name]
+
+    def call(self, name, *args):
+        """
+        Call the function called name with numbers as its arguments, and
+        return its result.
+        """
+        index = self.index(name)
+        arity = self.fns[index].arity
+        if len(args) != arity:
+            raise Exception('{} takes {} arguments, got {}'.format(
+                name, arity, len(args)))
+        args = [float(arg) for arg in args]
+        if self.lock is None:
+            return self.invoke(index, args)
+        with self.lock:
+            return self.invoke(index, args)
+
+    def invoke(self, index, args):
+        if self.compiled is not None:
+            try:
+                return self.compiled['f{}'.format(index)](*args)
+            except RecursionError:
+                # Deep recursion needs the interpreter's stack, as in
+                # jit.run().
+                pass
+        return execute(self.frames, (self.stubs[index], args + [index, None]))
+
+    def run(self):
+        """
+        Run the top level code, and return its result.
+        """
+        if self.lock is None:
+            return execute(self.frames, self.main)
+        with self.lock:
+            return execute(self.frames, self.main)
@@ -0,0 +1,74 @@
+"""
+Find the pure functions of a labeled program.
+
+A function is pure if its result only depends on its arguments. Functions
+can only see their own locals, so that holds for any function built from
+the statements and expressions below, as long as everything it calls is
+pure too. Anything the analysis doesn't know about makes a function impure.
+"""
+import bcast
+
+
+def calls(stmts, found):
+    """
+    Collect the indices of the functions called by stmts into found.
+    Returns False if stmts contain anything the analysis doesn't know.
+    """
+    for stmt in stmts:
+        if isinstance(stmt, bcast.Assignment):
+            ok = expr_calls(stmt.expr, found)
+        elif isinstance(stmt, bcast.Return):
+            ok = expr_calls(stmt.value, found)
+        elif isinstance(stmt, bcast.IfElse):
+            ok = (expr_calls(stmt.cond, found) and
+                  calls(stmt.if_block, found) and
+                  calls(stmt.else_block or [], found))
+        else:
+            ok = expr_calls(stmt, found)
+        if not ok:
+            return False
+    return True
+
+
+def expr_calls(expr, found):
+    if isinstance(expr, (bcast.Num, bcast.NameLabel)):
+        return True
+    elif isinstance(expr, bcast.BinOp):
+        return expr_calls(expr.lhs, found) and expr_calls(expr.rhs, found)
+    elif isinstance(expr, bcast.Tee):
+        return expr_calls(expr.expr, found)
+    elif isinstance(expr, bcast.Call):
+        found.add(expr.name.value)
+        return all(expr_calls(arg, found) for arg in expr.args)
+    return False
+
+
+def pure_functions(fns):
+    """
+    Return the set of indices of the pure functions among the labeled Fns.
+    """
+    callees = {}
+    for fn in fns:
+        found = set()
+        if calls(fn.body, found):
+            callees[fn.name.value] = found
+    return pure_callers(callees)
+
+
+def pure_callers(callees):
+    """
+    Given the set of functions called by each function the analysis could
+    handle, keyed by index, return the set of indices of the pure ones.
+    """
+    # Start by assuming that everything we could analyze is pure, and remove
+    # functions that call impure ones until nothing changes. This way,
+    # recursive functions are pure unless they call something impure.
+    pure = set(callees)
+    changed = True
+    while changed:
+        changed = False
+        for index in list(pure):
+            if not callees[index] <= pure:
+                pure.remove(index)
+                changed = True
+    return pure
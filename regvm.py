@@ -0,0 +1,381 @@
+"""
+A register machine backend, as an alternative to the stack machine in
+interpreter.py.
+
+The stack instructions from codegen() are translated into three-address
+instructions that name their operands and destination directly. Each frame
+has a flat list of registers laid out as
+
+    locals      one per local slot, with the arguments first
+    temporaries one per stack slot, so the value at depth d lives in
+                temporary d
+    constants   every number the code uses, filled in when the frame is
+                created
+
+Values on the stack are only copied into their temporary when they have
+to be, at branches and before the local they came from is overwritten, so
+most loads and pushes disappear. Storing a freshly computed value
+retargets the instruction that computed it to write the local directly.
+"""
+import bcinstr
+
+
+(MOVE, ADD, SUB, MUL, DIV, POW, LT, GT, LTE, GTE, EQ, NE, AND, OR,
+ CALL, TAIL_CALL, RETURN, JUMP, COND, UNLESS_LT, UNLESS_GT, UNLESS_LTE,
+ UNLESS_GTE, UNLESS_EQ, UNLESS_NE) = range(25)
+
+names = ['MOVE', 'ADD', 'SUB', 'MUL', 'DIV', 'POW', 'LT', 'GT', 'LTE', 'GTE',
+         'EQ', 'NE', 'AND', 'OR', 'CALL', 'TAIL_CALL', 'RETURN', 'JUMP',
+         'COND', 'UNLESS_LT', 'UNLESS_GT', 'UNLESS_LTE', 'UNLESS_GTE',
+         'UNLESS_EQ', 'UNLESS_NE']
+
+math_ops = {
+    '+': ADD, '-': SUB, '*': MUL, '/': DIV, '^': POW,
+    '<': LT, '>': GT, '<=': LTE, '>=': GTE, '==': EQ, '!=': NE,
+    '&&': AND, '||': OR,
+}
+
+# A comparison followed by a branch on its result becomes one instruction,
+# which jumps to its last operand unless the comparison holds.
+unless_ops = {
+    LT: UNLESS_LT, GT: UNLESS_GT, LTE: UNLESS_LTE, GTE: UNLESS_GTE,
+    EQ: UNLESS_EQ, NE: UNLESS_NE,
+}
+
+
+class Function(object):
+    """
+    A translated function. code is a list of (opcode, a, b, c) tuples, and
+    registers is the initial register file of a frame, minus the arguments.
+    """
+    def __init__(self, name, arity, code, registers):
+        self.name = name
+        self.arity = arity
+        self.code = code
+        self.registers = registers
+
+    def __repr__(self):
+        return 'regvm.Function({!r}, {!r})'.format(self.name, self.arity)
+
+
+def stack_depths(code, depth, arities):
+    """
+    Find the depth of the stack before each instruction in code, starting
+    with depth values on it. Unreachable instructions get None.
+    """
+    depths = [None] * len(code)
+    todo = [(0, depth)]
+    while todo:
+        i, depth = todo.pop()
+        while i < len(code) and depths[i] is None:
+            depths[i] = depth
+            instr = code[i]
+            if instr.isa((bcinstr.PushNum, bcinstr.LoadLocal,
+                          bcinstr.LocalNumOp, bcinstr.LocalLocalOp)):
+                depth += 1
+            elif instr.isa((bcinstr.StoreLocal, bcinstr.MathOp)):
+                depth -= 1
+            elif instr.isa(bcinstr.Call):
+                depth += 1 - arities[instr.value]
+            elif instr.isa((bcinstr.Return, bcinstr.TailCall)):
+                break
+            elif instr.isa(bcinstr.Branch):
+                i += 1 + instr.value
+                continue
+            elif instr.isa(bcinstr.CondBranch):
+                depth -= 1
+                todo.append((i + 1 + instr.false_loc, depth))
+                i += 1 + instr.true_loc
+                continue
+            i += 1
+    return depths
+
+
+def local_slots(code, arity):
+    """
+    Count the local slots used by code, which are at least its arguments.
+    """
+    slots = [arity - 1]
+    for instr in code:
+        if instr.isa((bcinstr.LoadLocal, bcinstr.StoreLocal,
+                      bcinstr.TeeLocal)):
+            slots.append(instr.value)
+        elif instr.isa(bcinstr.LocalNumOp):
+            slots.append(instr.slot)
+        elif instr.isa(bcinstr.LocalLocalOp):
+            slots.extend([instr.lhs, instr.rhs])
+    return max(slots) + 1
+
+
+class Translator(object):
+    """
+    Translates the stack instructions of one function into register
+    instructions. The simulated stack holds the register each value is in.
+    """
+    def __init__(self, arities, code, arity):
+        self.arities = arities
+        self.code = code
+        self.arity = arity
+        self.depths = stack_depths(code, arity, arities)
+        self.locals = local_slots(code, arity)
+        self.temps = max([d for d in self.depths if d is not None] + [0]) + 1
+        self.consts = bcinstr.ConstantPool()
+        self.out = []
+        # The index in out of the instruction that computed the value on
+        # top of the stack, if nothing has been emitted since.
+        self.fresh = None
+
+    def temp(self, depth):
+        return self.locals + depth
+
+    def const(self, value):
+        return self.locals + self.temps + self.consts.add(value)
+
+    def emit(self, *instr):
+        self.out.append(list(instr))
+        self.fresh = None
+
+    def result(self, op, depth, a, b):
+        """
+        Emit an instruction that leaves its result at depth on the stack.
+        """
+        self.emit(op, self.temp(depth), a, b)
+        self.fresh = len(self.out) - 1
+        return self.temp(depth)
+
+    def canonicalize(self, stack):
+        """
+        Copy every value on the stack into its own temporary, which is where
+        code that jumps in expects them.
+        """
+        for depth, reg in enumerate(stack):
+            if reg != self.temp(depth):
+                self.emit(MOVE, self.temp(depth), reg, None)
+                stack[depth] = self.temp(depth)
+
+    def store(self, stack, slot, reg):
+        readers = [depth for depth, other in enumerate(stack)
+                   if other == slot]
+        if (self.fresh is not None and self.out[self.fresh][1] == reg and
+                not readers):
+            self.out[self.fresh][1] = slot
+            # The value is in slot now, so storing it again has to copy it.
+            self.fresh = None
+            return
+        # Save the old value for anything still waiting to use it.
+        for depth in readers:
+            self.emit(MOVE, self.temp(depth), slot, None)
+            stack[depth] = self.temp(depth)
+        if reg != slot:
+            self.emit(MOVE, slot, reg, None)
+
+    def translate(self):
+        code = self.code
+        # Where each instruction starts in the output, for the jumps.
+        starts = [0] * (len(code) + 1)
+        targets = set()
+        for i, instr in enumerate(code):
+            if instr.isa(bcinstr.Branch):
+                targets.add(i + 1 + instr.value)
+            elif instr.isa(bcinstr.CondBranch):
+                targets.add(i + 1 + instr.true_loc)
+                targets.add(i + 1 + instr.false_loc)
+
+        stack = list(range(self.arity))
+        for i, instr in enumerate(code):
+            if i in targets and stack is not None:
+                self.canonicalize(stack)
+            starts[i] = len(self.out)
+            if self.depths[i] is None:
+                stack = None
+                continue
+            if i in targets or stack is None:
+                stack = [self.temp(d) for d in range(self.depths[i])]
+                self.fresh = None
+            stack = self.instruction(i, instr, stack)
+        starts[len(code)] = len(self.out)
+
+        for instr in self.out:
+            if instr[0] == JUMP:
+                instr[1] = starts[instr[1]]
+            elif instr[0] == COND:
+                instr[2] = starts[instr[2]]
+                instr[3] = starts[instr[3]]
+            elif instr[0] in unless_ops.values():
+                instr[3] = starts[instr[3]]
+        registers = ([None] * (self.locals - self.arity + self.temps) +
+                     self.consts.values)
+        return [tuple(instr) for instr in self.out], registers
+
+    def instruction(self, i, instr, stack):
+        """
+        Translate code[i]. Returns the stack after it, or None if control
+        never falls through to the next instruction.
+        """
+        if instr.isa(bcinstr.PushNum):
+            stack.append(self.const(instr.value))
+        elif instr.isa(bcinstr.LoadLocal):
+            stack.append(instr.value)
+        elif instr.isa((bcinstr.StoreLocal, bcinstr.TeeLocal)):
+            self.store(stack, instr.value, stack.pop())
+            if instr.isa(bcinstr.TeeLocal):
+                stack.append(instr.value)
+        elif instr.isa(bcinstr.MathOp):
+            b = stack.pop()
+            a = stack.pop()
+            stack.append(self.result(
+                math_ops[instr.value], len(stack), a, b))
+        elif instr.isa(bcinstr.LocalNumOp):
+            stack.append(self.result(
+                math_ops[instr.op], len(stack), instr.slot,
+                self.const(instr.num)))
+        elif instr.isa(bcinstr.LocalLocalOp):
+            stack.append(self.result(
+                math_ops[instr.op], len(stack), instr.lhs, instr.rhs))
+        elif instr.isa((bcinstr.Call, bcinstr.TailCall)):
+            arity = self.arities[instr.value]
+            args = tuple(stack[len(stack) - arity:])
+            del stack[len(stack) - arity:]
+            if instr.isa(bcinstr.TailCall):
+                self.emit(TAIL_CALL, None, instr.value, args)
+                return None
+            stack.append(self.result(CALL, len(stack), instr.value, args))
+        elif instr.isa(bcinstr.Return):
+            self.emit(RETURN, stack.pop(), None, None)
+            return None
+        elif instr.isa(bcinstr.Branch):
+            self.canonicalize(stack)
+            self.emit(JUMP, i + 1 + instr.value, None, None)
+            return None
+        elif instr.isa(bcinstr.CondBranch):
+            cond = stack.pop()
+            true, false = i + 1 + instr.true_loc, i + 1 + instr.false_loc
+            fresh = self.fresh
+            self.canonicalize(stack)
+            last = self.out[-1] if self.out else None
+            if (fresh is not None and fresh == len(self.out) - 1 and
+                    last[0] in unless_ops and last[1] == cond and
+                    instr.true_loc == 0):
+                self.out[-1] = [unless_ops[last[0]], last[2], last[3], false]
+            else:
+                self.emit(COND, cond, true, false)
+            # Both targets are jump targets, so the stack is rebuilt.
+            return None
+        else:
+            raise Exception("Unsupported instruction {}".format(instr))
+        return stack
+
+
+def translate(fns, code):
+    """
+    Translate compiled functions and top level code for the register
+    machine. Returns the translated functions and top level code.
+    """
+    arities = [fn.arity for fn in fns]
+    translated = []
+    for fn in fns:
+        if fn.code is None:
+            raise Exception("{} has no instructions to translate".format(
+                fn.name))
+        fn_code, registers = Translator(arities, fn.code, fn.arity).translate()
+        translated.append(Function(fn.name, fn.arity, fn_code, registers))
+    main_code, registers = Translator(arities, code, 0).translate()
+    return translated, Function('', 0, main_code, registers)
+
+
+def disassemble(fn):
+    lines = []
+    for i, (op, a, b, c) in enumerate(fn.code):
+        operands = ' '.join(str(x) for x in (a, b, c) if x is not None)
+        lines.append('{:>4} {:<12}{}'.format(i, names[op], operands))
+    return '\n'.join(lines)
+
+
+def execute(fns, main):
+    """
+    Run translated top level code, calling into the translated functions.
+    """
+    code = main.code
+    regs = list(main.registers)
+    ip = 0
+    call_stack = []
+    frames = [(fn.code, fn.registers) for fn in fns]
+    while True:
+        op, a, b, c = code[ip]
+        ip += 1
+        if op == MOVE:
+            regs[a] = regs[b]
+        elif op == ADD:
+            regs[a] = regs[b] + regs[c]
+        elif op == SUB:
+            regs[a] = regs[b] - regs[c]
+        elif op == UNLESS_LTE:
+            if not regs[a] <= regs[b]:
+                ip = c
+        elif op == UNLESS_LT:
+            if not regs[a] < regs[b]:
+                ip = c
+        elif op == MUL:
+            regs[a] = regs[b] * regs[c]
+        elif op == CALL:
+            call_stack.append((code, ip, regs, a))
+            code, registers = frames[b]
+            regs = [regs[arg] for arg in c] + registers
+            ip = 0
+        elif op == TAIL_CALL:
+            code, registers = frames[b]
+            regs = [regs[arg] for arg in c] + registers
+            ip = 0
+        elif op == RETURN:
+            value = regs[a]
+            if value is None:
+                # An unassigned register, which the interpreter rejects too.
+                raise Exception("Local read before it was assigned")
+            if not call_stack:
+                return value
+            code, ip, regs, a = call_stack.pop()
+            regs[a] = value
+        elif op == JUMP:
+            ip = a
+        elif op == COND:
+            ip = b if regs[a] else c
+        elif op == DIV:
+            regs[a] = regs[b] / regs[c]
+        elif op == LT:
+            regs[a] = 1.0 if regs[b] < regs[c] else 0.0
+        elif op == GT:
+            regs[a] = 1.0 if regs[b] > regs[c] else 0.0
+        elif op == LTE:
+            regs[a] = 1.0 if regs[b] <= regs[c] else 0.0
+        elif op == GTE:
+            regs[a] = 1.0 if regs[b] >= regs[c] else 0.0
+        elif op == EQ:
+            regs[a] = 1.0 if regs[b] == regs[c] else 0.0
+        elif op == NE:
+            regs[a] = 1.0 if regs[b] != regs[c] else 0.0
+        elif op == UNLESS_GT:
+            if not regs[a] > regs[b]:
+                ip = c
+        elif op == UNLESS_GTE:
+            if not regs[a] >= regs[b]:
+                ip = c
+        elif op == UNLESS_EQ:
+            if not regs[a] == regs[b]:
+                ip = c
+        elif op == UNLESS_NE:
+            if not regs[a] != regs[b]:
+                ip = c
+        elif op == POW:
+            regs[a] = regs[b] ** regs[c]
+        elif op == AND:
+            regs[a] = float(regs[b] and regs[c])
+        else:
+            # OR, translate() never emits any other opcode.
+            regs[a] = float(regs[b] or regs[c])
+
+
+def interp(fns, code):
+    """
+    Translate and run a program, like interpreter.interp().
+    """
+    return execute(*translate(fns, code))
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+A long-lived evaluation server, listening on a Unix domain socket, so that
+small programs don't pay for starting Python and importing the compiler
+every time they run.
+
+    server.py /tmp/math.sock &
+    echo '{"id": 1, "op": "eval", "source": "4 + 12.5 * 3 - 18"}' |
+        socat - UNIX-CONNECT:/tmp/math.sock
+
+Requests and responses are JSON objects, one per line. There are three
+kinds of request:
+
+    {"op": "load", "source": "fn fib(n) { ... }"}
+    {"op": "eval", "source": "..."}  or  {"op": "eval", "program": "..."}
+    {"op": "call", "program": "...", "name": "fib", "args": [64]}
+
+load compiles a program and answers with its key, the hash of its source,
+which later requests can send in place of the source. eval runs the top
+level code, and answers with the value it returns, or of the last
+statement if it doesn't. call calls a function. Every request can have an
+"id", which is copied into its response, and the response has either a
+"value" or an "error".
+
+Compiled programs are kept in memory, keyed by their source. Requests can
+be pipelined, sending many before reading any responses; they're worked on
+at the same time, in a pool of worker threads so the event loop is free to
+read and write, and answered in the order they came in.
+"""
+from __future__ import print_function
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import socket
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import bcast
+from lexer import tokenize
+from bcparser import parse
+from codegen import codegen
+from program import Program
+
+
+# The most requests from one connection that are worked on at once, before
+# the server stops reading more of them.
+PIPELINE = 64
+# Requests are single lines, which can hold a whole program.
+LINE_LIMIT = 1 << 24
+
+
+def key(source):
+    return hashlib.sha256(source.encode('utf-8')).hexdigest()
+
+
+def compile_source(source, optimize=False):
+    """
+    Compile source into a Program. If the top level code doesn't end in a
+    return, it returns the value of its last statement instead, so that a
+    bare expression evaluates to its value.
+    """
+    statements = parse(tokenize(source))
+    if statements:
+        last = statements[-1]
+        if isinstance(last, bcast.Assignment):
+            statements.append(bcast.Return(bcast.Ident(last.name.value)))
+        elif not isinstance(last, (bcast.Return, bcast.Fn, bcast.IfElse)):
+            statements[-1] = bcast.Return(last)
+    return Program(*codegen(statements, optimize))
+
+
+class Server(object):
+    """
+    Answers requests, running the work in executor. Up to cache_size
+    compiled programs are kept, evicting the least recently used.
+    """
+    def __init__(self, executor, optimize=False, cache_size=256):
+        self.executor = executor
+        self.optimize = optimize
+        self.cache_size = cache_size
+        # Futures of compiled programs, so that requests for a program
+        # that's still compiling wait for it rather than compiling it again.
+        self.programs = OrderedDict()
+
+    def run(self, fn, *args):
+        return asyncio.get_running_loop().run_in_executor(
+            self.executor, fn, *args)
+
+    async def program(self, request):
+        """
+        Find the program a request is for, compiling it if it sent source
+        that hasn't been compiled yet.
+        """
+        if 'source' in request:
+            source = request['source']
+            program_key = key(source)
+        elif 'program' in request:
+            source = None
+            program_key = request['program']
+        else:
+            raise Exception('expected a source or a program')
+
+        future = self.programs.get(program_key)
+        if future is None:
+            if source is None:
+                raise Exception('unknown program {}, send its source'.format(
+                    program_key))
+            future = asyncio.ensure_future(
+                self.run(compile_source, source, self.optimize))
+            self.programs[program_key] = future
+            if len(self.programs) > self.cache_size:
+                self.programs.popitem(last=False)
+        else:
+            self.programs.move_to_end(program_key)
+
+        try:
+            return program_key, await future
+        except Exception:
+            # Don't keep failures around, so that there's nothing stale.
+            if self.programs.get(program_key) is future:
+                del self.programs[program_key]
+            raise
+
+    async def handle(self, request):
+        if not isinstance(request, dict):
+            raise Exception('expected an object')
+        op = request.get('op')
+        if op == 'load':
+            program_key, _ = await self.program(request)
+            return {'program': program_key}
+        elif op == 'eval':
+            _, program = await self.program(request)
+            return {'value': await self.run(program.run)}
+        elif op == 'call':
+            _, program = await self.program(request)
+            args = request.get('args', [])
+            if not isinstance(args, list):
+                raise Exception('expected a list of arguments')
+            return {'value': await self.run(
+                program.call, request.get('name'), *args)}
+        raise Exception('unknown op {!r}'.format(op))
+
+    async def respond(self, line):
+        """
+        Answer one line of a request.
+        """
+        request = None
+        try:
+            request = json.loads(line)
+            # A value that JSON can't hold, like a complex number, is an
+            # error too.
+            return encode(request, await self.handle(request))
+        except Exception as e:
+            return encode(request, {'error': str(e) or e.__class__.__name__})
+
+    async def connection(self, reader, writer):
+        """
+        Serve one client, answering its requests in order.
+        """
+        responses = asyncio.Queue(PIPELINE)
+
+        async def write():
+            while True:
+                response = await responses.get()
+                if response is None:
+                    return
+                try:
+                    line = await response
+                except Exception as e:
+                    # Still answer, so that the requests after this one are
+                    # answered in order.
+                    line = encode(None, {'error': str(e) or
+                                         e.__class__.__name__})
+                writer.write(line)
+                await writer.drain()
+
+        writing = asyncio.ensure_future(write())
+        try:
+            while not writing.done():
+                line = await reader.readline()
+                if not line:
+                    break
+                if line.strip():
+                    await responses.put(
+                        asyncio.ensure_future(self.respond(line)))
+            await responses.put(None)
+            await writing
+        except (ConnectionError, ValueError):
+            # The client went away, or sent a line that was too long.
+            writing.cancel()
+        finally:
+            writer.close()
+
+
+def encode(request, response):
+    """
+    The line answering request with response, with the request's id.
+    """
+    if isinstance(request, dict) and 'id' in request:
+        response['id'] = request['id']
+    return json.dumps(response).encode('utf-8') + b'\n'
+
+
+async def start(path, server):
+    """
+    Start serving on the Unix domain socket at path, returning the
+    asyncio server.
+    """
+    if os.path.exists(path):
+        os.unlink(path)
+    return await asyncio.start_unix_server(server.connection, path,
+                                           limit=LINE_LIMIT)
+
+
+async def serve(path, server):
+    async with await start(path, server) as listener:
+        await listener.serve_forever()
+
+
+class Client(object):
+    """
+    A blocking client, for talking to a server from Python.
+
+        client = Client('/tmp/math.sock')
+        key = client.request(op='load', source=text)['program']
+        client.request(op='call', program=key, name='fib', args=[64])
+    """
+    def __init__(self, path):
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.file = self.socket.makefile('rwb')
+
+    def send(self, **request):
+        self.file.write(json.dumps(request).encode('utf-8') + b'\n')
+
+    def receive(self):
+        self.file.flush()
+        line = self.file.readline()
+        if not line:
+            raise Exception('the server closed the connection')
+        return json.loads(line)
+
+    def request(self, **request):
+        self.send(**request)
+        return self.receive()
+
+    def close(self):
+        self.file.close()
+        self.socket.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Serve .math evaluations over a Unix domain socket.')
+    parser.add_argument('path', help='where to create the socket')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='the number of worker threads, one per core by '
+                        'default')
+    parser.add_argument('-O', dest='optimize', action='store_true',
+                        help='fold constants and simplify expressions')
+    parser.add_argument('--cache-size', type=int, default=256,
+                        help='how many compiled programs to keep')
+    args = parser.parse_args()
+
+    with ThreadPoolExecutor(args.jobs) as executor:
+        try:
+            asyncio.run(serve(args.path, Server(executor, args.optimize,
+                                                args.cache_size)))
+        except KeyboardInterrupt:
+            pass
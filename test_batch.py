@@ -0,0 +1,57 @@
+import bcmodule
+import lexer
+import bcparser
+import codegen
+import batch
+
+
+SOURCE = """
+fn fib(n) {
+    if n < 2 { return n; }
+    return fib(n - 1) + fib(n - 2);
+}
+fn div(a, b) { return a / b; }
+return fib(10);
+"""
+
+
+def test_chunked():
+    assert list(batch.chunked(range(7), 3)) == [[0, 1, 2], [3, 4, 5], [6]]
+    assert list(batch.chunked([], 3)) == []
+
+
+def test_parse_args():
+    lines = ['1 2\n', '\n', '3, 4.5\n', '-1e3\n']
+    assert list(batch.parse_args(lines)) == [(1.0, 2.0), (3.0, 4.5),
+                                             (-1000.0,)]
+
+
+def test_run_calls():
+    fns, code = codegen.codegen(bcparser.parse(lexer.tokenize(SOURCE)))
+    module = bcmodule.dump(fns, code)
+    results = list(batch.run_calls(
+        module, 'fib', ((float(n),) for n in range(20)), 2, 3))
+    expected = [0, 1]
+    while len(expected) < 20:
+        expected.append(expected[-1] + expected[-2])
+    assert [result.value for result in results] == expected
+
+    results = list(batch.run_calls(
+        module, 'div', [(1.0, 2.0), (1.0, 0.0), (1.0,)], 2, 1))
+    assert results[0].value == 0.5
+    assert results[1].error == 'float division by zero'
+    assert results[2].error == 'expected 2 arguments, got 1'
+
+
+def test_run_files(tmp_path):
+    names = []
+    for i in range(5):
+        path = tmp_path / 'p{}.math'.format(i)
+        path.write_text('return {} * 2;\n'.format(i))
+        names.append(str(path))
+    bad = tmp_path / 'bad.math'
+    bad.write_text('return x;\n')
+    names.insert(2, str(bad))
+    results = list(batch.run_files(names, 2, 2))
+    assert [r.value for r in results] == [0.0, 2.0, None, 4.0, 6.0, 8.0]
+    assert 'undefined' in results[2].error
@@ -0,0 +1,70 @@
+import os
+
+import bccache
+import inliner
+from bccache import Cache
+from interpreter import interp
+from main import compile_bytecode
+
+
+def test_hit_skips_compilation(tmpdir):
+    cache = Cache(str(tmpdir.join('cache')))
+    source = tmpdir.join('prog.math')
+    source.write('fn f(x) { return x * 2; } return f(21);')
+
+    fns, code = compile_bytecode(str(source), cache)
+    assert len(cache.entries()) == 1
+    key = cache.key(str(source), False)
+    assert interp(*cache.get(key)) == interp(fns, code) == 42.0
+
+    # Changing the source or the options changes the key.
+    assert cache.key(str(source), True) != key
+    source.write('fn f(x) { return x * 3; } return f(21);')
+    assert cache.key(str(source), False) != key
+    assert interp(*compile_bytecode(str(source), cache)) == 63.0
+
+
+def test_key_covers_the_inliner(tmpdir, monkeypatch):
+    cache = Cache(str(tmpdir.join('cache')))
+    source = tmpdir.join('prog.math')
+    source.write('fn f(x) { return x * 2; } return f(21);')
+    fns, code = compile_bytecode(str(source), cache, False,
+                                 inliner.Inliner(16))
+    key = cache.key(str(source), False, 16)
+    assert interp(*cache.get(key)) == interp(fns, code) == 42.0
+    assert cache.key(str(source), False, 4) != key
+
+    # Changing the inliner's source changes the key too.
+    assert inliner in bccache.COMPILER_MODULES
+    changed = tmpdir.join('inliner.py')
+    with open(inliner.__file__) as f:
+        changed.write(f.read() + '\n# changed\n')
+    monkeypatch.setattr(inliner, '__file__', str(changed))
+    monkeypatch.setattr(bccache, '_compiler_version', None)
+    assert cache.key(str(source), False, 16) != key
+
+
+def test_eviction(tmpdir):
+    cache = Cache(str(tmpdir), max_size=0)
+    cache.put('a', list(range(1000)))
+    assert cache.entries() == []
+
+    cache.max_size = 10 ** 6
+    for i, key in enumerate('abc'):
+        cache.put(key, list(range(1000)))
+        os.utime(cache.path(key), (i, i))
+    cache.get('a')
+    cache.max_size = sum(size for _, size, _ in cache.entries()) - 1
+    cache.evict()
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+    cache.clear()
+    assert cache.entries() == []
+
+
+def test_corrupt_entry_is_a_miss(tmpdir):
+    cache = Cache(str(tmpdir))
+    tmpdir.join('bad.pickle').write('garbage')
+    assert cache.get('bad') is None
+    assert cache.entries() == []
@@ -0,0 +1,46 @@
+import pytest
+
+import bcinstr
+import bcmodule
+import interpreter
+from main import compile_bytecode
+
+
+def test_round_trip(tmpdir):
+    fns, code = compile_bytecode('something.math')
+    name = str(tmpdir.join('something.mbc'))
+    bcmodule.write(fns, code, name)
+
+    assert bcmodule.is_module(name)
+    loaded_fns, decoded_code = bcmodule.load(name)
+    assert [fn.decoded for fn in loaded_fns] == [
+        interpreter.decode(fn.code) for fn in fns]
+    assert [(fn.name, fn.arity, fn.frame_size, fn.pure)
+            for fn in loaded_fns] == [
+        (fn.name, fn.arity, fn.frame_size, fn.pure) for fn in fns]
+    assert decoded_code == interpreter.decode(code)
+    assert (interpreter.run(loaded_fns, decoded_code) ==
+            interpreter.interp(fns, code))
+
+
+def test_constants_are_exact(tmpdir):
+    source = tmpdir.join('consts.math')
+    source.write('return 0.1 + -0.0 * 1e300;')
+    fns, code = compile_bytecode(str(source))
+    fns, code = bcmodule.read(bcmodule.dump(fns, code))
+    assert interpreter.run(fns, code) == 0.1 + -0.0 * 1e300
+
+
+def test_rejects_other_files():
+    with pytest.raises(Exception):
+        bcmodule.read(b'not a module at all')
+    assert not bcmodule.is_module('something.math')
+
+
+def test_compact_code():
+    fns, code = compile_bytecode('something.math')
+    expected = bcmodule.dump(fns, code)
+    packed = [bcinstr.Function(fn.name, fn.arity, fn.code, fn.pure).pack()
+              for fn in fns]
+    assert all(fn.code is None for fn in packed)
+    assert bcmodule.dump(packed, code) == expected
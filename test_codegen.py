@@ -0,0 +1,54 @@
+import bcinstr
+import lexer
+import bcparser
+import codegen
+from bcinstr import Branch, CondBranch, PushNum, Return
+
+
+def compile_source(source):
+    return codegen.codegen(bcparser.parse(lexer.tokenize(source)))
+
+
+def test_emitter_labels():
+    out = bcinstr.Emitter()
+    start, end = bcinstr.Label(), bcinstr.Label()
+    out.place(start)
+    out.emit(PushNum(1))
+    out.branch_unless(end)
+    out.branch(start)
+    out.place(end)
+    out.emit(PushNum(2))
+    out.emit(Return())
+    assert [repr(instr) for instr in out.code] == [
+        repr(PushNum(1)), repr(CondBranch(0, 1)), repr(Branch(-3)),
+        repr(PushNum(2)), repr(Return())]
+
+
+def test_if_else():
+    _, code = compile_source(
+        "if 1 { x = 2; } else { x = 3; y = 4; } return 5;")
+    assert [str(instr).split()[0] for instr in code] == [
+        'PUSH_NUM', 'COND_BRANCH', 'PUSH_NUM', 'STORE_LOCAL', 'BRANCH',
+        'PUSH_NUM', 'STORE_LOCAL', 'PUSH_NUM', 'STORE_LOCAL',
+        'PUSH_NUM', 'RETURN']
+    assert (code[1].true_loc, code[1].false_loc) == (0, 3)
+    assert code[4].value == 4
+
+
+def test_functions():
+    fns, code = compile_source("fn f(a, b) { } fn g(a) { return f(a, a); }")
+    assert [repr(instr) for instr in fns[0].code] == [
+        'StoreLocal(1)', 'StoreLocal(0)', 'PushNum(0)', 'Return']
+    assert [repr(instr) for instr in fns[1].code] == [
+        'StoreLocal(0)', 'LoadLocal(0)', 'LoadLocal(0)', 'TailCall(0)']
+    assert code == []
+
+
+def test_short_circuit():
+    _, code = compile_source("a = 1; b = 2; return a || b;")
+    assert [str(instr).split()[0] for instr in code] == [
+        'PUSH_NUM', 'STORE_LOCAL', 'PUSH_NUM', 'STORE_LOCAL',
+        'LOAD_LOCAL', 'COND_BRANCH', 'LOAD_LOCAL', 'LOAD_LOCAL', 'OP_OR',
+        'BRANCH', 'PUSH_NUM', 'LOAD_LOCAL', 'OP_OR', 'RETURN']
+    assert (code[5].true_loc, code[5].false_loc) == (0, 4)
+    assert code[9].value == 3
@@ -0,0 +1,108 @@
+import pytest
+
+import lexer
+import bcparser
+import codegen
+import incremental
+import interpreter
+
+
+SOURCE = """
+fn square(x) { return x * x; }
+fn sum(n) {  # adds up squares; fn in a comment
+    if n <= 0 { return 0; }
+    return square(n) + sum(n - 1);
+};
+total = sum(10);
+fn half(x) { return x / 2; }
+return half(total);
+"""
+
+
+def compile_whole(text, optimize=False):
+    return codegen.codegen(bcparser.parse(lexer.tokenize(text)), optimize)
+
+
+def listing(fns, code):
+    return ([(fn.name, fn.arity, fn.frame_size, fn.pure,
+              [repr(instr) for instr in fn.code]) for fn in fns],
+            [repr(instr) for instr in code])
+
+
+def test_split():
+    fns, gaps = incremental.split(SOURCE)
+    assert [fn.split('(')[0] for fn in fns] == [
+        'fn square', 'fn sum', 'fn half']
+    assert gaps[2].strip() == 'total = sum(10);'
+    assert gaps[3].strip() == 'return half(total);'
+
+
+def test_matches_codegen():
+    with open('something.math') as f:
+        sources = [SOURCE, f.read()]
+    for text in sources:
+        for optimize in (False, True):
+            compiler = incremental.Compiler(optimize)
+            assert (listing(*compiler.compile(text)) ==
+                    listing(*compile_whole(text, optimize)))
+
+
+def test_rebuilds_changed_functions():
+    compiler = incremental.Compiler()
+    compiler.compile(SOURCE)
+    assert compiler.rebuilt == ['square', 'sum', 'half', None]
+
+    compiler.compile(SOURCE)
+    assert compiler.rebuilt == []
+    assert compiler.reused == 4
+
+    edited = SOURCE.replace('x * x', 'x * x * 2')
+    fns, code = compiler.compile(edited)
+    assert compiler.rebuilt == ['square']
+    assert interpreter.interp(fns, code) == 385.0
+
+
+def test_stable_indices():
+    compiler = incremental.Compiler()
+    compiler.compile(SOURCE)
+    added = SOURCE.replace('fn square', 'fn one() { return 1; }\nfn square')
+    fns, code = compiler.compile(added)
+    # The new function goes at the end, so nothing else moves.
+    assert [fn.name for fn in fns] == ['square', 'sum', 'half', 'one']
+    assert compiler.rebuilt == ['one', None]
+
+    removed = added.replace('fn square(x) { return x * x; }', '')
+    removed = removed.replace('square(n)', 'n * n')
+    fns, code = compiler.compile(removed)
+    assert [fn.name for fn in fns] == ['sum', 'half', 'one']
+    # sum changed, and the top level calls functions that moved. half
+    # doesn't call anything, so it's reused even though it moved.
+    assert compiler.rebuilt == ['sum', None]
+    assert interpreter.interp(fns, code) == 192.5
+
+
+def test_purity():
+    compiler = incremental.Compiler()
+    fns, _ = compiler.compile(SOURCE)
+    assert all(fn.pure for fn in fns)
+    # A nested function is beyond the purity analysis, which makes square
+    # impure, and sum along with it, without rebuilding sum.
+    fns, _ = compiler.compile(SOURCE.replace(
+        '{ return x * x; }', '{ fn inner() { } return x * x; }'))
+    assert compiler.rebuilt == ['square']
+    assert [fn.pure for fn in fns] == [False, False, True]
+
+
+def test_errors():
+    compiler = incremental.Compiler()
+    compiler.compile(SOURCE)
+    for text, message in [
+            (SOURCE + 'fn half(y) { return y; }', 'already defined'),
+            (SOURCE.replace('x / 2', 'y / 2'), 'undefined'),
+            (SOURCE.replace('half(total)', 'third(total)'), 'not defined'),
+            (SOURCE.replace('x / 2;', 'x / ;'), 'Parse Error')]:
+        with pytest.raises(Exception) as error:
+            compiler.compile(text)
+        assert message in str(error.value)
+    fns, code = compiler.compile(SOURCE)
+    assert interpreter.interp(fns, code) == 192.5
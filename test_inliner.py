@@ -0,0 +1,113 @@
+import pytest
+
+import lexer
+import bcparser
+import bcinstr
+import codegen
+import inliner
+import interpreter
+
+
+def compile_source(source, budget=inliner.DEFAULT_BUDGET, optimize=False):
+    inlining = inliner.Inliner(budget)
+    fns, code = codegen.codegen(bcparser.parse(lexer.tokenize(source)),
+                                optimize, inlining)
+    return fns, code, inlining
+
+
+def calls(code):
+    return [instr.value for instr in code
+            if instr.isa((bcinstr.Call, bcinstr.TailCall))]
+
+
+def test_something():
+    with open('something.math') as f:
+        source = f.read()
+    fns, code, inlining = compile_source(source)
+    names = [fn.name for fn in fns]
+    # id -> id2 -> id3 collapses, and so does fib into the top level, but
+    # fib2 calls itself.
+    assert calls(fns[names.index('id')].code) == []
+    assert [names[i] for i in calls(code)] == ['fib2']
+    assert inlining.inlined == [
+        ('id2', 'id3'), ('id', 'id2'), (None, 'fib')]
+    assert interpreter.interp(fns, code) == 10610209857723.0
+    assert inlining.report().splitlines() == [
+        'inlined 3 calls, {} -> {} instructions'.format(
+            inlining.before, inlining.after),
+        '  fib into <main>: 1',
+        '  id2 into id: 1',
+        '  id3 into id2: 1']
+
+
+def test_budget():
+    source = """
+    fn add(a, b) { return a + b; }
+    fn big(a) { return a * 2 + a * 3 + a * 4 + a * 5; }
+    return add(1, 2) + big(3);
+    """
+    fns, code, inlining = compile_source(source, 4)
+    assert calls(code) == [1]
+    fns, code, inlining = compile_source(source, 0)
+    assert calls(code) == [0, 1]
+    assert inlining.inlined == []
+    assert interpreter.interp(fns, code) == 45.0
+
+
+def test_statements():
+    source = """
+    fn maths(z) {
+        a = 13 * 2 - z;
+        b = 9 * 2;
+        c = a ^ b;
+        d = c - (a * b);
+        return d;
+    }
+    fn twice(x) { return x * x + maths(x); }
+    fn g(x) { y = maths(x + 1); return maths(y) + twice(maths(25)); }
+    return g(24);
+    """
+    expected = interpreter.interp(*codegen.codegen(
+        bcparser.parse(lexer.tokenize(source))))
+    for optimize in (False, True):
+        fns, code, inlining = compile_source(source, 30, optimize)
+        assert interpreter.interp(fns, code) == expected
+        # maths can only be inlined where it's the whole value of an
+        # assignment, and twice can't be inlined into an argument.
+        assert sorted(inlining.inlined) == [('g', 'maths'), ('g', 'twice')]
+        assert [fns[i].name for i in calls(fns[2].code)] == [
+            'maths', 'maths', 'maths']
+
+
+def test_arguments():
+    source = """
+    fn sq(x) { return x * x; }
+    fn sub(a, b) { return b - a; }
+    fn first(a, b) { return a; }
+    fn n(x) { return x + 1; }
+    fn f(x) { return sq(n(x)) + sub(n(x), n(2)); }
+    fn g(x) { return first(n(x), n(2)) + 1; }
+    return f(1) + g(1);
+    """
+    fns, code, inlining = compile_source(source)
+    # sq(n(x)) keeps n(x) in a local, since it's used twice. sub uses its
+    # arguments the wrong way round, and first doesn't use one at all, so
+    # they can only be inlined where they're a whole statement.
+    assert sorted(callee for caller, callee in inlining.inlined
+                  if caller == 'f') == ['n', 'n', 'n', 'sq']
+    assert interpreter.interp(fns, code) == 4 + 1 + 3
+
+
+def test_errors_in_order():
+    source = """
+    fn boom(x) { return x / 0; }
+    fn big(x) { return 10 ^ 400; }
+    fn second(a, b) { return b; }
+    fn pair(a, b) { c = b; return c + a; }
+    return CALL;
+    """
+    for call in ['second(boom(1), big(1))', 'pair(boom(1), big(1))',
+                 'second(1, boom(1)) + big(1)']:
+        with pytest.raises(ZeroDivisionError):
+            fns, code, _ = compile_source(source.replace('CALL', call))
+            interpreter.interp(fns, code)
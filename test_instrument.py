@@ -0,0 +1,78 @@
+import lexer
+import bcparser
+import codegen
+import interpreter
+import instrument
+
+
+FIB = """
+fn fib(n) {
+    if n < 2 { return n; }
+    return fib(n - 1) + fib(n - 2);
+}
+fn twice(n) { return fib(n) + fib(n); }
+return twice(10);
+"""
+
+
+def compile_source(source):
+    return codegen.codegen(bcparser.parse(lexer.tokenize(source)))
+
+
+def profile(source, memo=None):
+    fns, code = compile_source(source)
+    hooks = [instrument.OpcodeCounts(), instrument.CallProfile(),
+             instrument.StackDepth()]
+    result = interpreter.interp(fns, code, memo, hooks)
+    assert result == interpreter.interp(fns, code)
+    return fns, hooks
+
+
+def test_call_counts():
+    fns, (counts, calls, depth) = profile(FIB)
+    names = {instrument.function_name(fns, index): n
+             for index, n, _, _ in calls.functions()}
+    assert names == {'fib': 2 * 177, 'twice': 1, '<main>': 1}
+    for index, _, inclusive, exclusive in calls.functions():
+        assert 0 <= exclusive <= inclusive + 1e-9
+    assert depth.calls == 10
+    assert counts.counts[interpreter.RETURN] == 2 * 177 + 1
+
+
+def test_opcode_counts():
+    fns, code = compile_source("a = 1; b = a + 2; return b * a;")
+    counts = instrument.OpcodeCounts()
+    assert interpreter.interp(fns, code, hooks=[counts]) == 3.0
+    opcodes, _ = interpreter.decode(code)
+    assert sum(counts.counts.values()) == len(opcodes)
+    assert dict(counts.most_common()) == {
+        name: opcodes.count(op)
+        for op, name in enumerate(interpreter.opcode_names)
+        if op in opcodes}
+
+
+def test_memoized_and_tail_calls():
+    source = """
+    fn fib2(n, a, b) {
+        if n <= 0 { return a; }
+        return fib2(n - 1, b, a + b);
+    }
+    fn f(n) { return fib2(n, 0, 1); }
+    return f(30) + f(30) + f(20);
+    """
+    fns, (_, calls, depth) = profile(source, interpreter.Memo(64))
+    names = {instrument.function_name(fns, index): n
+             for index, n, _, _ in calls.functions()}
+    # The second f(30) is a cache hit, so fib2 only runs for the first one
+    # and for f(20).
+    assert names == {'<main>': 1, 'f': 2, 'fib2': 31 + 21}
+    assert not calls.frames
+    assert depth.calls == 1
+
+
+def test_report():
+    fns, hooks = profile(FIB)
+    text = instrument.report(fns, *hooks, limit=2)
+    lines = text.splitlines()
+    assert lines[1].split()[:2] == ['fib', '354']
+    assert 'max call depth 10' in lines[-1]
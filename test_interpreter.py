@@ -0,0 +1,233 @@
+import pytest
+
+import bcinstr
+import lexer
+import bcparser
+import codegen
+import interpreter
+
+
+def run(source):
+    return interpreter.interp(*codegen.codegen(
+        bcparser.parse(lexer.tokenize(source))))
+
+
+def test_arithmetic():
+    cases = [
+        ("return (3^2 + 4^2)^(1/2);", 5.0),
+        ("a = 2; b = 2; c = 2; d = 2; return a^b^c^d;", 65536.0),
+        ("a = 2; b = 4; c = 3; d = 1; return a - b - c - d;", -6.0),
+        ("return 4 + 12.5 * 3 - 18;", 23.5),
+        ("return 1 < 2;", 1.0),
+        ("return 2 <= 1;", 0.0),
+        ("return 2 && 3;", 3.0),
+        ("return 0 || 4;", 4.0),
+    ]
+    for source, result in cases:
+        assert run(source) == result
+
+
+def test_short_circuit():
+    source = """
+    fn boom() { return 1 / 0; }
+    fn and(a, b) { return a && b; }
+    fn or(a, b) { return a || b; }
+    fn and_sum(a, b) { return (a + 0) && b; }
+    fn or_less(a, b) { return (a < 1) || b; }
+    return (1 || boom()) + (0 && boom()) + (boom() && 0);
+    """
+    fns, code = codegen.codegen(bcparser.parse(lexer.tokenize(source)))
+    with pytest.raises(ZeroDivisionError):
+        interpreter.interp(fns, code)
+    fns, code = codegen.codegen(bcparser.parse(lexer.tokenize(
+        source.replace(" + (boom() && 0)", ""))))
+    assert interpreter.interp(fns, code) == 1.0
+
+    # The results are what the ops table gives, down to the sign of zero.
+    values = [-0.0, 0.0, 0.5, 2.0, float('inf'), float('nan')]
+    cases = [
+        ('and', lambda a, b: interpreter.ops['&&'](a, b)),
+        ('or', lambda a, b: interpreter.ops['||'](a, b)),
+        ('and_sum', lambda a, b: interpreter.ops['&&'](a + 0, b)),
+        ('or_less', lambda a, b: interpreter.ops['||'](float(a < 1), b)),
+    ]
+    for name, expected in cases:
+        index = [fn.name for fn in fns].index(name)
+        for a in values:
+            for b in values:
+                assert (repr(interpreter.call(fns, index, [a, b])) ==
+                        repr(expected(a, b)))
+
+    # Whichever side is the result, it goes through float() like before.
+    assert repr(run("fn g(x) { x; } return 1 && g(2);")) == '0.0'
+    assert repr(run("fn g(x) { x; } return g(2) || 0;")) == '0.0'
+    assert repr(run("fn g(x) { x; } a = g(2); return a && 1;")) == '0.0'
+    for source in ["return 1 && (0 - 1) ^ 0.5;",
+                   "return ((0 - 1) ^ 0.5) || 1;"]:
+        with pytest.raises(TypeError):
+            run(source)
+    for source in [
+            "fn f(x) { if x { y = 1; } return 1 && y; } return f(0);",
+            "fn h(x) { if x { y = 1; } return y; } z = 0 || h(0); return 5;"]:
+        with pytest.raises(Exception, match='before it was assigned'):
+            run(source)
+
+
+def test_branches():
+    source = """
+    fn sign(x) {
+        if x < 0 { return 0 - 1; } else if x == 0 { return 0; }
+        return 1;
+    }
+    return sign(-5) * 100 + sign(0) * 10 + sign(7);
+    """
+    assert run(source) == -99.0
+
+
+def test_recursion():
+    with open('something.math') as f:
+        assert run(f.read()) == 10610209857723.0
+
+
+def test_trace_matches(capsys):
+    source = "fn f(a, b) { return a * b + 1; } return f(6, 7);"
+    fns, code = codegen.codegen(bcparser.parse(lexer.tokenize(source)))
+    assert interpreter.trace(fns, code) == interpreter.interp(fns, code)
+
+
+def test_tail_calls():
+    source = """
+    fn count(n, acc) {
+        if n <= 0 { return acc; }
+        return count(n - 1, acc + 2);
+    }
+    return count(200000, 0);
+    """
+    fns, code = codegen.codegen(bcparser.parse(lexer.tokenize(source)))
+    assert any(instr.isa(bcinstr.TailCall) for instr in fns[0].code)
+    assert interpreter.interp(fns, code) == 400000.0
+
+
+def test_memoization():
+    source = """
+    fn fib(n) {
+        if n < 2 { return n; }
+        return fib(n - 1) + fib(n - 2);
+    }
+    fn fib2(n, a, b) {
+        if n <= 0 { return a; }
+        return fib2(n - 1, b, a + b);
+    }
+    fn both(n) { return fib(n) - fib2(n, 0, 1); }
+    return both(20) + both(20) + fib(25);
+    """
+    fns, code = codegen.codegen(bcparser.parse(lexer.tokenize(source)))
+    assert all(fn.pure for fn in fns)
+    memo = interpreter.Memo(8)
+    assert interpreter.interp(fns, code, memo) == interpreter.interp(fns, code)
+    stats = {name: (hits, misses) for name, hits, misses in memo.stats(fns)}
+    assert stats['both'] == (1, 1)
+    # Every fib(n) is computed once, apart from the ones evicted from the
+    # cache between both(20) and fib(25).
+    assert stats['fib'][1] < 40
+    # A second run reuses the results of the first.
+    assert interpreter.interp(fns, code, memo) == interpreter.interp(fns, code)
+    assert memo.stats(fns)[0][2] == stats['fib'][1]
+
+
+def test_lru_cache():
+    cache = interpreter.LRUCache(2)
+    cache.put((1.0,), 1.0)
+    cache.put((2.0,), 2.0)
+    assert cache.get((1.0,)) == 1.0
+    cache.put((3.0,), 3.0)
+    assert cache.get((2.0,)) is interpreter.MISSING
+    assert (cache.hits, cache.misses) == (1, 1)
+
+
+def test_compact_code():
+    with open('something.math') as f:
+        fns, code = codegen.codegen(
+            bcparser.parse(lexer.tokenize(f.read())), True)
+    listings = [[str(instr) for instr in fn.code] for fn in fns]
+    expected = interpreter.interp(fns, code)
+
+    for fn in fns:
+        fn.pack()
+        fn.decoded = None
+    assert all(len(fn.compact) == len(listing)
+               for fn, listing in zip(fns, listings))
+    compact = bcinstr.CompactCode.from_instrs(code)
+    assert interpreter.interp(fns, compact) == expected
+
+    for fn in fns:
+        fn.unpack()
+    assert [[str(instr) for instr in fn.code] for fn in fns] == listings
+
+
+def test_frames():
+    source = """
+    fn f(a, b) { c = a * b; if c > 10 { d = c; } else { e = 0; } return c; }
+    fn unset(x) { if x > 0 { y = x; } return y; }
+    return f(3, 4);
+    """
+    fns, code = codegen.codegen(bcparser.parse(lexer.tokenize(source)), True)
+    # c takes over the slot of a once a and b are dead, and d and e share
+    # one, while y, which can be read unassigned, keeps its own.
+    assert [(fn.arity, fn.frame_size) for fn in fns] == [(2, 2), (1, 2)]
+    frames = interpreter.layout(fns, interpreter.decode_functions(fns))
+    # The arguments are passed straight into the frame, skipping the
+    # prologue that would store them.
+    assert [frame[2] for frame in frames] == [2, 1]
+    assert interpreter.interp(fns, code) == 12.0
+
+    index = [fn.name for fn in fns].index('unset')
+    assert interpreter.call(fns, index, [1]) == 1.0
+    with pytest.raises(Exception):
+        interpreter.call(fns, index, [-1])
+
+
+def test_unassigned_return():
+    # The unassigned result is never used, but returning it is an error.
+    source = "fn g(x) { if x { y = 1; } return y; } z = g(0); return 5;"
+    fns, code = codegen.codegen(bcparser.parse(lexer.tokenize(source)))
+    for hooks in [None, [interpreter.Hooks()]]:
+        with pytest.raises(Exception, match='before it was assigned'):
+            interpreter.interp(fns, code, hooks=hooks)
+    with pytest.raises(Exception, match='before it was assigned'):
+        interpreter.interp(fns, code, interpreter.Memo())
+    assert run(source.replace('g(0)', 'g(1)')) == 5.0
+
+
+def test_memoized_tail_call_hit():
+    source = """
+    fn sq(x) { return x * x; }
+    fn g(x, y) { return sq(x); }
+    return g(3, 1) + g(3, 2) * 10;
+    """
+    fns, code = codegen.codegen(bcparser.parse(lexer.tokenize(source)))
+    memo = interpreter.Memo()
+    assert interpreter.interp(fns, code, memo) == 99.0
+    assert ('sq', 1, 1) in memo.stats(fns)
+
+
+def test_memo_keeps_signed_zeros():
+    source = """
+    fn neg(x) { return x * (0 - 1); }
+    fn g(x) { return neg(x); }
+    a = neg(0); b = neg(0 * (0 - 1));
+    return b;
+    """
+    fns, code = codegen.codegen(bcparser.parse(lexer.tokenize(source)))
+    plain = interpreter.interp(fns, code)
+    assert repr(plain) == '0.0'
+    assert repr(interpreter.interp(fns, code, interpreter.Memo())) == '0.0'
+    hooks = [interpreter.Hooks()]
+    assert repr(interpreter.interp(
+        fns, code, interpreter.Memo(), hooks)) == '0.0'
+    # Both a call and a tail call, with either zero first.
+    memo = interpreter.Memo()
+    for index in (0, 1):
+        for x in (0.0, -0.0, 0.0):
+            assert (repr(interpreter.call(fns, index, [x], memo)) ==
+                    repr(interpreter.call(fns, index, [x])))
@@ -0,0 +1,126 @@
+import pytest
+
+import bcmodule
+import bcparser
+import codegen
+import interpreter
+import jit
+import lexer
+
+
+def compile_program(source, optimize=False):
+    return codegen.codegen(bcparser.parse(lexer.tokenize(source)), optimize)
+
+
+PROGRAMS = [
+    "return (3^2 + 4^2)^(1/2);",
+    "a = 2; b = 2; c = 2; d = 2; return a^b^c^d;",
+    "return 0 - 0 * 1;",
+    "a = 0 - 0; return (0 - 2) ^ 2 + a;",
+    "return (2 && 3) + (0 || 4) * 10 + (0 && 5) * 100;",
+    """
+    fn boom() { return 1 / 0; }
+    fn walk(n) {
+        if n < 0 && boom() { return 1; }
+        if n <= 0 { return (0 * (0 - 1)) && boom(); }
+        return walk(n - 1) + (n > 0 || boom()) + ((n * 2) && n);
+    }
+    return walk(3);
+    """,
+    """
+    fn sign(x) {
+        if x < 0 { return 0 - 1; } else if x == 0 { return 0; }
+        return 1;
+    }
+    return sign(-5) * 100 + sign(0) * 10 + sign(7);
+    """,
+    """
+    fn gcd(a, b, steps) {
+        if a == b { return a * 1000 + steps; }
+        if a > b { c = a - b; d = b; } else { c = a; d = b - a; }
+        return gcd(c, d, steps + 1);
+    }
+    return gcd(1071, 462, 0);
+    """,
+    """
+    fn fact(n) { if n <= 1 { return 1; } return n * fact(n - 1); }
+    fn twice(x) { y = x; y = y + x; return y; }
+    return twice(fact(10)) - fact(3);
+    """,
+    """
+    fn count(n) { if n <= 0 { return 0; } return count(n - 1); }
+    return count(100000);
+    """,
+]
+
+
+@pytest.mark.parametrize('optimize', [False, True])
+@pytest.mark.parametrize('source', PROGRAMS)
+def test_matches_interp(source, optimize):
+    fns, code = compile_program(source, optimize)
+    expected = interpreter.interp(fns, code)
+    assert repr(jit.run(fns, code)) == repr(expected)
+
+
+def test_errors():
+    fns, code = compile_program("a = 1 / 0; return 1;")
+    with pytest.raises(ZeroDivisionError):
+        jit.run(fns, code)
+    # The division happens before the call, as in the interpreter.
+    fns, code = compile_program("""
+    fn f(x) { return f(x); }
+    return 1 / 0 + f(1);
+    """)
+    with pytest.raises(ZeroDivisionError):
+        jit.run(fns, code)
+
+
+def test_self_tail_calls_loop():
+    fns, code = compile_program("""
+    fn loop(n) { if n <= 0 { return 42; } return loop(n - 1); }
+    return 0;
+    """)
+    namespace = jit.compile_functions(fns)
+    assert 'while True:' in jit.source(fns)
+    assert namespace['f0'](1e6) == 42.0
+
+
+def test_memo():
+    fns, code = compile_program("""
+    fn fib(n) { if n < 2 { return n; } return fib(n - 1) + fib(n - 2); }
+    return fib(60);
+    """)
+    memo = interpreter.Memo()
+    assert jit.run(fns, code, memo) == 1548008755920.0
+    assert memo.stats(fns) == [('fib', 58, 61)]
+
+
+def test_memo_keeps_signed_zeros():
+    fns, code = compile_program("""
+    fn neg(x) { return x * (0 - 1); }
+    a = neg(0); b = neg(0 * (0 - 1));
+    return b;
+    """)
+    assert repr(jit.run(fns, code, interpreter.Memo())) == '0.0'
+
+
+def test_fallback_lays_out_once(tmp_path, monkeypatch):
+    # Functions loaded from a module have no instructions to compile, so
+    # they all run in the interpreter.
+    fns, code = compile_program("""
+    fn fact(n) { if n <= 1 { return 1; } return n * fact(n - 1); }
+    return fact(5);
+    """)
+    module = str(tmp_path / 'fact.mathc')
+    bcmodule.write(fns, code, module)
+    fns, code = bcmodule.load(module)
+    layouts = []
+    layout = interpreter.layout
+
+    def counting_layout(fns, decoded):
+        layouts.append(len(fns))
+        return layout(fns, decoded)
+    monkeypatch.setattr(interpreter, 'layout', counting_layout)
+    namespace = jit.compile_functions(fns)
+    assert [namespace['f0'](n) for n in (3, 4, 5)] == [6.0, 24.0, 120.0]
+    assert layouts == [1]
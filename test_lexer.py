@@ -1,3 +1,4 @@
+import io
 import math
 
 import hypothesis
@@ -5,7 +6,7 @@ from hypothesis import given, example
 from hypothesis.strategies import text, floats, integers
 
 import lexer
-from lexer import Ident, Num
+from lexer import Char, Ident, Keyword, Num, Op, Sep
 
 
 @given(text(alphabet='abcdefghijklmnopqrstuvwxyz0123456789_'))
@@ -35,3 +36,43 @@ def test_lexer():
     ]
     for inp, outp in cases:
         assert list(lexer.tokenize(inp)) == outp
+
+
+def test_mixed_program():
+    text = "fn f(x) { # comment\n  return x-1 <= 2e3; }"
+    assert list(lexer.tokenize(text)) == [
+        Keyword('fn'), Ident('f'), Char('('), Ident('x'), Char(')'),
+        Char('{'), Keyword('return'), Ident('x'), Num(-1), Op('<='),
+        Num(2e3), Sep(';'), Char('}'),
+    ]
+
+
+@given(text(alphabet='abfinr019.e+-*/^<>=!&|;(){},# \t\r\né'),
+       integers(1, 8))
+def test_chunked_source(source, size):
+    expected = list(lexer.tokenize(source))
+    pieces = [source[i:i + size] for i in range(0, len(source), size)]
+    assert list(lexer.tokenize(iter(pieces))) == expected
+
+    data = source.encode('utf-8')
+    assert list(lexer.tokenize(io.BytesIO(data))) == expected
+    pieces = [data[i:i + size] for i in range(0, len(data), size)]
+    assert list(lexer.tokenize(iter(pieces))) == expected
+
+
+def test_long_line(monkeypatch):
+    # A chain like a - b - c - ..., all on one line, is still lexed a chunk
+    # at a time instead of being carried over whole into every chunk.
+    source = 'a = 1; return ' + ' - '.join(['a'] * 20000) + '; # a - b\n'
+    expected = list(lexer.tokenize(source))
+    scanned = []
+    scan = lexer.scan
+
+    def recording_scan(string, pos=0, endpos=None):
+        scanned.append(len(string))
+        return scan(string, pos, endpos)
+    monkeypatch.setattr(lexer, 'scan', recording_scan)
+    monkeypatch.setattr(lexer, 'CHUNK_SIZE', 1024)
+    assert list(lexer.tokenize(io.BytesIO(source.encode()))) == expected
+    assert len(scanned) > 50
+    assert max(scanned) < 2 * 1024
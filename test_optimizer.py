@@ -0,0 +1,112 @@
+import math
+
+import pytest
+
+import lexer
+import bcparser
+import bcinstr
+import codegen
+import interpreter
+
+
+def compile_source(source, optimize):
+    return codegen.codegen(bcparser.parse(lexer.tokenize(source)), optimize)
+
+
+def run(source, optimize):
+    return interpreter.interp(*compile_source(source, optimize))
+
+
+def same(a, b):
+    return (a == b and math.copysign(1, a) == math.copysign(1, b) or
+            a != a and b != b)
+
+
+programs = [
+    "return 13 * 2 - 9 * 2;",
+    "return (3^2 + 4^2)^(1/2);",
+    "x = -0.0; return x + 0;",
+    "x = -0.0; return x - 0;",
+    "fn f(x) { return x * 1 + x / 1 - 0 + x ^ 1; } return f(-0.0);",
+    "fn f(x) { return x + -0.0; } return f(-0.0);",
+    "a = 2; b = a * 3; c = b ^ a; return c - a;",
+    "x = 1; if x < 2 { y = 3; } else { y = 4; } return y;",
+    "fn f(n) { if n { x = 1; } else { x = 2; } return x * 10; } "
+    "return f(0) + f(1);",
+    "fn f(x) { return 2 && x; } return f(0) + f(3) + (0 || 5);",
+    "return 1e308 * 10 - 1e308 * 10;",
+]
+
+
+@pytest.mark.parametrize('source', programs)
+def test_same_results(source):
+    assert same(run(source, True), run(source, False))
+
+
+def test_folds_constants():
+    fns, code = compile_source(
+        "fn f(z) { a = 13 * 2 - z; b = 9 * 2; return a * b; } return f(1);",
+        True)
+    consts = [instr.num if instr.isa(bcinstr.LocalNumOp) else instr.value
+              for instr in fns[0].code
+              if instr.isa((bcinstr.PushNum, bcinstr.LocalNumOp))]
+    assert consts == [26.0, 18.0, 18.0]
+    assert [str(instr) for instr in code] == [
+        str(bcinstr.PushNum(1.0)), str(bcinstr.TailCall(0))]
+
+
+def test_keeps_runtime_errors():
+    with pytest.raises(ZeroDivisionError):
+        run("return 1 / 0;", True)
+
+
+def test_dead_branches():
+    fns, code = compile_source(
+        "if 1 < 0 { return 42; } else if 1 == 2 { return 32; } return 7;",
+        True)
+    assert not any(instr.isa(bcinstr.CondBranch) for instr in code)
+    assert interpreter.interp(fns, code) == 7.0
+
+
+def test_common_subexpressions():
+    fns, _ = compile_source(
+        "fn f(a, b) { x = a * b; y = (a * b) + (a * b); "
+        "z = (x - a) * (x - a); return b * a + y + z; }", True)
+    ops = [instr for instr in fns[0].code
+           if instr.isa((bcinstr.MathOp, bcinstr.LocalNumOp,
+                         bcinstr.LocalLocalOp))]
+    # a * b once, the + for y, x - a once, its square, and the two +s in
+    # the return.
+    assert len(ops) == 6
+    assert interpreter.call(fns, 0, [3.0, 4.0]) == 12 + 24 + 81
+
+
+def test_common_subexpressions_respect_assignments():
+    programs = [
+        "a = 2; x = a * 3; a = 5; return a * 3 + x;",
+        "a = 2; x = a * 3; x = 1; return a * 3 + x;",
+        "fn f(n) { if n { y = n * n; } else { y = 0; } return n * n + y; } "
+        "return f(3) + f(0);",
+        "fn f(n) { x = n * 2; if n { n = 1; } return n * 2 + x; } "
+        "return f(3) + f(0);",
+    ]
+    for source in programs:
+        assert run(source, True) == run(source, False)
+
+
+def test_reuses_slots():
+    fns, _ = compile_source(
+        "fn f(z) { a = 13 * 2 - z; b = a * 2; c = a ^ b; d = c - a * b; "
+        "return d; }", True)
+    # z is dead once a is worked out, and a, b and c are dead after d.
+    assert fns[0].frame_size == 3
+    assert interpreter.call(fns, 0, [25.0]) == 1.0 - 2.0
+
+
+def test_reused_slots_still_raise_when_unassigned():
+    source = ("fn f(n) { x = n + 1; if n { y = x; } z = x * 2; return y + z; }"
+              " return f(N);")
+    assert run(source.replace('N', '1'), True) == 6.0
+    with pytest.raises(Exception) as error:
+        run(source.replace('N', '0'), True)
+    assert 'before it was assigned' in str(error.value)
@@ -1,6 +1,8 @@
+import pytest
+
 import lexer
 import bcparser
-from bcast import IfElse, Num, Return, BinOp
+from bcast import IfElse, Num, Return, BinOp, Assignment, Ident, Call
 
 
 def test_basic_operators():
@@ -32,3 +34,51 @@ def test_if_else():
     for string, ast in cases:
         tokens = lexer.tokenize(string)
         assert bcparser.parse(tokens) == ast
+
+
+def test_precedence():
+    cases = [
+        ('1 - 2 - 3', BinOp(BinOp(Num(1), '-', Num(2)), '-', Num(3))),
+        ('1 ^ 2 ^ 3', BinOp(Num(1), '^', BinOp(Num(2), '^', Num(3)))),
+        ('1 + 2 * 3', BinOp(Num(1), '+', BinOp(Num(2), '*', Num(3)))),
+        ('(1 + 2) * 3', BinOp(BinOp(Num(1), '+', Num(2)), '*', Num(3))),
+        # An operator binding tighter than the one before it, but looser
+        # than the one before that.
+        ('1 + 2 ^ 2 * 3',
+         BinOp(Num(1), '+', BinOp(BinOp(Num(2), '^', Num(2)), '*', Num(3)))),
+        ('1 < 2 + 3 * 4 == 1',
+         BinOp(BinOp(Num(1), '<', BinOp(Num(2), '+',
+                                        BinOp(Num(3), '*', Num(4)))),
+               '==', Num(1))),
+    ]
+    for string, ast in cases:
+        assert bcparser.parse(lexer.tokenize(string)) == [ast]
+
+
+def test_calls():
+    [stmt] = bcparser.parse(lexer.tokenize('x = f(1, g(2 3), h()) + 1;'))
+    assert stmt == Assignment(Ident('x'), BinOp(
+        Call('f', [Num(1), Call('g', [Num(2), Num(3)]), Call('h', [])]),
+        '+', Num(1)))
+
+
+def test_deep_nesting():
+    depth = 20000
+    [stmt] = bcparser.parse(lexer.tokenize(
+        'return {}1{};'.format('(1 + ' * depth, ')' * depth)))
+    expr = stmt.value
+    for _ in range(depth):
+        assert expr.lhs == Num(1)
+        expr = expr.rhs
+    assert expr == Num(1)
+
+    [stmt] = bcparser.parse(lexer.tokenize(
+        'return {}1{};'.format('f(' * depth, ')' * depth)))
+    assert stmt.value.name == 'f'
+
+
+def test_errors():
+    for string in ['return (1 + 2;', 'return 1 + ;', 'fn (a) {}',
+                   'if 1 { return 2;', 'return f(1;']:
+        with pytest.raises(Exception):
+            bcparser.parse(lexer.tokenize(string))
@@ -0,0 +1,46 @@
+import bcinstr
+import interpreter
+import peephole
+from bcinstr import (PushNum, LoadLocal, StoreLocal, MathOp, Return, Branch,
+                     CondBranch, TeeLocal, LocalNumOp, LocalLocalOp)
+
+
+def test_fuses_sequences():
+    code = [
+        PushNum(2.0), StoreLocal(0), LoadLocal(0),
+        LoadLocal(0), PushNum(1.0), MathOp('-'),
+        LoadLocal(0), LoadLocal(0), MathOp('*'),
+        MathOp('+'), Return(),
+    ]
+    optimized = peephole.optimize(code)
+    assert [type(instr) for instr in optimized] == [
+        PushNum, TeeLocal, LocalNumOp, LocalLocalOp, MathOp, Return]
+    assert interpreter.interp([], optimized) == interpreter.interp([], code)
+
+
+def test_retargets_branches():
+    # if x < 1 { y = 5 } ; return y + x, with an empty else
+    code = [
+        PushNum(0.0), StoreLocal(0),
+        LoadLocal(0), PushNum(1.0), MathOp('<'),
+        CondBranch(0, 4),
+        PushNum(5.0), StoreLocal(1), LoadLocal(1), Branch(0),
+        LoadLocal(1), LoadLocal(0), MathOp('+'), Return(),
+    ]
+    optimized = peephole.optimize(code)
+    assert not any(instr.isa(Branch) for instr in optimized)
+    branch = [instr for instr in optimized if instr.isa(CondBranch)][0]
+    assert branch.false_loc == 2
+    assert interpreter.interp([], optimized) == interpreter.interp([], code)
+
+
+def test_no_fusion_across_targets():
+    # The LOAD_LOCAL after the branch is jumped to, so it can't be fused
+    # with the STORE_LOCAL before it.
+    code = [
+        PushNum(1.0), CondBranch(0, 2), PushNum(3.0), StoreLocal(0),
+        LoadLocal(0), Return(),
+    ]
+    optimized = peephole.optimize(code)
+    assert not any(instr.isa(bcinstr.TeeLocal) for instr in optimized)
+    assert optimized[1].false_loc == 2
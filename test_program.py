@@ -0,0 +1,83 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import bcmodule
+import bcparser
+import codegen
+import interpreter
+import lexer
+from program import Program
+
+
+SOURCE = """
+fn fib(n) {
+    if n < 2 { return n; }
+    return fib(n - 1) + fib(n - 2);
+}
+fn fib2(n, a, b) {
+    if n <= 0 { return a; }
+    return fib2(n - 1, b, a + b);
+}
+fn div(a, b) { return a / b; }
+return fib(10);
+"""
+
+
+def test_call():
+    program = Program.from_source(SOURCE)
+    assert program.call('fib', 10) == 55.0
+    assert program.call('fib2', 64, 0, 1) == 10610209857723.0
+    assert program.call('div', 1, 4) == 0.25
+    assert program.run() == 55.0
+    with pytest.raises(ZeroDivisionError):
+        program.call('div', 1, 0)
+    # A failed call leaves nothing behind.
+    assert program.call('fib', 12) == 144.0
+
+
+def test_bad_calls():
+    program = Program.from_source(SOURCE)
+    with pytest.raises(Exception) as error:
+        program.call('nope', 1)
+    assert 'no function called nope' in str(error.value)
+    with pytest.raises(Exception) as error:
+        program.call('fib', 1, 2)
+    assert 'fib takes 1 arguments, got 2' in str(error.value)
+
+
+def test_from_file(tmp_path):
+    script = Program.from_file('something.math')
+    assert script.call('fib', 64) == 10610209857723.0
+
+    module = str(tmp_path / 'something.mathc')
+    bcmodule.write(*codegen.codegen(bcparser.parse(lexer.tokenize(SOURCE))),
+                   name=module)
+    program = Program.from_file(module)
+    assert program.call('fib2', 64, 0, 1) == 10610209857723.0
+    assert program.run() == 55.0
+
+
+@pytest.mark.parametrize('options', [
+    {}, {'use_jit': True}, {'memo': interpreter.Memo(64)},
+    {'memo': interpreter.Memo(64), 'use_jit': True}])
+def test_threads(options):
+    program = Program.from_source(SOURCE, **options)
+    args = [n % 20 for n in range(400)]
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(lambda n: program.call('fib', n), args))
+    expected = [0.0, 1.0]
+    while len(expected) < 20:
+        expected.append(expected[-1] + expected[-2])
+    assert results == [expected[n] for n in args]
+
+
+def test_jit_deep_recursion():
+    source = """
+    fn sum(n) {
+        if n <= 0 { return 0; }
+        return n + sum(n - 1);
+    }
+    """
+    program = Program.from_source(source, use_jit=True)
+    assert program.call('sum', 100000) == 5000050000.0
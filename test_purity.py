@@ -0,0 +1,33 @@
+import lexer
+import bcparser
+import bcast
+import purity
+
+
+def pure_names(source):
+    ast = bcparser.parse(lexer.tokenize(source))
+    env = bcast.Env()
+    fns = [stmt for stmt in ast if isinstance(stmt, bcast.Fn)]
+    for fn in fns:
+        env.declare_function(fn)
+    for stmt in ast:
+        stmt.label(env)
+    pure = purity.pure_functions(fns)
+    return set(name for name, index in env.functions.items() if index in pure)
+
+
+def test_pure_functions():
+    with open('something.math') as f:
+        assert pure_names(f.read()) == set(
+            ['maths', 'id', 'id2', 'id3', 'add', 'mul', 'fib', 'fib2'])
+
+
+def test_unknown_nodes_are_impure():
+    source = "fn f(x) { return x; } fn g(x) { return f(x); }"
+    ast = bcparser.parse(lexer.tokenize(source))
+    env = bcast.Env()
+    for fn in ast:
+        env.declare_function(fn)
+        fn.label(env)
+    ast[0].body.append(object())
+    assert purity.pure_functions(ast) == set()
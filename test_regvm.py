@@ -0,0 +1,95 @@
+import pytest
+
+import bcparser
+import codegen
+import interpreter
+import lexer
+import regvm
+
+
+def compile_program(source, optimize=False):
+    return codegen.codegen(bcparser.parse(lexer.tokenize(source)), optimize)
+
+
+PROGRAMS = [
+    "return (3^2 + 4^2)^(1/2);",
+    "a = 2; b = 2; c = 2; d = 2; return a^b^c^d;",
+    "a = 2; a = a * a + a; return a * a;",
+    "a = 0 - 0; return (0 - 2) ^ 2 + a;",
+    "return (2 && 3) + (0 || 4) * 10 + (0 && 5) * 100;",
+    """
+    fn boom() { return 1 / 0; }
+    fn walk(n) {
+        if n < 0 && boom() { return 1; }
+        if n <= 0 { return (0 * (0 - 1)) && boom(); }
+        return walk(n - 1) + (n > 0 || boom()) + ((n * 2) && n);
+    }
+    return walk(3);
+    """,
+    "1 + 2; a = 3; if a > 2 { 4; a = a + 1; } else { a = 0; } return a;",
+    """
+    fn sign(x) {
+        if x < 0 { return 0 - 1; } else if x == 0 { return 0; }
+        return 1;
+    }
+    return sign(-5) * 100 + sign(0) * 10 + sign(7);
+    """,
+    """
+    fn gcd(a, b, steps) {
+        if a == b { return a * 1000 + steps; }
+        if a > b { c = a - b; d = b; } else { c = a; d = b - a; }
+        return gcd(c, d, steps + 1);
+    }
+    return gcd(1071, 462, 0);
+    """,
+    """
+    fn fib(n) { if n < 2 { return n; } return fib(n - 1) + fib(n - 2); }
+    fn swap(a, b) { return a * 10 + b; }
+    return swap(fib(10), fib(5)) + swap(3, 4);
+    """,
+]
+
+
+@pytest.mark.parametrize('optimize', [False, True])
+@pytest.mark.parametrize('source', PROGRAMS)
+def test_matches_interp(source, optimize):
+    fns, code = compile_program(source, optimize)
+    expected = interpreter.interp(fns, code)
+    assert repr(regvm.interp(fns, code)) == repr(expected)
+
+
+def test_fewer_instructions():
+    fns, code = compile_program("""
+    fn loop(n, acc) {
+        if n <= 0 { return acc; }
+        return loop(n - 1, acc + n * n);
+    }
+    return loop(10, 0);
+    """)
+    translated, main = regvm.translate(fns, code)
+    assert len(translated[0].code) < len(fns[0].code) / 2
+    # The comparison and the branch on it are fused.
+    assert translated[0].code[0][0] == regvm.UNLESS_LTE
+
+
+def test_errors():
+    fns, code = compile_program("a = 1 / 0; return 1;")
+    with pytest.raises(ZeroDivisionError):
+        regvm.interp(fns, code)
+
+    fns, code = compile_program(
+        "fn g(x) { if x { y = 1; } return y; } z = g(0); return 5;")
+    with pytest.raises(Exception, match='before it was assigned'):
+        regvm.interp(fns, code)
+    fns, code = compile_program(
+        "fn g(x) { if x { y = 1; } return y; } return g(0);")
+    with pytest.raises(Exception, match='before it was assigned'):
+        regvm.interp(fns, code)
+
+
+def test_call_result_stored_twice():
+    # The call's result is stored straight into t, and then copied to c,
+    # rather than moved out of t.
+    fns, code = compile_program(
+        "fn g(x) { return x; } t = g(2); c = t; return c - t;")
+    assert regvm.interp(fns, code) == 0.0
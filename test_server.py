@@ -0,0 +1,126 @@
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import main
+import server
+
+
+SOURCE = """
+fn fib(n) {
+    if n < 2 { return n; }
+    return fib(n - 1) + fib(n - 2);
+}
+fn div(a, b) { return a / b; }
+return fib(10);
+"""
+
+
+async def stop(listener):
+    listener.close()
+    await listener.wait_closed()
+    # Let the connections the tests closed finish up.
+    await asyncio.gather(*(asyncio.all_tasks() - {asyncio.current_task()}))
+
+
+@pytest.fixture
+def path(tmp_path):
+    path = str(tmp_path / 'math.sock')
+    loop = asyncio.new_event_loop()
+    thread = threading.Thread(target=loop.run_forever)
+    thread.start()
+    executor = ThreadPoolExecutor(2)
+    listener = asyncio.run_coroutine_threadsafe(
+        server.start(path, server.Server(executor, cache_size=2)),
+        loop).result()
+    yield path
+    asyncio.run_coroutine_threadsafe(stop(listener), loop).result()
+    loop.call_soon_threadsafe(loop.stop)
+    thread.join()
+    loop.close()
+    executor.shutdown()
+
+
+def test_compile_source():
+    values = [server.compile_source(test).run() for test in main.tests]
+    assert values == [5.0, 65536.0, -6.0, 23.5, 3.0]
+    assert server.compile_source(SOURCE).run() == 55.0
+
+
+def test_requests(path):
+    client = server.Client(path)
+    assert client.request(op='eval', source='(3^2 + 4^2)^(1/2)') == {
+        'value': 5.0}
+    key = client.request(op='load', source=SOURCE)['program']
+    assert key == server.key(SOURCE)
+    assert client.request(id=7, op='call', program=key, name='fib',
+                          args=[20]) == {'id': 7, 'value': 6765.0}
+    assert client.request(op='eval', program=key) == {'value': 55.0}
+    for request, error in [
+            ({'op': 'call', 'program': key, 'name': 'div', 'args': [1, 0]},
+             'float division by zero'),
+            ({'op': 'call', 'program': key, 'name': 'nope'},
+             'no function called nope'),
+            ({'op': 'eval', 'program': 'abc'}, 'unknown program abc'),
+            ({'op': 'eval', 'source': 'return x;'}, 'undefined'),
+            ({'op': 'frob'}, 'unknown op'),
+            ({'id': 'x'}, 'unknown op')]:
+        response = client.request(**request)
+        assert error in response['error']
+        assert response.get('id') == request.get('id')
+    client.file.write(b'not json\n')
+    assert 'error' in client.receive()
+    client.close()
+
+
+def test_pipelining(path):
+    client = server.Client(path)
+    key = client.request(op='load', source=SOURCE)['program']
+    # A slow call first, which the quick ones after it have to wait for.
+    client.send(id=0, op='call', program=key, name='fib', args=[22])
+    for n in range(1, 100):
+        client.send(id=n, op='eval', source='return {} * 2;'.format(n))
+    responses = [client.receive() for _ in range(100)]
+    assert [response['id'] for response in responses] == list(range(100))
+    assert responses[0]['value'] == 17711.0
+    assert [response['value'] for response in responses[1:]] == [
+        n * 2.0 for n in range(1, 100)]
+    # Only the last two programs are kept.
+    assert 'unknown program' in client.request(
+        op='eval', program=key)['error']
+    client.close()
+
+
+def test_complex_result(path):
+    client = server.Client(path)
+    # Fail rather than hang if the response never comes.
+    client.socket.settimeout(10)
+    try:
+        client.send(id=1, op='eval', source='(0 - 1) ^ 0.5')
+        client.send(id=2, op='eval', source='1 + 1')
+        first, second = client.receive(), client.receive()
+        assert first['id'] == 1 and 'complex' in first['error']
+        assert second == {'id': 2, 'value': 2.0}
+    finally:
+        client.close()
+
+
+def test_failed_response(path, monkeypatch):
+    respond = server.Server.respond
+
+    async def failing(self, line):
+        if b'boom' in line:
+            raise Exception('boom')
+        return await respond(self, line)
+    monkeypatch.setattr(server.Server, 'respond', failing)
+    client = server.Client(path)
+    client.socket.settimeout(10)
+    try:
+        client.send(op='eval', source='boom')
+        client.send(id=2, op='eval', source='1 + 1')
+        assert client.receive() == {'error': 'boom'}
+        assert client.receive() == {'id': 2, 'value': 2.0}
+    finally:
+        client.close()
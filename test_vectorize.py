@@ -0,0 +1,113 @@
+import pytest
+
+import bcparser
+import codegen
+import interpreter
+import lexer
+
+np = pytest.importorskip('numpy')
+import vectorize  # noqa: E402
+
+
+def compile_fns(source, optimize=False):
+    fns, _ = codegen.codegen(
+        bcparser.parse(lexer.tokenize(source)), optimize)
+    return fns
+
+
+def scalar(fns, name, *args):
+    index = [fn.name for fn in fns].index(name)
+    return interpreter.call(fns, index, args)
+
+
+SOURCE = """
+fn poly(x) { return 3 * x ^ 2 - 2 * x + 1; }
+fn clamp(x, lo, hi) {
+    if x < lo { return lo; } else if x > hi { return hi; }
+    return x;
+}
+fn pick(x) {
+    y = 0;
+    if x > 0 { y = x * 2; } else { y = 0 - x; }
+    return poly(y) + (x && 5) + (x || 7);
+}
+fn fact(n) { if n <= 1 { return 1; } return n * fact(n - 1); }
+fn usefact(x) { return fact(x) + 1; }
+fn maybe(x) { if x > 0 { y = x; } return y; }
+fn inv(x) { return 1 / x; }
+"""
+
+
+@pytest.mark.parametrize('optimize', [False, True])
+def test_matches_scalar(optimize):
+    fns = compile_fns(SOURCE, optimize)
+    xs = np.array([-3.0, -1.5, -0.0, 0.0, 0.5, 1.0, 2.0, 7.0, 1e100])
+    cases = [
+        ('poly', [xs]),
+        ('clamp', [xs, -1.0, 2.0]),
+        ('pick', [xs]),
+        ('pick', [np.array([1.0, 2.0])]),
+        ('usefact', [np.array([0.0, 1.0, 5.0, 10.0])]),
+    ]
+    for name, args in cases:
+        result = vectorize.evaluate(fns, name, *args)
+        expected = [scalar(fns, name, *lane)
+                    for lane in zip(*np.broadcast_arrays(*args))]
+        assert result.tolist() == expected
+
+
+def test_errors_match_scalar():
+    fns = compile_fns(SOURCE)
+    assert vectorize.evaluate(fns, 'maybe', [1.0, 2.0]).tolist() == [1, 2]
+    with pytest.raises(Exception):
+        vectorize.evaluate(fns, 'maybe', [1.0, -1.0])
+    with pytest.raises(ZeroDivisionError):
+        vectorize.evaluate(fns, 'inv', [1.0, 0.0])
+    with pytest.raises(OverflowError):
+        vectorize.evaluate(fns, 'poly', [1.0, 1e300])
+
+
+def test_shape():
+    fns = compile_fns(SOURCE)
+    result = vectorize.evaluate(fns, 'clamp', np.zeros((2, 3)), [[-1], [1]], 5)
+    assert result.shape == (2, 3)
+    assert result.tolist() == [[0.0] * 3, [1.0] * 3]
+
+
+def test_recursive_functions():
+    fns = compile_fns(SOURCE)
+    names = [fn.name for fn in fns]
+    assert ({names[i] for i in vectorize.recursive_functions(fns)} ==
+            {'fact'})
+
+
+def test_power_matches_python():
+    with open('something.math') as f:
+        fns = compile_fns(f.read())
+    xs = np.linspace(-5, 5, 1001)
+    result = vectorize.evaluate(fns, 'maths', xs)
+    assert result.tolist() == [scalar(fns, 'maths', x) for x in xs]
+
+
+def test_constant_power():
+    # Without -O, 2 ^ 3 isn't folded, so both operands are plain numbers.
+    fns = compile_fns("fn f(x) { return x + 2 ^ 3; }")
+    xs = np.arange(3.0)
+    assert vectorize.evaluate(fns, 'f', xs).tolist() == [8.0, 9.0, 10.0]
+
+
+def test_scalar_lanes_lay_out_once(monkeypatch):
+    fns = compile_fns(SOURCE)
+    layouts = []
+    layout = interpreter.layout
+
+    def counting_layout(fns, decoded):
+        layouts.append(len(fns))
+        return layout(fns, decoded)
+    monkeypatch.setattr(interpreter, 'layout', counting_layout)
+    xs = np.array([0.0, 1.0, 5.0, 10.0])
+    result = vectorize.evaluate(fns, 'usefact', xs)
+    assert result.tolist() == [2.0, 2.0, 121.0, 3628801.0]
+    with pytest.raises(ZeroDivisionError):
+        vectorize.evaluate(fns, 'inv', [1.0, 0.0])
+    assert len(layouts) == 2
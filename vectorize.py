@@ -0,0 +1,327 @@
+"""
+Evaluate a compiled function over whole NumPy arrays of arguments at once.
+
+The stack machine is run with arrays in place of numbers, one lane per set
+of arguments. Both sides of every if/else are evaluated, under a mask of
+the lanes that take each side, and stores and returns only affect the
+lanes in the current mask.
+
+The results are exactly those of the scalar interpreter. Lanes where Python
+would raise, like a division by zero, are tracked and run again with the
+scalar interpreter, so that they raise just the same. Anything that can't
+be vectorized falls back to the scalar interpreter: calls to recursive
+functions are made lane by lane, and whole functions that use unsupported
+code are run lane by lane.
+
+NumPy is an optional dependency, only needed for this module.
+"""
+import bcinstr
+import interpreter
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+class Unsupported(Exception):
+    """
+    Raised for code that can't be vectorized.
+    """
+
+
+def scalar_power(lhs, rhs):
+    """
+    Python's a ** b, except that where it would raise, for overflow or zero
+    to a negative power, or leave the reals, for a negative number to a
+    fractional power, it gives NaN.
+    """
+    try:
+        result = lhs ** rhs
+    except (ArithmeticError, ValueError):
+        return float('nan')
+    if isinstance(result, complex):
+        return float('nan')
+    return result
+
+
+if np is not None:
+    power = np.frompyfunc(scalar_power, 2, 1)
+
+
+def binary(op, lhs, rhs, mask, state):
+    """
+    Apply an operator to arrays, flagging the lanes in mask where the
+    interpreter would raise.
+    """
+    if op == '+':
+        return lhs + rhs
+    elif op == '-':
+        return lhs - rhs
+    elif op == '*':
+        return lhs * rhs
+    elif op == '/':
+        state.fail(mask & (rhs == 0))
+        return lhs / rhs
+    elif op == '^':
+        # NumPy's power can differ from Python's in the last place, so
+        # this one still goes element by element, just without the
+        # interpreter around it.
+        # On two constants, the ufunc gives back a float, not an array.
+        result = np.asarray(power(lhs, rhs), dtype=np.float64)
+        state.fail(mask & ~np.isfinite(result) &
+                   np.isfinite(lhs) & np.isfinite(rhs))
+        return result
+    elif op == '&&':
+        return np.where(lhs != 0, rhs, lhs)
+    elif op == '||':
+        return np.where(lhs != 0, lhs, rhs)
+    comparisons = {
+        '>': np.greater, '<': np.less, '>=': np.greater_equal,
+        '<=': np.less_equal, '==': np.equal, '!=': np.not_equal,
+    }
+    return comparisons[op](lhs, rhs).astype(np.float64)
+
+
+class State(object):
+    """
+    The state of one vectorized call: its locals, data stack, result and
+    which lanes have returned or need to be run again by the interpreter.
+    """
+    def __init__(self, size):
+        self.size = size
+        # slot -> (values, mask of the lanes where the local is assigned)
+        self.locals = {}
+        self.stack = []
+        self.result = np.zeros(size)
+        self.done = np.zeros(size, dtype=bool)
+        self.failed = np.zeros(size, dtype=bool)
+
+    def fail(self, lanes):
+        self.failed |= lanes
+
+    def store(self, slot, value, mask):
+        value = np.broadcast_to(value, (self.size,))
+        if slot in self.locals:
+            old, assigned = self.locals[slot]
+            self.locals[slot] = (np.where(mask, value, old), assigned | mask)
+        else:
+            self.locals[slot] = (value, mask.copy())
+
+    def load(self, slot, mask):
+        if slot not in self.locals:
+            # Never assigned on any path, so every lane would fail.
+            self.fail(mask)
+            return np.zeros(self.size)
+        value, assigned = self.locals[slot]
+        self.fail(mask & ~assigned)
+        return value
+
+
+class Vectorizer(object):
+    def __init__(self, fns, memo=None):
+        self.fns = fns
+        self.memo = memo
+        self.recursive = recursive_functions(fns)
+        # The program laid out for the scalar interpreter, the first time
+        # a lane needs it.
+        self.frames = None
+
+    def scalar(self, index, args):
+        """
+        Call fns[index] once, in the scalar interpreter.
+        """
+        if self.frames is None:
+            self.frames = interpreter.prepare(self.fns, self.memo)
+        return interpreter.invoke(self.fns, self.frames, index, args,
+                                  self.memo)
+
+    def call(self, index, args, mask):
+        """
+        Call fns[index] for the lanes in mask. Returns the results and the
+        lanes that need to be run again by the interpreter.
+        """
+        if index not in self.recursive:
+            try:
+                return self.vectorized_call(index, args, mask)
+            except Unsupported:
+                pass
+        return self.scalar_call(index, args, mask)
+
+    def scalar_call(self, index, args, mask):
+        size = len(mask)
+        result = np.zeros(size)
+        failed = np.zeros(size, dtype=bool)
+        args = [np.broadcast_to(arg, (size,)) for arg in args]
+        for lane in np.flatnonzero(mask):
+            try:
+                result[lane] = self.scalar(index,
+                                           [arg[lane] for arg in args])
+            except Exception:
+                # Let the final run of the whole lane raise it.
+                failed[lane] = True
+        return result, failed
+
+    def vectorized_call(self, index, args, mask):
+        code = self.fns[index].code
+        if code is None:
+            raise Unsupported("function has no instructions")
+        state = State(len(mask))
+        state.stack.extend(args)
+        self.region(code, 0, len(code), state, mask)
+        return state.result, state.failed
+
+    def region(self, code, start, end, state, mask):
+        """
+        Run code[start:end] for the lanes in mask.
+        """
+        ip = start
+        while ip < end:
+            if not mask.any():
+                return
+            instr = code[ip]
+            stack = state.stack
+            if instr.isa(bcinstr.PushNum):
+                stack.append(instr.value)
+            elif instr.isa(bcinstr.LoadLocal):
+                stack.append(state.load(instr.value, mask))
+            elif instr.isa(bcinstr.StoreLocal):
+                state.store(instr.value, stack.pop(), mask)
+            elif instr.isa(bcinstr.TeeLocal):
+                state.store(instr.value, stack[-1], mask)
+            elif instr.isa(bcinstr.MathOp):
+                rhs = stack.pop()
+                lhs = stack.pop()
+                stack.append(binary(instr.value, lhs, rhs, mask, state))
+            elif instr.isa(bcinstr.LocalNumOp):
+                lhs = state.load(instr.slot, mask)
+                stack.append(binary(instr.op, lhs, instr.num, mask, state))
+            elif instr.isa(bcinstr.LocalLocalOp):
+                lhs = state.load(instr.lhs, mask)
+                rhs = state.load(instr.rhs, mask)
+                stack.append(binary(instr.op, lhs, rhs, mask, state))
+            elif instr.isa((bcinstr.Call, bcinstr.TailCall)):
+                arity = self.fns[instr.value].arity
+                args = stack[len(stack) - arity:]
+                del stack[len(stack) - arity:]
+                result, failed = self.call(instr.value, args, mask)
+                state.fail(mask & failed)
+                stack.append(result)
+                if instr.isa(bcinstr.TailCall):
+                    self.ret(state, mask)
+                    return
+            elif instr.isa(bcinstr.Return):
+                self.ret(state, mask)
+                return
+            elif instr.isa(bcinstr.CondBranch):
+                ip = self.if_else(code, ip, state, mask)
+                mask = mask & ~state.done
+                continue
+            else:
+                raise Unsupported("unstructured {}".format(instr))
+            ip += 1
+
+    def ret(self, state, mask):
+        value = np.broadcast_to(state.stack.pop(), (state.size,))
+        state.result = np.where(mask, value, state.result)
+        state.done |= mask
+
+    def if_else(self, code, ip, state, mask):
+        """
+        Run the if/else starting with the COND_BRANCH at code[ip], and
+        return the index of the first instruction after it.
+        """
+        branch = code[ip]
+        if branch.true_loc != 0 or branch.false_loc < 0:
+            raise Unsupported("unstructured branch")
+        if_start = ip + 1
+        else_start = if_start + branch.false_loc
+        # An if with an else ends with a forward branch over the else. The
+        # peephole optimizer drops the empty ones from ifs without an else.
+        last = code[else_start - 1] if else_start > if_start else None
+        if last is not None and last.isa(bcinstr.Branch) and last.value >= 0:
+            if_end, end = else_start - 1, else_start + last.value
+        elif last is not None and last.isa(bcinstr.Branch):
+            raise Unsupported("backward branch")
+        else:
+            if_end, end = else_start, else_start
+
+        cond = np.broadcast_to(state.stack.pop(), (state.size,)) != 0
+        depth = len(state.stack)
+        self.region(code, if_start, if_end, state, mask & cond)
+        if_values = state.stack[depth:]
+        del state.stack[depth:]
+        self.region(code, else_start, end, state, mask & ~cond)
+        else_values = state.stack[depth:]
+        del state.stack[depth:]
+        # Each side of a conditional expression leaves its value on the
+        # stack. Anything else left behind is from expression statements,
+        # which nothing ever reads. A side that no lane takes doesn't run at
+        # all, so the other side's values are used for every lane.
+        if not (mask & cond).any():
+            if_values = else_values
+        elif not (mask & ~cond).any():
+            else_values = if_values
+        if len(if_values) == len(else_values):
+            for if_value, else_value in zip(if_values, else_values):
+                state.stack.append(np.where(cond, if_value, else_value))
+        return end
+
+
+def recursive_functions(fns):
+    """
+    Find the indices of the functions that can end up calling themselves.
+    """
+    callees = {}
+    for index, fn in enumerate(fns):
+        callees[index] = set(
+            instr.value for instr in fn.code or []
+            if instr.isa((bcinstr.Call, bcinstr.TailCall)))
+        if fn.code is None:
+            callees[index].add(index)
+
+    recursive = set()
+    for index in callees:
+        seen = set()
+        todo = list(callees[index])
+        while todo:
+            callee = todo.pop()
+            if callee == index:
+                recursive.add(index)
+                break
+            if callee not in seen:
+                seen.add(callee)
+                todo.extend(callees[callee])
+    return recursive
+
+
+def evaluate(fns, name, *args, **kwargs):
+    """
+    Call the function called name once for every element of the argument
+    arrays, which are broadcast against each other. Returns an array of the
+    results. Pass memo to memoize the calls that fall back to the scalar
+    interpreter.
+    """
+    if np is None:
+        raise Exception("Vectorized evaluation needs NumPy")
+    index = [fn.name for fn in fns].index(name)
+    if len(args) != fns[index].arity:
+        raise Exception("{} takes {} arguments, got {}".format(
+            name, fns[index].arity, len(args)))
+
+    args = np.broadcast_arrays(
+        *[np.asarray(arg, dtype=np.float64) for arg in args])
+    shape = args[0].shape if args else ()
+    args = [arg.ravel() for arg in args]
+    size = len(args[0]) if args else 1
+
+    vectorizer = Vectorizer(fns, kwargs.get('memo'))
+    with np.errstate(all='ignore'):
+        result, failed = vectorizer.call(
+            index, args, np.ones(size, dtype=bool))
+    # Run the lanes that would have raised through the interpreter, which
+    # raises the same exception it would have in a scalar call.
+    result = np.array(result)
+    for lane in np.flatnonzero(failed):
+        result[lane] = vectorizer.scalar(index, [arg[lane] for arg in args])
+    return result.reshape(shape)